@@ -1845,6 +1845,11 @@ class FirewallClientConfig(object):
     def set_property(self, prop, value):
         self.fw_properties.Set(DBUS_INTERFACE_CONFIG, prop, value)
 
+    @slip.dbus.polkit.enable_proxy
+    @handle_exceptions
+    def commit(self):
+        self.fw_config.commit()
+
     # ipset
 
     @slip.dbus.polkit.enable_proxy
@@ -2685,6 +2690,11 @@ class FirewallClient(object):
     def passthrough(self, ipv, args):
         return dbus_to_python(self.fw_direct.passthrough(ipv, args))
 
+    @slip.dbus.polkit.enable_proxy
+    @handle_exceptions
+    def passthroughs(self, ipv, args_list):
+        return dbus_to_python(self.fw_direct.passthroughs(ipv, args_list))
+
     # tracked passthrough
 
     @slip.dbus.polkit.enable_proxy
@@ -2707,6 +2717,11 @@ class FirewallClient(object):
     def addPassthrough(self, ipv, args):
         self.fw_direct.addPassthrough(ipv, args)
 
+    @slip.dbus.polkit.enable_proxy
+    @handle_exceptions
+    def addPassthroughs(self, ipv, args_list):
+        return dbus_to_python(self.fw_direct.addPassthroughs(ipv, args_list))
+
     @slip.dbus.polkit.enable_proxy
     @handle_exceptions
     def removePassthrough(self, ipv, args):
@@ -21,6 +21,8 @@
 
 import os.path
 import copy
+import heapq
+import time
 from firewall.config import *
 from firewall import functions
 from firewall.core import ipXtables
@@ -36,6 +38,7 @@ from firewall.core.fw_policies import FirewallPolicies
 from firewall.core.fw_ipset import FirewallIPSet
 from firewall.core.logger import log
 from firewall.core.io.firewalld_conf import firewalld_conf
+from firewall.core.io.config_cache import ConfigCache
 from firewall.core.io.direct import Direct
 from firewall.core.io.service import service_reader
 from firewall.core.io.icmptype import icmptype_reader
@@ -52,6 +55,7 @@ from firewall.errors import *
 class Firewall(object):
     def __init__(self):
         self._firewalld_conf = firewalld_conf(FIREWALLD_CONF)
+        self._config_cache = ConfigCache(FIREWALLD_CONFIG_CACHE)
 
         self._ip4tables = ipXtables.ip4tables()
         self.ip4tables_enabled = True
@@ -72,28 +76,44 @@ class Firewall(object):
         self.policies = FirewallPolicies()
         self.ipset = FirewallIPSet(self)
 
+        # applies the restore rules of handle_rules and handle_chains if set
+        self._rules_committer = None
+        # calls waiting for the rules of the committer: (func, args)
+        self._after_rules = [ ]
+        # saved runtime state for rollback, see checkpoint
+        self._checkpoint = None
+
         self.__init_vars()
 
     def __repr__(self):
-        return '%s(%r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r %r)' % \
+        return '%s(%r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r)' % \
             (self.__class__, self.ip4tables_enabled, self.ip6tables_enabled,
              self.ebtables_enabled, self._state, self._panic,
              self._default_zone, self._module_refcount, self._marks,
              self._min_mark, self.cleanup_on_exit, self.ipv6_rpfilter_enabled,
-             self.ipset_enabled, self._individual_calls, self._log_denied)
+             self.ipset_enabled, self._individual_calls, self._log_denied,
+             self._forward_port_marks, self._parallel_config_loading,
+             self._group_commit_window, self._group_commit_max_batch)
 
     def __init_vars(self):
         self._state = "INIT"
         self._panic = False
         self._default_zone = ""
         self._module_refcount = { }
-        self._marks = [ ]
+        # marks in use, freed marks (min heap) and next never used mark
+        self._marks = set()
+        self._free_marks = [ ]
+        self._next_mark = None
         # fallback settings will be overloaded by firewalld.conf
         self._min_mark = FALLBACK_MINIMAL_MARK
         self.cleanup_on_exit = FALLBACK_CLEANUP_ON_EXIT
         self.ipv6_rpfilter_enabled = FALLBACK_IPV6_RPFILTER
         self._individual_calls = FALLBACK_INDIVIDUAL_CALLS
         self._log_denied = FALLBACK_LOG_DENIED
+        self._forward_port_marks = FALLBACK_FORWARD_PORT_MARKS
+        self._parallel_config_loading = FALLBACK_PARALLEL_CONFIG_LOADING
+        self._group_commit_window = FALLBACK_GROUP_COMMIT_WINDOW
+        self._group_commit_max_batch = FALLBACK_GROUP_COMMIT_MAX_BATCH
 
     def _check_tables(self):
         # check if iptables, ip6tables and ebtables are usable, else disable
@@ -123,7 +143,7 @@ class Firewall(object):
             log.error("ipset not usable, disabling ipset usage in firewall.")
             self.ipset_enabled = False
 
-    def _start(self):
+    def _start(self, preload=False):
         # initialize firewall
         default_zone = FALLBACK_ZONE
 
@@ -181,11 +201,42 @@ class Firewall(object):
                     self._log_denied = value.lower()
                     log.debug1("LogDenied is set to '%s'", self._log_denied)
 
+            if self._firewalld_conf.get("ForwardPortMarks"):
+                value = self._firewalld_conf.get("ForwardPortMarks")
+                if value is not None:
+                    if value.lower() in [ "no", "false" ]:
+                        self._forward_port_marks = False
+                    if value.lower() in [ "yes", "true" ]:
+                        self._forward_port_marks = True
+            if not self._forward_port_marks:
+                log.debug1("ForwardPortMarks is disabled, using conntrack "
+                           "DNAT state for forward ports")
+
+            if self._firewalld_conf.get("ParallelConfigLoading"):
+                value = self._firewalld_conf.get("ParallelConfigLoading")
+                if value is not None:
+                    if value.lower() in [ "no", "false" ]:
+                        self._parallel_config_loading = False
+                    if value.lower() in [ "yes", "true" ]:
+                        self._parallel_config_loading = True
+            if not self._parallel_config_loading:
+                log.debug1("ParallelConfigLoading is disabled")
+
+            if self._firewalld_conf.get("GroupCommitWindow"):
+                self._group_commit_window = \
+                    int(self._firewalld_conf.get("GroupCommitWindow"))
+
+            if self._firewalld_conf.get("GroupCommitMaxBatch"):
+                self._group_commit_max_batch = \
+                    int(self._firewalld_conf.get("GroupCommitMaxBatch"))
+            if self._group_commit_max_batch < 2:
+                log.debug1("Group commits are disabled")
+
             if not self._individual_calls and \
                not self._ebtables.restore_noflush_option:
                 log.debug1("ebtables-restore is not supporting the --noflush option, will therefore not be used")
 
-        self.config.set_firewalld_conf(copy.deepcopy(self._firewalld_conf))
+        self.config.set_firewalld_conf(copy.copy(self._firewalld_conf))
 
         # apply default rules
         self._apply_default_rules()
@@ -203,7 +254,28 @@ class Firewall(object):
                       self.policies.lockdown_whitelist.filename, msg)
 
         # copy policies to config interface
-        self.config.set_policies(copy.deepcopy(self.policies))
+        self.config.set_policies(copy.copy(self.policies))
+
+        # load cache of parsed configuration files
+        self._config_cache.read()
+
+        # parse changed configuration files in parallel, the results are
+        # used by the loaders in the same order as with serial loading.
+        # Only at the initial start: the worker processes are forked, this
+        # is not safe anymore if the main loop and reload threads exist.
+        if preload and self._parallel_config_loading:
+            jobs = [ ]
+            for (path, reader_type) in [
+                    (FIREWALLD_IPSETS, "ipset"),
+                    (ETC_FIREWALLD_IPSETS, "ipset"),
+                    (FIREWALLD_ICMPTYPES, "icmptype"),
+                    (ETC_FIREWALLD_ICMPTYPES, "icmptype"),
+                    (FIREWALLD_SERVICES, "service"),
+                    (ETC_FIREWALLD_SERVICES, "service"),
+                    (FIREWALLD_ZONES, "zone"),
+                    (ETC_FIREWALLD_ZONES, "zone") ]:
+                jobs += self._loader_jobs(path, reader_type)
+            self._config_cache.preload(jobs)
 
         # load ipset files
         self._loader(FIREWALLD_IPSETS, "ipset")
@@ -227,6 +299,9 @@ class Firewall(object):
         self._loader(FIREWALLD_ZONES, "zone")
         self._loader(ETC_FIREWALLD_ZONES, "zone")
 
+        # save cache of parsed configuration files
+        self._config_cache.write()
+
         if len(self.zone.get_zones()) == 0:
             log.fatal("No zones found.")
             sys.exit(1)
@@ -256,7 +331,7 @@ class Firewall(object):
                 log.debug1("Failed to load direct rules file '%s': %s",
                            FIREWALLD_DIRECT, msg)
         self.direct.set_permanent_config(obj)
-        self.config.set_direct(copy.deepcopy(obj))
+        self.config.set_direct(copy.copy(obj))
 
         # check if default_zone is a valid zone
         if default_zone not in self.zone.get_zones():
@@ -283,7 +358,25 @@ class Firewall(object):
         self._check_tables()
         self._flush()
         self._set_policy("ACCEPT")
-        self._start()
+        self._start(preload=True)
+
+    def _loader_jobs(self, path, reader_type):
+        # files that will be read by _loader: [ (reader, filename, path) ]
+        readers = { "icmptype": icmptype_reader, "service": service_reader,
+                    "zone": zone_reader, "ipset": ipset_reader }
+        jobs = [ ]
+        if not os.path.isdir(path):
+            return jobs
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith(".xml"):
+                if path.startswith(ETC_FIREWALLD) and \
+                        reader_type == "zone" and \
+                        os.path.isdir("%s/%s" % (path, filename)):
+                    jobs += self._loader_jobs("%s/%s" % (path, filename),
+                                              reader_type)
+                continue
+            jobs.append((readers[reader_type], filename, path))
+        return jobs
 
     def _loader(self, path, reader_type, combine=False):
         # combine: several zone files are getting combined into one obj
@@ -313,7 +406,8 @@ class Firewall(object):
             log.debug1("Loading %s file '%s'", reader_type, name)
             try:
                 if reader_type == "icmptype":
-                    obj = icmptype_reader(filename, path)
+                    obj = self._config_cache.get(icmptype_reader,
+                                                 filename, path)
                     if obj.name in self.icmptype.get_icmptypes():
                         orig_obj = self.icmptype.get_icmptype(obj.name)
                         log.debug1("  Overloads %s '%s' ('%s/%s')", reader_type,
@@ -323,10 +417,11 @@ class Firewall(object):
                     elif obj.path.startswith(ETC_FIREWALLD):
                         obj.default = True
                     self.icmptype.add_icmptype(obj)
-                    # add a deep copy to the configuration interface
-                    self.config.add_icmptype(copy.deepcopy(obj))
+                    # add a copy-on-write copy to the configuration interface
+                    self.config.add_icmptype(copy.copy(obj))
                 elif reader_type == "service":
-                    obj = service_reader(filename, path)
+                    obj = self._config_cache.get(service_reader,
+                                                 filename, path)
                     if obj.name in self.service.get_services():
                         orig_obj = self.service.get_service(obj.name)
                         log.debug1("  Overloads %s '%s' ('%s/%s')", reader_type,
@@ -336,10 +431,11 @@ class Firewall(object):
                     elif obj.path.startswith(ETC_FIREWALLD):
                         obj.default = True
                     self.service.add_service(obj)
-                    # add a deep copy to the configuration interface
-                    self.config.add_service(copy.deepcopy(obj))
+                    # add a copy-on-write copy to the configuration interface
+                    self.config.add_service(copy.copy(obj))
                 elif reader_type == "zone":
-                    obj = zone_reader(filename, path)
+                    obj = self._config_cache.get(zone_reader,
+                                                 filename, path)
                     if combine:
                         # Change name for permanent configuration
                         obj.name = "%s/%s" % (
@@ -347,7 +443,7 @@ class Firewall(object):
                             os.path.basename(filename)[0:-4])
                         obj.check_name(obj.name)
                     # Copy object before combine
-                    config_obj = copy.deepcopy(obj)
+                    config_obj = copy.copy(obj)
                     if obj.name in self.zone.get_zones():
                         orig_obj = self.zone.get_zone(obj.name)
                         self.zone.remove_zone(orig_obj.name)
@@ -373,7 +469,8 @@ class Firewall(object):
                     else:
                         self.zone.add_zone(obj)
                 elif reader_type == "ipset":
-                    obj = ipset_reader(filename, path)
+                    obj = self._config_cache.get(ipset_reader,
+                                                 filename, path)
                     if obj.name in self.ipset.get_ipsets():
                         orig_obj = self.ipset.get_ipset(obj.name)
                         log.debug1("  Overloads %s '%s' ('%s/%s')", reader_type,
@@ -383,8 +480,8 @@ class Firewall(object):
                     elif obj.path.startswith(ETC_FIREWALLD):
                         obj.default = True
                     self.ipset.add_ipset(obj)
-                    # add a deep copy to the configuration interface
-                    self.config.add_ipset(copy.deepcopy(obj))
+                    # add a copy-on-write copy to the configuration interface
+                    self.config.add_ipset(copy.copy(obj))
                 else:
                     log.fatal("Unknown reader type %s", reader_type)
             except FirewallError as msg:
@@ -412,12 +509,32 @@ class Firewall(object):
         self.service.cleanup()
         self.zone.cleanup()
         self.ipset.cleanup()
+        self._marks.clear()
+        del self._free_marks[:]
+        self._next_mark = None
         self.config.cleanup()
         self.direct.cleanup()
         self.policies.cleanup()
         self._firewalld_conf.cleanup()
         self.__init_vars()
 
+    def snapshot(self):
+        """ Return a copy of the runtime state for read only queries, that
+            is not affected by changes of this object like a reload. The
+            permanent configuration is not part of the snapshot.
+        """
+        obj = copy.copy(self)
+        obj._marks = self._marks.copy()
+        obj._free_marks = self._free_marks[:]
+        obj._module_refcount = self._module_refcount.copy()
+        obj.icmptype = self.icmptype.snapshot(obj)
+        obj.service = self.service.snapshot(obj)
+        obj.zone = self.zone.snapshot(obj)
+        obj.direct = self.direct.snapshot(obj)
+        obj.policies = self.policies.snapshot()
+        obj.ipset = self.ipset.snapshot(obj)
+        return obj
+
     def stop(self):
         if self.cleanup_on_exit:
             self._flush()
@@ -429,18 +546,97 @@ class Firewall(object):
     # marks
 
     def new_mark(self):
-        # return first unused mark
-        i = self._min_mark
-        while i in self._marks:
-            i += 1
-        self._marks.append(i)
+        # return first unused mark: reuse the lowest freed mark if there is
+        # one, else continue after the highest mark used so far
+        if self._next_mark is None or self._next_mark < self._min_mark:
+            self._next_mark = max([ self._min_mark ] + \
+                                  [ x + 1 for x in self._marks ])
+        while self._free_marks:
+            i = heapq.heappop(self._free_marks)
+            if i >= self._min_mark and i not in self._marks:
+                break
+        else:
+            i = self._next_mark
+            self._next_mark += 1
+        self._marks.add(i)
         return i
 
     def del_mark(self, mark):
         self._marks.remove(mark)
+        if mark == self._next_mark - 1:
+            self._next_mark -= 1
+        else:
+            heapq.heappush(self._free_marks, mark)
 
     # handle rules, chains and modules
 
+    def get_group_commit(self):
+        # window in milliseconds and maximum batch size for group commits,
+        # rules are not grouped if they are applied with individual calls
+        if self._individual_calls:
+            return (0, 1)
+        return (self._group_commit_window, self._group_commit_max_batch)
+
+    def set_rules_committer(self, committer):
+        """ Let committer(rules, values) apply the rules of handle_rules and
+            handle_chains, that are applied with restore calls. rules and
+            values are dicts ipv -> list of the prepared restore rules and
+            the corresponding items of the rules argument. The committer
+            returns None if all worked, else (items of the rules, that have
+            been applied and need a cleanup, error message). None is
+            restoring the default, the calls waiting for the rules of the
+            committer are done then.
+        """
+        self._rules_committer = committer
+        if committer is None:
+            calls = self._after_rules
+            self._after_rules = [ ]
+            for (func, args) in calls:
+                func(*args)
+
+    def after_rules(self, func, *args):
+        """ Call func(*args) after the rules given to handle_rules and
+            handle_chains before have been applied: right away without a
+            rules committer, else when the committer is reset.
+        """
+        if self._rules_committer is None:
+            func(*args)
+        else:
+            self._after_rules.append((func, args))
+
+    def checkpoint(self):
+        """ Save the runtime state of the zones, the marks and the module
+            references and record the changes of the ipsets from now on.
+            The state is restored with rollback, release drops it.
+        """
+        if self._checkpoint is not None:
+            raise RuntimeError("Checkpoint exists already")
+        # the state of the zones is restored in place, the firewall and the
+        # rich rules are shared, the rules are immutable
+        state = copy.deepcopy((self.zone.__dict__, self._marks,
+                               self._free_marks, self._next_mark,
+                               self._module_refcount), { id(self): self })
+        self._ipset = ipset.ipset_journal(self._ipset)
+        self._checkpoint = state
+
+    def rollback(self):
+        """ Restore the runtime state of the checkpoint and undo the changes
+            of the ipsets. The calls waiting for the rules of the committer
+            are dropped.
+        """
+        (zone, self._marks, self._free_marks, self._next_mark,
+         self._module_refcount) = self._checkpoint
+        self.zone.__dict__.clear()
+        self.zone.__dict__.update(zone)
+        self._after_rules = [ ]
+        self._ipset.undo()
+        self.release()
+
+    def release(self):
+        """ Drop the checkpoint """
+        self._ipset = self._ipset.backend
+        self._checkpoint = None
+
     def handle_rules(self, rules, enable, insert=False):
         if insert:
             append_delete = { True: "-I", False: "-D", }
@@ -448,6 +644,7 @@ class Firewall(object):
             append_delete = { True: "-A", False: "-D", }
 
         _rules = { }
+        _values = { }
         # appends rules
         # returns None if all worked, else (cleanup rules, error message)
         for i,value in enumerate(rules):
@@ -496,6 +693,10 @@ class Firewall(object):
                     return (rules[:i], msg) # cleanup rules and error message
             else:
                 _rules.setdefault(ipv, []).append(_rule)
+                _values.setdefault(ipv, []).append(value)
+
+        if self._rules_committer is not None and len(_rules) > 0:
+            return self._rules_committer(_rules, _values)
 
         try:
             for ipv in _rules:
@@ -511,6 +712,7 @@ class Firewall(object):
         new_delete = { True: "-N", False: "-X" }
 
         _rules = { }
+        _values = { }
         # appends chains
         # returns None if all worked, else (cleanup chains, error message)
         for i,(ipv, rule) in enumerate(rules):
@@ -524,6 +726,11 @@ class Firewall(object):
                     return (rules[:i], msg) # cleanup chains and error message
             else:
                 _rules.setdefault(ipv, []).append(_rule)
+                _values.setdefault(ipv, []).append((ipv, rule))
+
+        if self._rules_committer is not None and len(_rules) > 0:
+            return self._rules_committer(_rules, _values)
+
         try:
             for ipv in _rules:
                 self.rules(ipv, _rules[ipv])
@@ -861,6 +1068,18 @@ class Firewall(object):
         _zone_interfaces = { }
         for zone in self.zone.get_zones():
             _zone_interfaces[zone] = self.zone.get_settings(zone)["interfaces"]
+        # save timed settings, that have not expired yet
+        _zone_timed = { }
+        now = time.time()
+        for zone in self.zone.get_zones():
+            settings = self.zone.get_settings(zone)
+            for key in [ "services", "ports", "protocols", "icmp_blocks",
+                         "masquerade", "forward_ports", "rules" ]:
+                for (args, _settings) in settings[key].items():
+                    timeout = _settings.get("timeout", 0)
+                    if timeout > 0 and _settings["date"] + timeout > now:
+                        _zone_timed.setdefault(zone, { }).setdefault(key, { })
+                        _zone_timed[zone][key][args] = _settings
         # save direct config
         _direct_config = self.direct.get_runtime_config()
         _old_dz = self.get_default_zone()
@@ -870,6 +1089,8 @@ class Firewall(object):
         self._flush()
         if stop:
             self._modules.unload_firewall_modules()
+        # ipsets with entries files are only updated with the changes
+        self.ipset.keep_ipsets()
         self.cleanup()
 
         # start
@@ -908,6 +1129,15 @@ class Firewall(object):
                 del _zone_interfaces[zone]
         del _zone_interfaces
 
+        # restore timed settings, the remaining time is calculated from the
+        # saved date and timeout
+        for zone in _zone_timed:
+            if zone in self.zone.get_zones():
+                self.zone.set_settings(zone, _zone_timed[zone])
+            else:
+                log.info1("Lost zone '%s', timed settings dropped.", zone)
+        del _zone_timed
+
         # restore direct config
         self.direct.set_config(_direct_config)
 
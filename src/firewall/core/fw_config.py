@@ -21,6 +21,8 @@
 
 import copy
 import os, os.path
+import shutil
+import tempfile
 from firewall.config import *
 from firewall.core.base import *
 from firewall.core.logger import log
@@ -54,8 +56,16 @@ class FirewallConfig(object):
         self._firewalld_conf = None
         self._policies = None
         self._direct = None
+        self._write_delay = 0
+        self._write_source = None
+        self._pending_writes = { } # name: (writer, obj)
 
     def cleanup(self):
+        try:
+            self.commit()
+        except FirewallError as msg:
+            log.error(msg)
+
         for x in list(self._builtin_ipsets.keys()):
             self._builtin_ipsets[x].cleanup()
             del self._builtin_ipsets[x]
@@ -106,9 +116,149 @@ class FirewallConfig(object):
     def lockdown_enabled(self):
         return self._fw.policies.query_lockdown()
 
+    def access_check_keys(self):
+        return self._fw.policies.access_check_keys()
+
     def access_check(self, key, value):
         return self._fw.policies.access_check(key, value)
 
+    # configuration files
+
+    def _find_by_filename(self, objs, filename):
+        # objects are normally named after their file, scan only otherwise
+        if filename.endswith(".xml") and filename[:-4] in objs and \
+           objs[filename[:-4]].filename == filename:
+            return filename[:-4]
+        for x in objs:
+            if objs[x].filename == filename:
+                return x
+        return None
+
+    # write-behind of configuration files
+
+    def set_write_delay(self, delay):
+        """ Delay writing changed configuration files for delay seconds.
+            The changed objects are collected and every object is written
+            once when the delay is over, all files of a burst are synced
+            and renamed in one batch. The objects have been checked with
+            import_config when they have been changed. A delay of 0 is
+            writing the files immediately. Needs a GLib main loop if enabled.
+        """
+        self._write_delay = delay
+        if delay <= 0:
+            self.commit()
+
+    def _write_name(self, obj):
+        if obj.filename:
+            return "%s/%s" % (obj.path, obj.filename)
+        return "%s/%s.xml" % (obj.path, obj.name)
+
+    def _write(self, writer, obj):
+        if self._write_delay <= 0:
+            writer(obj)
+            return
+        # the last change of the file wins, the object is written with the
+        # settings it has at the commit
+        self._pending_writes[self._write_name(obj)] = (writer, obj)
+        if self._write_source is None:
+            from gi.repository import GLib
+            self._write_source = GLib.timeout_add_seconds(
+                self._write_delay, self._write_timeout)
+
+    def _write_timeout(self):
+        self._write_source = None
+        try:
+            self.commit()
+        except FirewallError as msg:
+            log.error(msg)
+        # remove this GLib source
+        return False
+
+    def _write_pending(self, name):
+        return name in self._pending_writes
+
+    def _remove_file(self, name):
+        # a pending write of a file, that does not exist yet, is only dropped
+        pending = self._pending_writes.pop(name, None)
+        if pending is None or os.path.exists(name):
+            os.remove(name)
+
+    def _fsync(self, name):
+        fd = os.open(name, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def commit(self):
+        """ Write all pending configuration files
+
+        Every changed object is written once into a temporary directory in
+        ETC_FIREWALLD, the files are synced to disk and then renamed to
+        their final names. The previous version of a file is kept as backup
+        with the .old suffix like the writers do. Raises FirewallError if a
+        file could not be written, the other files are committed.
+        """
+        if self._write_source is not None:
+            from gi.repository import GLib
+            GLib.source_remove(self._write_source)
+            self._write_source = None
+        if len(self._pending_writes) < 1:
+            return
+        pending = self._pending_writes
+        self._pending_writes = { }
+
+        log.debug1("Writing %d configuration files", len(pending))
+        if not os.path.exists(ETC_FIREWALLD):
+            os.mkdir(ETC_FIREWALLD, 0o750)
+        temp_dir = tempfile.mkdtemp(prefix=".write.", dir=ETC_FIREWALLD)
+        failed = [ ]
+        try:
+            # every file gets its own directory, files of different types
+            # might have the same name
+            written = [ ]
+            for (i, name) in enumerate(sorted(pending)):
+                (writer, obj) = pending[name]
+                temp_path = "%s/%d" % (temp_dir, i)
+                temp_name = "%s/%s" % (temp_path, os.path.basename(name))
+                try:
+                    os.mkdir(temp_path)
+                    writer(obj, temp_path)
+                    self._fsync(temp_name)
+                except Exception as msg:
+                    log.error("Failed to write '%s': %s", name, msg)
+                    failed.append(name)
+                else:
+                    written.append((name, temp_name))
+
+            dirs = set()
+            for (name, temp_name) in written:
+                dirpath = os.path.dirname(name)
+                try:
+                    if os.path.exists(name):
+                        shutil.copy2(name, "%s.old" % name)
+                    if not os.path.exists(dirpath):
+                        os.makedirs(dirpath, 0o750)
+                    os.rename(temp_name, name)
+                except Exception as msg:
+                    log.error("Failed to write '%s': %s", name, msg)
+                    failed.append(name)
+                else:
+                    dirs.add(dirpath)
+
+            # make the renames persistent
+            for dirpath in dirs:
+                try:
+                    self._fsync(dirpath)
+                except Exception as msg:
+                    log.debug1("Failed to sync '%s': %s", dirpath, msg)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if len(failed) > 0:
+            raise FirewallError(COMMAND_FAILED, "Failed to write '%s'" % \
+                                "', '".join(failed))
+
     # firewalld_conf
 
     def set_firewalld_conf(self, conf):
@@ -194,11 +344,11 @@ class FirewallConfig(object):
             if obj.path != x.path:
                 x.default = False
             self.add_ipset(x)
-            ipset_writer(x)
+            self._write(ipset_writer, x)
             return x
         else:
             obj.import_config(config)
-            ipset_writer(obj)
+            self._write(ipset_writer, obj)
             return obj
 
     def new_ipset(self, name, config):
@@ -219,7 +369,7 @@ class FirewallConfig(object):
         x.builtin = False
         x.default = True
 
-        ipset_writer(x)
+        self._write(ipset_writer, x)
         self.add_ipset(x)
         return x
 
@@ -227,30 +377,34 @@ class FirewallConfig(object):
         filename = os.path.basename(name)
         path = os.path.dirname(name)
 
+        if self._write_pending(name):
+            # the file will be written again with the current settings
+            return (None, None)
+
         if not os.path.exists(name):
             # removed file
 
             if path == ETC_FIREWALLD_IPSETS:
                 # removed custom ipset
-                for x in self._ipsets.keys():
+                x = self._find_by_filename(self._ipsets, filename)
+                if x is not None:
                     obj = self._ipsets[x]
-                    if obj.filename == filename:
-                        del self._ipsets[x]
-                        if obj.name in self._builtin_ipsets:
-                            return ("update", self._builtin_ipsets[obj.name])
-                        return ("remove", obj)
+                    del self._ipsets[x]
+                    if obj.name in self._builtin_ipsets:
+                        return ("update", self._builtin_ipsets[obj.name])
+                    return ("remove", obj)
             else:
                 # removed builtin ipset
-                for x in self._builtin_ipsets.keys():
+                x = self._find_by_filename(self._builtin_ipsets, filename)
+                if x is not None:
                     obj = self._builtin_ipsets[x]
-                    if obj.filename == filename:
-                        del self._builtin_ipsets[x]
-                        if obj.name not in self._ipsets:
-                            # update dbus ipset
-                            return ("remove", obj)
-                        else:
-                            # builtin hidden, no update needed
-                            return (None, None)
+                    del self._builtin_ipsets[x]
+                    if obj.name not in self._ipsets:
+                        # update dbus ipset
+                        return ("remove", obj)
+                    else:
+                        # builtin hidden, no update needed
+                        return (None, None)
 
             # ipset not known to firewalld, yet (timeout, ..)
             return (None, None)
@@ -259,7 +413,8 @@ class FirewallConfig(object):
 
         log.debug1("Loading ipset file '%s'", name)
         try:
-            obj = ipset_reader(filename, path)
+            obj = self._fw._config_cache.get(ipset_reader,
+                                             filename, path)
         except Exception as msg:
             log.error("Failed to load ipset file '%s': %s", filename, msg)
             return (None, None)
@@ -298,7 +453,7 @@ class FirewallConfig(object):
         if obj.path != ETC_FIREWALLD_IPSETS:
             raise FirewallError(INVALID_DIRECTORY,
                         "'%s' != '%s'" % (obj.path, ETC_FIREWALLD_IPSETS))
-        os.remove("%s/%s.xml" % (obj.path, obj.name))
+        self._remove_file("%s/%s.xml" % (obj.path, obj.name))
         del self._ipsets[obj.name]
 
     def check_builtin_ipset(self, obj):
@@ -325,6 +480,9 @@ class FirewallConfig(object):
         return sorted(set(list(self._icmptypes.keys()) + \
                           list(self._builtin_icmptypes.keys())))
 
+    def query_icmptype(self, name):
+        return name in self._icmptypes or name in self._builtin_icmptypes
+
     def add_icmptype(self, obj):
         if obj.builtin:
             self._builtin_icmptypes[obj.name] = obj
@@ -362,11 +520,11 @@ class FirewallConfig(object):
             if obj.path != x.path:
                 x.default = False
             self.add_icmptype(x)
-            icmptype_writer(x)
+            self._write(icmptype_writer, x)
             return x
         else:
             obj.import_config(config)
-            icmptype_writer(obj)
+            self._write(icmptype_writer, obj)
             return obj
 
     def new_icmptype(self, name, config):
@@ -387,7 +545,7 @@ class FirewallConfig(object):
         x.builtin = False
         x.default = True
 
-        icmptype_writer(x)
+        self._write(icmptype_writer, x)
         self.add_icmptype(x)
         return x
 
@@ -395,30 +553,34 @@ class FirewallConfig(object):
         filename = os.path.basename(name)
         path = os.path.dirname(name)
 
+        if self._write_pending(name):
+            # the file will be written again with the current settings
+            return (None, None)
+
         if not os.path.exists(name):
             # removed file
 
             if path == ETC_FIREWALLD_ICMPTYPES:
                 # removed custom icmptype
-                for x in self._icmptypes.keys():
+                x = self._find_by_filename(self._icmptypes, filename)
+                if x is not None:
                     obj = self._icmptypes[x]
-                    if obj.filename == filename:
-                        del self._icmptypes[x]
-                        if obj.name in self._builtin_icmptypes:
-                            return ("update", self._builtin_icmptypes[obj.name])
-                        return ("remove", obj)
+                    del self._icmptypes[x]
+                    if obj.name in self._builtin_icmptypes:
+                        return ("update", self._builtin_icmptypes[obj.name])
+                    return ("remove", obj)
             else:
                 # removed builtin icmptype
-                for x in self._builtin_icmptypes.keys():
+                x = self._find_by_filename(self._builtin_icmptypes, filename)
+                if x is not None:
                     obj = self._builtin_icmptypes[x]
-                    if obj.filename == filename:
-                        del self._builtin_icmptypes[x]
-                        if obj.name not in self._icmptypes:
-                            # update dbus icmptype
-                            return ("remove", obj)
-                        else:
-                            # builtin hidden, no update needed
-                            return (None, None)
+                    del self._builtin_icmptypes[x]
+                    if obj.name not in self._icmptypes:
+                        # update dbus icmptype
+                        return ("remove", obj)
+                    else:
+                        # builtin hidden, no update needed
+                        return (None, None)
 
             # icmptype not known to firewalld, yet (timeout, ..)
             return (None, None)
@@ -427,7 +589,8 @@ class FirewallConfig(object):
 
         log.debug1("Loading icmptype file '%s'", name)
         try:
-            obj = icmptype_reader(filename, path)
+            obj = self._fw._config_cache.get(icmptype_reader,
+                                             filename, path)
         except Exception as msg:
             log.error("Failed to load icmptype file '%s': %s", filename, msg)
             return (None, None)
@@ -466,7 +629,7 @@ class FirewallConfig(object):
         if obj.path != ETC_FIREWALLD_ICMPTYPES:
             raise FirewallError(INVALID_DIRECTORY,
                         "'%s' != '%s'" % (obj.path, ETC_FIREWALLD_ICMPTYPES))
-        os.remove("%s/%s.xml" % (obj.path, obj.name))
+        self._remove_file("%s/%s.xml" % (obj.path, obj.name))
         del self._icmptypes[obj.name]
 
     def check_builtin_icmptype(self, obj):
@@ -493,6 +656,9 @@ class FirewallConfig(object):
         return sorted(set(list(self._services.keys()) + \
                           list(self._builtin_services.keys())))
 
+    def query_service(self, name):
+        return name in self._services or name in self._builtin_services
+
     def add_service(self, obj):
         if obj.builtin:
             self._builtin_services[obj.name] = obj
@@ -530,11 +696,11 @@ class FirewallConfig(object):
             if obj.path != x.path:
                 x.default = False
             self.add_service(x)
-            service_writer(x)
+            self._write(service_writer, x)
             return x
         else:
             obj.import_config(config)
-            service_writer(obj)
+            self._write(service_writer, obj)
             return obj
 
     def new_service(self, name, config):
@@ -555,7 +721,7 @@ class FirewallConfig(object):
         x.builtin = False
         x.default = True
 
-        service_writer(x)
+        self._write(service_writer, x)
         self.add_service(x)
         return x
 
@@ -563,30 +729,34 @@ class FirewallConfig(object):
         filename = os.path.basename(name)
         path = os.path.dirname(name)
 
+        if self._write_pending(name):
+            # the file will be written again with the current settings
+            return (None, None)
+
         if not os.path.exists(name):
             # removed file
 
             if path == ETC_FIREWALLD_SERVICES:
                 # removed custom service
-                for x in self._services.keys():
+                x = self._find_by_filename(self._services, filename)
+                if x is not None:
                     obj = self._services[x]
-                    if obj.filename == filename:
-                        del self._services[x]
-                        if obj.name in self._builtin_services:
-                            return ("update", self._builtin_services[obj.name])
-                        return ("remove", obj)
+                    del self._services[x]
+                    if obj.name in self._builtin_services:
+                        return ("update", self._builtin_services[obj.name])
+                    return ("remove", obj)
             else:
                 # removed builtin service
-                for x in self._builtin_services.keys():
+                x = self._find_by_filename(self._builtin_services, filename)
+                if x is not None:
                     obj = self._builtin_services[x]
-                    if obj.filename == filename:
-                        del self._builtin_services[x]
-                        if obj.name not in self._services:
-                            # update dbus service
-                            return ("remove", obj)
-                        else:
-                            # builtin hidden, no update needed
-                            return (None, None)
+                    del self._builtin_services[x]
+                    if obj.name not in self._services:
+                        # update dbus service
+                        return ("remove", obj)
+                    else:
+                        # builtin hidden, no update needed
+                        return (None, None)
 
             # service not known to firewalld, yet (timeout, ..)
             return (None, None)
@@ -595,7 +765,8 @@ class FirewallConfig(object):
 
         log.debug1("Loading service file '%s'", name)
         try:
-            obj = service_reader(filename, path)
+            obj = self._fw._config_cache.get(service_reader,
+                                             filename, path)
         except Exception as msg:
             log.error("Failed to load service file '%s': %s", filename, msg)
             return (None, None)
@@ -634,7 +805,7 @@ class FirewallConfig(object):
         if obj.path != ETC_FIREWALLD_SERVICES:
             raise FirewallError(INVALID_DIRECTORY,
                         "'%s' != '%s'" % (obj.path, ETC_FIREWALLD_SERVICES))
-        os.remove("%s/%s.xml" % (obj.path, obj.name))
+        self._remove_file("%s/%s.xml" % (obj.path, obj.name))
         del self._services[obj.name]
 
     def check_builtin_service(self, obj):
@@ -705,12 +876,12 @@ class FirewallConfig(object):
             if obj.path != x.path:
                 x.default = False
             self.add_zone(x)
-            zone_writer(x)
+            self._write(zone_writer, x)
             return x
         else:
             obj.fw_config = self
             obj.import_config(config)
-            zone_writer(obj)
+            self._write(zone_writer, obj)
             return obj
 
     def new_zone(self, name, config):
@@ -732,7 +903,7 @@ class FirewallConfig(object):
         x.builtin = False
         x.default = True
 
-        zone_writer(x)
+        self._write(zone_writer, x)
         self.add_zone(x)
         return x
 
@@ -740,30 +911,34 @@ class FirewallConfig(object):
         filename = os.path.basename(name)
         path = os.path.dirname(name)
 
+        if self._write_pending(name):
+            # the file will be written again with the current settings
+            return (None, None)
+
         if not os.path.exists(name):
             # removed file
 
             if path == ETC_FIREWALLD_ZONES:
                 # removed custom zone
-                for x in self._zones.keys():
+                x = self._find_by_filename(self._zones, filename)
+                if x is not None:
                     obj = self._zones[x]
-                    if obj.filename == filename:
-                        del self._zones[x]
-                        if obj.name in self._builtin_zones:
-                            return ("update", self._builtin_zones[obj.name])
-                        return ("remove", obj)
+                    del self._zones[x]
+                    if obj.name in self._builtin_zones:
+                        return ("update", self._builtin_zones[obj.name])
+                    return ("remove", obj)
             else:
                 # removed builtin zone
-                for x in self._builtin_zones.keys():
+                x = self._find_by_filename(self._builtin_zones, filename)
+                if x is not None:
                     obj = self._builtin_zones[x]
-                    if obj.filename == filename:
-                        del self._builtin_zones[x]
-                        if obj.name not in self._zones:
-                            # update dbus zone
-                            return ("remove", obj)
-                        else:
-                            # builtin hidden, no update needed
-                            return (None, None)
+                    del self._builtin_zones[x]
+                    if obj.name not in self._zones:
+                        # update dbus zone
+                        return ("remove", obj)
+                    else:
+                        # builtin hidden, no update needed
+                        return (None, None)
 
             # zone not known to firewalld, yet (timeout, ..)
             return (None, None)
@@ -772,7 +947,8 @@ class FirewallConfig(object):
 
         log.debug1("Loading zone file '%s'", name)
         try:
-            obj = zone_reader(filename, path)
+            obj = self._fw._config_cache.get(zone_reader,
+                                             filename, path)
         except Exception as msg:
             log.error("Failed to load zone file '%s': %s", filename, msg)
             return (None, None)
@@ -813,7 +989,7 @@ class FirewallConfig(object):
         if not obj.path.startswith(ETC_FIREWALLD_ZONES):
             raise FirewallError(INVALID_DIRECTORY,
                 "'%s' doesn't start with '%s'" % (obj.path, ETC_FIREWALLD_ZONES))
-        os.remove("%s/%s.xml" % (ETC_FIREWALLD_ZONES, obj.name))
+        self._remove_file("%s/%s.xml" % (ETC_FIREWALLD_ZONES, obj.name))
         del self._zones[obj.name]
 
     def check_builtin_zone(self, obj):
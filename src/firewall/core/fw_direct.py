@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 import os.path
 from firewall.config import *
 from firewall import functions
@@ -41,18 +42,35 @@ class FirewallDirect(object):
 
     def __repr__(self):
         return '%s(%r, %r, %r)' % (self.__class__, self._chains, self._rules,
-                                   self._rule_priority_positions)
+                                   self._passthroughs)
 
     def __init_vars(self):
         self._chains = LastUpdatedOrderedDict()
+        # chain_id: PriorityOrderedDict of (priority, args) in the order of
+        # the rules in the chain
         self._rules = LastUpdatedOrderedDict()
-        self._rule_priority_positions = { }
         self._passthroughs = LastUpdatedOrderedDict()
         self._obj = None
 
     def cleanup(self):
         self.__init_vars()
 
+    def snapshot(self, fw):
+        # copy for read only queries of the snapshot fw, the chains, rules
+        # and passthroughs are copied as they are changed in place
+        obj = copy.copy(self)
+        obj._fw = fw
+        obj._chains = LastUpdatedOrderedDict()
+        for (table_id, chains) in self._chains.items():
+            obj._chains[table_id] = chains[:]
+        obj._rules = LastUpdatedOrderedDict()
+        for (chain_id, rules) in self._rules.items():
+            obj._rules[chain_id] = rules.copy()
+        obj._passthroughs = LastUpdatedOrderedDict()
+        for (ipv, passthroughs) in self._passthroughs.items():
+            obj._passthroughs[ipv] = passthroughs[:]
+        return obj
+
     def set_permanent_config(self, obj):
         # Apply permanent configuration and save the obj to be able to
         # remove permanent configuration settings within get_runtime_config
@@ -98,6 +116,141 @@ class FirewallDirect(object):
 
     def set_config(self, config):
         (_chains, _rules, _passthroughs) = config
+        if self._fw._individual_calls:
+            self.__set_config(_chains, _rules, _passthroughs)
+            return
+
+        # Split the config by ipv and table, every part is applied with one
+        # restore call. ebtables and invalid tables are handled individually
+        # and report their errors like before.
+        individual = ({ }, { }, { })
+        batches = LastUpdatedOrderedDict()
+        def _batch(ipv, table):
+            if ipv not in [ "ipv4", "ipv6" ]:
+                return individual
+            try:
+                self._check_ipv_table(ipv, table)
+            except FirewallError:
+                return individual
+            if (ipv, table) not in batches:
+                batches[(ipv, table)] = ({ }, { }, { })
+            return batches[(ipv, table)]
+
+        for table_id in _chains:
+            (ipv, table) = table_id
+            _batch(ipv, table)[0][table_id] = _chains[table_id]
+        for chain_id in _rules:
+            (ipv, table, chain) = chain_id
+            _batch(ipv, table)[1][chain_id] = _rules[chain_id]
+        for ipv in _passthroughs:
+            for args in _passthroughs[ipv]:
+                table = self.__restore_table(ipv, args)
+                if table is None:
+                    batch = individual
+                else:
+                    batch = _batch(ipv, table)
+                batch[2].setdefault(ipv, [ ]).append(args)
+
+        for (ipv, table) in batches:
+            (chains, rules, passthroughs) = batches[(ipv, table)]
+            try:
+                self.__apply_batch(ipv, table, chains, rules, passthroughs)
+            except Exception as msg:
+                # nothing of the batch has been applied, try one by one
+                log.warning("Failed to apply direct configuration for "
+                            "'%s:%s' in one call, applying it one by one: %s",
+                            ipv, table, msg)
+                self.__set_config(chains, rules, passthroughs)
+        self.__set_config(*individual)
+
+    def __apply_batch(self, ipv, table, chains, rules, passthroughs):
+        # The final positions of the rules are computed up front from the
+        # priorities, the config is then applied with one restore call and
+        # recorded afterwards.
+        lines = [ ]
+        new_chains = [ ]
+        new_passthroughs = [ ]
+        new_rules = { }
+        seen = set()
+
+        for table_id in chains:
+            for chain in chains[table_id]:
+                try:
+                    if self.query_chain(ipv, table, chain):
+                        continue
+                except FirewallError as error:
+                    log.warning(str(error))
+                    continue
+                if chain in new_chains:
+                    continue
+                lines.append([ "-t", table, "-N", chain ])
+                new_chains.append(chain)
+
+        for chain_id in rules:
+            chain = chain_id[2]
+            _chain = self.__direct_chain(ipv, table, chain)
+            self._fw.zone.create_zone_base_by_chain(ipv, table, chain)
+            if chain_id not in new_rules:
+                if chain_id in self._rules:
+                    new_rules[chain_id] = self._rules[chain_id].copy()
+                else:
+                    new_rules[chain_id] = PriorityOrderedDict()
+            for (priority, args) in rules[chain_id]:
+                rule_id = (priority, args)
+                if (chain_id, rule_id) in seen or \
+                   self.query_rule(ipv, table, chain, priority, args):
+                    continue
+                seen.add((chain_id, rule_id))
+                index = new_rules[chain_id].position(priority) + 1
+                lines.append([ "-t", table, "-I", _chain, str(index) ] + \
+                             self.__quote(args))
+                new_rules[chain_id][rule_id] = priority
+
+        for _ipv in passthroughs:
+            for args in passthroughs[_ipv]:
+                args = list(args)
+                if tuple(args) in seen or self.query_passthrough(ipv, args):
+                    continue
+                seen.add(tuple(args))
+                try:
+                    self.check_passthrough(args)
+                except FirewallError as error:
+                    log.warning(str(error))
+                    continue
+                self.__passthrough_zone_base(ipv, args)
+                lines.append(self.__restore_args(table, args))
+                new_passthroughs.append(args)
+
+        if len(lines) < 1:
+            return
+        log.debug1("Applying %d direct chains, rules and passthroughs for "
+                   "'%s:%s'", len(lines), ipv, table)
+        self._fw.rules(ipv, lines)
+
+        table_id = (ipv, table)
+        for chain in new_chains:
+            self._chains.setdefault(table_id, [ ]).append(chain)
+        for chain_id in new_rules:
+            if len(new_rules[chain_id]) > 0:
+                self._rules[chain_id] = new_rules[chain_id]
+        for args in new_passthroughs:
+            self._passthroughs.setdefault(ipv, [ ]).append(args)
+
+    def __quote(self, args):
+        # Quote arguments for the restore input, that would be split or
+        # changed by the restore parser otherwise. Within quotes, the parser
+        # takes the character after a backslash as is. A newline would end
+        # the restore line, these arguments need an individual call.
+        ret = [ ]
+        for x in args:
+            if "\n" in x:
+                raise ValueError("Argument '%s' contains a newline" % x)
+            if x == "" or any(c in x for c in ' \t"\\\''):
+                x = '"%s"' % x.replace("\\", "\\\\").replace('"', '\\"')
+            ret.append(x)
+        return ret
+
+    def __set_config(self, _chains, _rules, _passthroughs):
         for table_id in _chains:
             (ipv, table) = table_id
             for chain in _chains[table_id]:
@@ -233,15 +386,7 @@ class FirewallDirect(object):
         if ipv in [ "ipv4", "ipv6" ]:
             self._fw.zone.create_zone_base_by_chain(ipv, table, chain)
 
-        _chain = chain
-
-        if ipv in [ "ipv4", "ipv6" ]:
-            _CHAINS = ipXtables.BUILT_IN_CHAINS
-        else:
-            _CHAINS = ebtables.BUILT_IN_CHAINS
-
-        if table in _CHAINS and chain in _CHAINS[table]:
-            _chain = "%s_direct" % (chain)
+        _chain = self.__direct_chain(ipv, table, chain)
 
         chain_id = (ipv, table, chain)
         rule_id = (priority, args)
@@ -262,13 +407,9 @@ class FirewallDirect(object):
             # get priority of rule
             priority = self._rules[chain_id][rule_id]
 
-        # If a rule gets added, the initial rule index position within the 
-        # ipv, table and chain combination (chain_id) is 1.
-        # Tf the chain_id exists in _rule_priority_positions, there are already
-        # other rules for this chain_id. The number of rules for a priority
-        # less or equal to the priority of the new rule will increase the 
-        # index of the new rule. The index is the ip*tables -I insert rule
-        # number.
+        # The index is the ip*tables -I insert rule number: a new rule is
+        # added after all rules with a lower or the same priority in the
+        # chain.
         #
         # Example: We have the following rules for chain_id (ipv4, filter,
         # INPUT) already:
@@ -276,37 +417,15 @@ class FirewallDirect(object):
         #   ipv4, filter, INPUT, 2, -i, foo2, -j, ACCEPT
         #   ipv4, filter, INPUT, 2, -i, foo2_1, -j, ACCEPT
         #   ipv4, filter, INPUT, 3, -i, foo3, -j, ACCEPT
-        # This results in the following _rule_priority_positions structure:
-        #   _rule_priority_positions[(ipv4,filter,INPUT)][1] = 1
-        #   _rule_priority_positions[(ipv4,filter,INPUT)][2] = 2
-        #   _rule_priority_positions[(ipv4,filter,INPUT)][3] = 1
         # The new rule
         #   ipv4, filter, INPUT, 2, -i, foo2_2, -j, ACCEPT
-        # has the same pritority as the second rule before and will be added
-        # right after it. 
-        # The initial index is 1 and the chain_id is already in
-        # _rule_priority_positions. Therefore the index will increase for
-        # the number of rules in every rule position in 
-        # _rule_priority_positions[(ipv4,filter,INPUT)].keys()
-        # where position is smaller or equal to the entry in keys.
-        # With the example from above:
-        # The priority of the new rule is 2. Therefore for all keys in 
-        # _rule_priority_positions[chain_id] where priority is 1 or 2, the 
-        # number of the rules will increase the index of the rule.
-        # For _rule_priority_positions[chain_id][1]: index += 1
-        # _rule_priority_positions[chain_id][2]: index += 2
-        # index will be 4 in the end and the rule in the table chain 
-        # combination will be added at index 4.
-        # If there are no rules in the table chain combination, a new rule 
-        # has index 1.
+        # has the same priority as the second and third rule and will be
+        # added right after them with index 4. The number of rules up to a
+        # priority is looked up in the PriorityOrderedDict of the chain.
 
         index = 1
-        if chain_id in self._rule_priority_positions:
-            positions = sorted(self._rule_priority_positions[chain_id].keys())
-            j = 0
-            while j < len(positions) and priority >= positions[j]:
-                index += self._rule_priority_positions[chain_id][positions[j]]
-                j += 1
+        if chain_id in self._rules:
+            index += self._rules[chain_id].position(priority)
 
         rule = [ "-t", table ]
         if enable:
@@ -323,20 +442,23 @@ class FirewallDirect(object):
 
         if enable:
             if chain_id not in self._rules:
-                self._rules[chain_id] = LastUpdatedOrderedDict()
+                self._rules[chain_id] = PriorityOrderedDict()
             self._rules[chain_id][rule_id] = priority
-            if chain_id not in self._rule_priority_positions:
-                self._rule_priority_positions[chain_id] = { }
-
-            if priority in self._rule_priority_positions[chain_id]:
-                self._rule_priority_positions[chain_id][priority] += 1
-            else:
-                self._rule_priority_positions[chain_id][priority] = 1
         else:
             del self._rules[chain_id][rule_id]
             if len(self._rules[chain_id]) == 0:
                 del self._rules[chain_id]
-            self._rule_priority_positions[chain_id][priority] -= 1
+
+    def __direct_chain(self, ipv, table, chain):
+        # rules for built-in chains are going into the _direct chains
+        if ipv in [ "ipv4", "ipv6" ]:
+            _CHAINS = ipXtables.BUILT_IN_CHAINS
+        else:
+            _CHAINS = ebtables.BUILT_IN_CHAINS
+
+        if table in _CHAINS and chain in _CHAINS[table]:
+            return "%s_direct" % (chain)
+        return chain
 
     def add_rule(self, ipv, table, chain, priority, args):
         self.__rule(True, ipv, table, chain, priority, args)
@@ -351,6 +473,7 @@ class FirewallDirect(object):
                 (priority, args) in self._rules[chain_id])
 
     def get_rules(self, ipv, table, chain):
+        # the rules in the order they are in the chain
         self._check_ipv_table(ipv, table)
         chain_id = (ipv, table, chain)
         if chain_id in self._rules:
@@ -374,6 +497,101 @@ class FirewallDirect(object):
             log.debug2(msg)
             raise FirewallError(COMMAND_FAILED, msg)
 
+    def passthroughs(self, ipv, args_list):
+        """ Pass several commands through to the firewall. Runs of commands,
+            that can be expressed in restore syntax, are applied with one
+            restore call per table. Returns a list of (True, output) or
+            (False, error message) for the commands. The output of commands
+            applied with a restore call is empty.
+        """
+        return self.__passthroughs(ipv, [ list(args) for args in args_list ])
+
+    def __restore_table(self, ipv, args):
+        # return the table of a passthrough, that can be applied with
+        # ip*tables-restore, or None
+        if self._fw._individual_calls or ipv not in [ "ipv4", "ipv6" ]:
+            return None
+        table = "filter"
+        commands = 0
+        if any("\n" in x for x in args):
+            return None
+        i = 0
+        while i < len(args):
+            if args[i] in [ "-t", "--table" ]:
+                if i + 1 >= len(args):
+                    return None
+                table = args[i+1]
+                i += 1
+            elif args[i] in [ "-A", "--append", "-I", "--insert",
+                              "-D", "--delete", "-N", "--new-chain",
+                              "-X", "--delete-chain" ]:
+                commands += 1
+            elif args[i] in [ "-C", "--check", "-R", "--replace",
+                              "-L", "--list", "-S", "--list-rules",
+                              "-F", "--flush", "-Z", "--zero",
+                              "-P", "--policy", "-E", "--rename-chain",
+                              "-w", "--wait", "-W", "--wait-interval",
+                              "-v", "--verbose", "-n", "--numeric",
+                              "-x", "--exact", "--line-numbers",
+                              "--modprobe", "-h", "--help" ]:
+                # commands and options, that have an output or are not
+                # valid in restore syntax
+                return None
+            i += 1
+        if commands != 1 or not self._fw.is_table_available(ipv, table):
+            return None
+        return table
+
+    def __restore_args(self, table, args):
+        # the passthrough in restore syntax with the table option in front
+        args = list(args)
+        while "-t" in args or "--table" in args:
+            j = args.index("-t") if "-t" in args else args.index("--table")
+            del args[j:j+2]
+        return [ "-t", table ] + self.__quote(args)
+
+    def __passthroughs(self, ipv, args_list):
+        results = [ None ] * len(args_list)
+        batch = LastUpdatedOrderedDict()
+
+        def _run(i):
+            try:
+                results[i] = (True, self._fw.rule(ipv, list(args_list[i])))
+            except Exception as msg:
+                log.debug2(msg)
+                results[i] = (False, str(FirewallError(COMMAND_FAILED, msg)))
+
+        def _flush():
+            for table in batch.keys():
+                lines = [ ]
+                for i in batch[table]:
+                    lines.append(self.__restore_args(table, args_list[i]))
+                try:
+                    self._fw.rules(ipv, lines)
+                except Exception as msg:
+                    # nothing has been applied, get the results one by one
+                    log.warning("Failed to apply passthroughs for '%s:%s' "
+                                "in one call, applying them one by one: %s",
+                                ipv, table, msg)
+                    for i in batch[table]:
+                        _run(i)
+                else:
+                    for i in batch[table]:
+                        results[i] = (True, "")
+            batch.clear()
+
+        # keep the order of the commands: a command, that can not be
+        # batched, is run after the batched commands before it
+        for (i, args) in enumerate(args_list):
+            table = self.__restore_table(ipv, args)
+            if table is not None:
+                batch.setdefault(table, [ ]).append(i)
+            else:
+                _flush()
+                _run(i)
+        _flush()
+        return results
+
     # DIRECT PASSTHROUGH (tracked)
 
     def __passthrough(self, enable, ipv, args):
@@ -392,29 +610,7 @@ class FirewallDirect(object):
 
         if enable:
             self.check_passthrough(args)
-            # try to find out if a zone chain should be used
-            if ipv in [ "ipv4", "ipv6" ]:
-                table = "filter"
-                try:
-                    i = args.index("-t")
-                except:
-                    pass
-                else:
-                    if len(args) >= i+1:
-                        table = args[i+1]
-                chain = None
-                for opt in [ "-A", "--append",
-                             "-I", "--insert",
-                             "-N", "--new-chain" ]:
-                    try:
-                        i = args.index(opt)
-                    except:
-                        pass
-                    else:
-                        if len(args) >= i+1:
-                            chain = args[i+1]
-                if table and chain:
-                    self._fw.zone.create_zone_base_by_chain(ipv, table, chain)
+            self.__passthrough_zone_base(ipv, args)
             _args = args
         else:
             _args = self.reverse_passthrough(args)
@@ -434,9 +630,67 @@ class FirewallDirect(object):
             if len(self._passthroughs[ipv]) == 0:
                 del self._passthroughs[ipv]
 
+    def __passthrough_zone_base(self, ipv, args):
+        # try to find out if a zone chain should be used
+        if ipv in [ "ipv4", "ipv6" ]:
+            table = "filter"
+            try:
+                i = args.index("-t")
+            except:
+                pass
+            else:
+                if len(args) >= i+1:
+                    table = args[i+1]
+            chain = None
+            for opt in [ "-A", "--append",
+                         "-I", "--insert",
+                         "-N", "--new-chain" ]:
+                try:
+                    i = args.index(opt)
+                except:
+                    pass
+                else:
+                    if len(args) >= i+1:
+                        chain = args[i+1]
+            if table and chain:
+                self._fw.zone.create_zone_base_by_chain(ipv, table, chain)
+
     def add_passthrough(self, ipv, args):
         self.__passthrough(True, ipv, list(args))
 
+    def add_passthroughs(self, ipv, args_list):
+        """ Add several tracked passthroughs, see passthroughs. Returns a
+            list of (True, "") or (False, error message) for the
+            passthroughs.
+        """
+        self._check_ipv(ipv)
+
+        results = [ None ] * len(args_list)
+        todo = [ ]
+        seen = set()
+        for (i, args) in enumerate(args_list):
+            args = list(args)
+            try:
+                if tuple(args) in seen or self.query_passthrough(ipv, args):
+                    raise FirewallError(ALREADY_ENABLED,
+                                        "passthrough '%s', '%s'" % (ipv, args))
+                self.check_passthrough(args)
+                self.__passthrough_zone_base(ipv, args)
+            except FirewallError as error:
+                results[i] = (False, str(error))
+            else:
+                seen.add(tuple(args))
+                todo.append((i, args))
+
+        _results = self.__passthroughs(ipv, [ args for (i, args) in todo ])
+        for ((i, args), (ok, msg)) in zip(todo, _results):
+            if ok:
+                self._passthroughs.setdefault(ipv, [ ]).append(args)
+                results[i] = (True, "")
+            else:
+                results[i] = (False, msg)
+        return results
+
     def remove_passthrough(self, ipv, args):
         self.__passthrough(False, ipv, list(args))
 
@@ -32,6 +32,12 @@ class FirewallIcmpType(object):
     def cleanup(self):
         self._icmptypes.clear()
 
+    def snapshot(self, fw):
+        # copy for read only queries of the snapshot fw
+        obj = FirewallIcmpType(fw)
+        obj._icmptypes = self._icmptypes.copy()
+        return obj
+
     # zones
 
     def get_icmptypes(self):
@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 
 from firewall.core.base import *
 from firewall.core.logger import log
@@ -26,12 +27,15 @@ from firewall.functions import portStr, checkIPnMask, checkIP6nMask, \
     checkProtocol, enable_ip_forwarding, check_single_address
 from firewall.errors import *
 from firewall.core import ipset
-from firewall.core.io.ipset import IPSet
+from firewall.core.io.ipset import IPSet, ipset_entries_file_reader
 
 class FirewallIPSet(object):
     def __init__(self, fw):
         self._fw = fw
         self._ipsets = { }
+        # ipsets with entries file kept in the kernel over a reload:
+        # name: (type, options)
+        self._kept = { }
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__, self._ipsets)
@@ -42,10 +46,18 @@ class FirewallIPSet(object):
 
         self._ipsets.clear()
 
+    def snapshot(self, fw):
+        # copy for read only queries of the snapshot fw, the applied state
+        # of the ipset objects is changed in place
+        obj = FirewallIPSet(fw)
+        obj._ipsets = dict((name, copy.copy(x))
+                           for (name, x) in self._ipsets.items())
+        return obj
+
     # ipsets
 
     def check_ipset(self, ipset):
-        if ipset not in self.get_ipsets():
+        if ipset not in self._ipsets:
             raise FirewallError(INVALID_IPSET, ipset)
 
     def get_ipsets(self):
@@ -76,11 +88,31 @@ class FirewallIPSet(object):
                 log.error(msg)
         del self._ipsets[name]
 
+    def keep_ipsets(self):
+        """ Keep the applied ipsets with entries files in the kernel for the
+            next apply_ipsets, that is only applying the changes then.
+        """
+        for obj in self._ipsets.values():
+            if obj.applied and obj.entries_file:
+                self._kept[obj.name] = (obj.type, obj.options.copy())
+                obj.applied = False
+
     def apply_ipsets(self, individual=False):
+        kept = self._kept
+        self._kept = { }
+        if individual:
+            # kept ipsets are created again
+            self._destroy_ipsets(kept)
+            kept = { }
+
         for ipset in self.get_ipsets():
             obj = self._ipsets[ipset]
             obj.applied = False
 
+            if obj.entries_file and not individual:
+                self._apply_entries_file(obj, kept.pop(obj.name, None))
+                continue
+
             if individual:
                 try:
                     self._fw._ipset.create(obj.name, obj.type, obj.options)
@@ -93,7 +125,7 @@ class FirewallIPSet(object):
                         # no entries visible for ipsets with timeout
                         continue
 
-                for entry in obj.entries:
+                for entry in self._ipset_entries(obj):
                     try:
                         self._fw._ipset.add(obj.name, entry)
                     except Exception as msg:
@@ -110,6 +142,99 @@ class FirewallIPSet(object):
                 else:
                     obj.applied = True
 
+        # kept ipsets, that are not used anymore
+        self._destroy_ipsets(kept)
+
+    def _destroy_ipsets(self, names):
+        for name in names:
+            try:
+                self._fw._ipset.destroy(name)
+            except Exception as msg:
+                log.error("Failed to destroy ipset '%s'" % name)
+                log.error(msg)
+
+    def _ipset_entries(self, obj):
+        # the entries of the ipset and of the entries file, every entry
+        # only once
+        seen = set()
+        for entry in obj.entries:
+            if entry not in seen:
+                seen.add(entry)
+                yield entry
+        name = obj.get_entries_file()
+        if name is None:
+            return
+        if "timeout" in obj.options:
+            # no entries visible for ipsets with timeout
+            log.warning("%s: timeout option is set, entries file '%s' is "
+                        "ignored", obj.name, name)
+            return
+        _check = IPSet.entry_checker(obj.options, obj.type)
+        for entry in ipset_entries_file_reader(name):
+            if entry in seen:
+                continue
+            try:
+                _check(entry)
+            except FirewallError as e:
+                log.warning("%s: %s, ignoring.", name, e)
+            else:
+                seen.add(entry)
+                yield entry
+
+    def _apply_entries_file(self, obj, kept):
+        # the set in the kernel is kept over a reload and only updated with
+        # the changes of the entries, it is created if that is not possible
+        if kept is not None and kept == (obj.type, obj.options) and \
+           "timeout" not in obj.options:
+            family = self.get_family(obj.name)
+            try:
+                entries = { }
+                for entry in self._ipset_entries(obj):
+                    key = ipset.normalize_entry(entry, obj.type, family)
+                    if key is None:
+                        # no diff possible
+                        break
+                    entries[key] = entry
+                else:
+                    current = set(self._fw._ipset.get_entries(obj.name))
+                    added = [ entries[x] for x in entries
+                              if x not in current ]
+                    removed = [ x for x in current if x not in entries ]
+                    log.debug1("Updating ipset '%s': %d added, %d removed",
+                               obj.name, len(added), len(removed))
+                    if added or removed:
+                        self._fw._ipset.update(obj.name, added, removed)
+                    obj.applied = True
+                    return
+            except Exception as msg:
+                log.error("Failed to update ipset '%s'" % obj.name)
+                log.error(msg)
+                if isinstance(msg, (IOError, OSError)):
+                    # the entries file is not readable, keep the set as is
+                    obj.applied = True
+                    return
+
+        if kept is not None:
+            self._destroy_ipsets([ obj.name ])
+        try:
+            self._fw._ipset.restore(obj.name, obj.type,
+                                    self._ipset_entries(obj),
+                                    obj.options, None)
+        except Exception as msg:
+            log.error("Failed to create ipset '%s'" % obj.name)
+            log.error(msg)
+            # the set has been created if the entries file failed, the
+            # rules using it are working, but entries might be missing
+            try:
+                obj.applied = obj.name in self._fw._ipset.names()
+            except Exception:
+                pass
+            if obj.applied:
+                log.warning("ipset '%s' is incomplete, entries might be "
+                            "missing", obj.name)
+        else:
+            obj.applied = True
+
     # TYPE
 
     def get_type(self, ipset):
@@ -152,6 +277,7 @@ class FirewallIPSet(object):
         else:
             if "timeout" not in obj.options:
                 # no entries visible for ipsets with timeout
+                obj.unshare("entries")
                 obj.entries.append(entry)
 
     def remove_entry(self, ipset, entry, sender=None):
@@ -173,6 +299,7 @@ class FirewallIPSet(object):
         else:
             if "timeout" not in obj.options:
                 # no entries visible for ipsets with timeout
+                obj.unshare("entries")
                 obj.entries.remove(entry)
 
     def query_entry(self, ipset, entry, sender=None):
@@ -197,24 +324,31 @@ class FirewallIPSet(object):
             # no entries visible for ipsets with timeout
             raise FirewallError(IPSET_WITH_TIMEOUT, ipset)
 
+        check = IPSet.entry_checker(obj.options, obj.type)
+        _entries = [ ]
+        seen = set()
         for entry in entries:
-            IPSet.check_entry(entry, obj.options, obj.type)
-
-        for entry in obj.entries:
-            try:
-                self._fw._ipset.remove(obj.name, entry)
-            except Exception as msg:
-                log.error("Failed to remove entry '%s' from ipset '%s'" % \
-                          (entry, obj.name))
-                log.error(msg)
-        obj.entries.clear()
+            check(entry)
+            if entry not in seen:
+                seen.add(entry)
+                _entries.append(entry)
 
-        for entry in entries:
+        # replace the entries with one restore call instead of a call for
+        # every removed and added entry
+        try:
+            self._fw._ipset.flush(obj.name)
+            self._fw._ipset.restore(obj.name, obj.type, _entries,
+                                    obj.options, None)
+        except Exception as msg:
+            log.error("Failed to set entries of ipset '%s'" % obj.name)
+            # restore the previous entries
             try:
-                self._fw._ipset.add(obj.name, entry)
-            except Exception as msg:
-                log.error("Failed to remove entry '%s' from ipset '%s'" % \
-                          (entry, obj.name))
-                log.error(msg)
-            else:
-                obj.entries.append(entry)
+                self._fw._ipset.flush(obj.name)
+                self._fw._ipset.restore(obj.name, obj.type, obj.entries,
+                                        obj.options, None)
+            except Exception as e:
+                log.error("Failed to restore entries of ipset '%s': %s",
+                          obj.name, e)
+            raise FirewallError(COMMAND_FAILED, msg)
+        obj.unshare("entries")
+        obj.entries[:] = _entries
@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 import time
 from firewall.config import LOCKDOWN_WHITELIST
 from firewall.core.base import *
@@ -35,12 +36,40 @@ class FirewallPolicies(object):
         return '%s(%r, %r)' % (self.__class__, self._lockdown,
                                            self.lockdown_whitelist)
 
+    def __copy__(self):
+        # the lockdown whitelist is copy-on-write
+        obj = FirewallPolicies()
+        obj._lockdown = self._lockdown
+        obj.lockdown_whitelist = copy.copy(self.lockdown_whitelist)
+        return obj
+
+    def snapshot(self):
+        # copy for read only queries of a snapshot, the whitelist is not
+        # shared
+        obj = copy.copy(self)
+        obj.lockdown_whitelist.unshare()
+        return obj
+
     def cleanup(self):
         self._lockdown = False
         self.lockdown_whitelist.cleanup()
 
     # lockdown
 
+    def access_check_keys(self):
+        """ Return the keys for access_check, that have entries in the
+            whitelist, in the order the checks should be done.
+        """
+        keys = [ ]
+        for (key, entries) in [ ("context", self.lockdown_whitelist.contexts),
+                                ("uid", self.lockdown_whitelist.uids),
+                                ("user", self.lockdown_whitelist.users),
+                                ("command",
+                                 self.lockdown_whitelist.commands) ]:
+            if len(entries) > 0:
+                keys.append(key)
+        return keys
+
     def access_check(self, key, value):
         if key == "context":
             log.debug2('Doing access check for context "%s"' % value)
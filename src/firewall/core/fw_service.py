@@ -32,6 +32,12 @@ class FirewallService(object):
     def cleanup(self):
         self._services.clear()
 
+    def snapshot(self, fw):
+        # copy for read only queries of the snapshot fw
+        obj = FirewallService(fw)
+        obj._services = self._services.copy()
+        return obj
+
     # zones
 
     def get_services(self):
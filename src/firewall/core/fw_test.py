@@ -131,7 +131,7 @@ class Firewall_test(object):
             else:
                 log.debug1("IPV6 rpfilter is disabled")
 
-        self.config.set_firewalld_conf(copy.deepcopy(self._firewalld_conf))
+        self.config.set_firewalld_conf(copy.copy(self._firewalld_conf))
 
         # load lockdown whitelist
         log.debug1("Loading lockdown whitelist")
@@ -142,7 +142,7 @@ class Firewall_test(object):
                       self.policies.lockdown_whitelist.filename, msg)
 
         # copy policies to config interface
-        self.config.set_policies(copy.deepcopy(self.policies))
+        self.config.set_policies(copy.copy(self.policies))
 
         # load ipset files
         self._loader(FIREWALLD_IPSETS, "ipset")
@@ -188,7 +188,7 @@ class Firewall_test(object):
             except Exception as msg:
                 log.debug1("Failed to load direct rules file '%s': %s",
                            FIREWALLD_DIRECT, msg)
-        self.config.set_direct(copy.deepcopy(obj))
+        self.config.set_direct(copy.copy(obj))
 
         # check if default_zone is a valid zone
         if default_zone not in self.zone.get_zones():
@@ -245,8 +245,8 @@ class Firewall_test(object):
                                    orig_obj.filename)
                         self.icmptype.remove_icmptype(orig_obj.name)
                     self.icmptype.add_icmptype(obj)
-                    # add a deep copy to the configuration interface
-                    self.config.add_icmptype(copy.deepcopy(obj))
+                    # add a copy-on-write copy to the configuration interface
+                    self.config.add_icmptype(copy.copy(obj))
                 elif reader_type == "service":
                     obj = service_reader(filename, path)
                     if obj.name in self.service.get_services():
@@ -256,8 +256,8 @@ class Firewall_test(object):
                                    orig_obj.filename)
                         self.service.remove_service(orig_obj.name)
                     self.service.add_service(obj)
-                    # add a deep copy to the configuration interface
-                    self.config.add_service(copy.deepcopy(obj))
+                    # add a copy-on-write copy to the configuration interface
+                    self.config.add_service(copy.copy(obj))
                 elif reader_type == "zone":
                     obj = zone_reader(filename, path)
                     if combine:
@@ -267,7 +267,7 @@ class Firewall_test(object):
                             os.path.basename(filename)[0:-4])
                         obj.check_name(obj.name)
                     # Copy object before combine
-                    config_obj = copy.deepcopy(obj)
+                    config_obj = copy.copy(obj)
                     if obj.name in self.zone.get_zones():
                         orig_obj = self.zone.get_zone(obj.name)
                         self.zone.remove_zone(orig_obj.name)
@@ -298,8 +298,8 @@ class Firewall_test(object):
                                    orig_obj.filename)
                         self.ipset.remove_ipset(orig_obj.name)
                     self.ipset.add_ipset(obj)
-                    # add a deep copy to the configuration interface
-                    self.config.add_ipset(copy.deepcopy(obj))
+                    # add a copy-on-write copy to the configuration interface
+                    self.config.add_ipset(copy.copy(obj))
                 else:
                     log.fatal("Unknown reader type %s", reader_type)
             except FirewallError as msg:
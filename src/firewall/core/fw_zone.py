@@ -19,6 +19,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
+import math
 import time
 from firewall.core.base import *
 from firewall.core.logger import log
@@ -27,6 +29,7 @@ from firewall.functions import portStr, checkIPnMask, checkIP6nMask, \
     checkIP, checkIP6
 from firewall.core.rich import *
 from firewall.errors import *
+from firewall.core.ipset import IPSET_RESERVED_PREFIX
 from firewall.core.ipXtables import ip4tables_available_tables,\
     ip6tables_available_tables, OUR_CHAINS
 
@@ -80,18 +83,132 @@ for x in INTERFACE_ZONE_OPTS:
     if INTERFACE_ZONE_OPTS[x] == "-o":
         SOURCE_ZONE_OPTS[x] = "-d"
 
+class SettingsRecord(object):
+    """ Date, sender, timeout, mark and default zone flag of a runtime
+    setting of a zone
+
+    Records are used like dicts with the keys "date", "sender", "timeout",
+    "mark" and "__default__". The optional keys "mark" and "__default__" are
+    not contained if their value is None.
+    """
+
+    __slots__ = ( "date", "sender", "timeout", "mark", "default" )
+    KEYS = { "date": "date", "sender": "sender", "timeout": "timeout",
+             "mark": "mark", "__default__": "default" }
+    OPTIONAL_KEYS = ( "mark", "__default__" )
+
+    def __init__(self, date, sender, timeout, mark=None, default=None):
+        self.date = date
+        self.sender = sender
+        self.timeout = timeout
+        self.mark = mark
+        self.default = default
+
+    def __repr__(self):
+        return '%s(%r, %r, %r, %r, %r)' % \
+            (self.__class__, self.date, self.sender, self.timeout, self.mark,
+             self.default)
+
+    def __contains__(self, key):
+        if key not in self.KEYS:
+            return False
+        return key not in self.OPTIONAL_KEYS or \
+            getattr(self, self.KEYS[key]) is not None
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, self.KEYS[key])
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, self.KEYS[key], value)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return getattr(self, self.KEYS[key])
+
+    def copy(self):
+        return SettingsRecord(self.date, self.sender, self.timeout, self.mark,
+                              self.default)
+
+class _Rich_Set_Destination(object):
+    # destination of an aggregated rich rule: the hidden ipset with the
+    # destination addresses of the rules
+    __slots__ = ( "ipset", )
+    addr = None
+    invert = False
+
+    def __init__(self, ipset):
+        self.ipset = ipset
+
 class FirewallZone(object):
     def __init__(self, fw):
         self._fw = fw
         self._chains = { }
         self._zones = { }
+        # ipsets with timeout for timed rich rules:
+        # name -> [ count, zone, ipv, ipset type ]
+        self._timed_ipsets = { }
+        # rich rules grouped by source in sub chains:
+        # (zone, ipv, chain, source match) -> (sub chain, number of rules)
+        self._source_groups = { }
+        # rich rules, that only differ in the source or destination address:
+        # (zone, rule with placeholder address) ->
+        #     [ ipset name or None if applied one by one, ipv, rule matching
+        #       the ipset, { rule id: (rule, address) } ]
+        self._rule_sets = { }
+        # ipset name -> ipv
+        self._rule_set_names = { }
+        # settings generation and exported config with settings per zone
+        self._generation = { }
+        self._config_cache = { }
 
     def __repr__(self):
-        return '%s(%r, %r)' % (self.__class__, self._chains, self._zones)
+        return '%s(%r, %r, %r, %r, %r)' % (self.__class__, self._chains,
+                                           self._zones, self._timed_ipsets,
+                                           self._source_groups,
+                                           self._rule_sets)
 
     def cleanup(self):
         self._chains.clear()
         self._zones.clear()
+        self._source_groups.clear()
+        self._generation.clear()
+        self._config_cache.clear()
+        for name in self._timed_ipsets:
+            try:
+                self._fw._ipset.destroy(name)
+            except Exception as msg:
+                log.debug1("Failed to destroy ipset '%s': %s", name, msg)
+        self._timed_ipsets.clear()
+        for name in self._rule_set_names:
+            try:
+                self._fw._ipset.destroy(name)
+            except Exception as msg:
+                log.debug1("Failed to destroy ipset '%s': %s", name, msg)
+        self._rule_sets.clear()
+        self._rule_set_names.clear()
+
+    def snapshot(self, fw):
+        """ Return a copy for read only queries of the snapshot fw. The
+            zones and their settings are copied, the other dicts are only
+            copied as they are cleared in place by cleanup.
+        """
+        obj = copy.copy(self)
+        obj._fw = fw
+        for (name, value) in self.__dict__.items():
+            if isinstance(value, dict):
+                setattr(obj, name, value.copy())
+        for (name, zone) in self._zones.items():
+            zone = copy.copy(zone)
+            zone.settings = dict((key, dict((x, value[x].copy())
+                                            for x in value))
+                                 for (key, value) in zone.settings.items())
+            obj._zones[name] = zone
+        return obj
 
     # zones
 
@@ -134,6 +251,7 @@ class FirewallZone(object):
                                            "protocols" ] }
 
         self._zones[obj.name] = obj
+        self.__settings_changed(obj.name)
 
     def remove_zone(self, zone):
         obj = self._zones[zone]
@@ -141,6 +259,8 @@ class FirewallZone(object):
             self.unapply_zone_settings(zone)
         obj.settings.clear()
         del self._zones[zone]
+        self._generation.pop(zone, None)
+        self._config_cache.pop(zone, None)
 
     def apply_zones(self):
         for zone in self.get_zones():
@@ -160,7 +280,7 @@ class FirewallZone(object):
                 self._error2warning(self.add_protocol, obj.name, args)
             if obj.masquerade:
                 self._error2warning(self.add_masquerade, obj.name)
-            for args in obj.rules:
+            for args in obj.rules.values():
                 self._error2warning(self.add_rule, obj.name, args)
             for args in obj.interfaces:
                 self._error2warning(self.add_interface, obj.name, args)
@@ -322,14 +442,15 @@ class FirewallZone(object):
 
     # generate settings record with sender, timeout, mark
     def __gen_settings(self, timeout, sender, mark=None):
-        ret = {
-            "date": time.time(),
-            "sender": sender,
-            "timeout": timeout,
-        }
-        if mark:
-            ret["mark"] = mark
-        return ret
+        return SettingsRecord(time.time(), sender, timeout, mark or None)
+
+    # remaining time of a timed settings record in seconds, at least 1
+    def __remaining_timeout(self, settings):
+        timeout = settings.get("timeout", 0)
+        if timeout < 1:
+            return 0
+        return max(int(math.ceil(settings["date"] + timeout - time.time())),
+                   1)
 
     def get_settings(self, zone):
         return self.get_zone(zone).settings
@@ -337,14 +458,14 @@ class FirewallZone(object):
     def set_settings(self, zone, settings):
         _obj = self.get_zone(zone)
 
-        try:
-            for key in settings:
-                for args in settings[key]:
-                    if args in _obj.settings[key]:
-                        # do not add things, that are already active in the
-                        # zone configuration, also do not restore date,
-                        # sender and timeout
-                        continue
+        for key in settings:
+            for args in settings[key]:
+                if args in _obj.settings[key]:
+                    # do not add things, that are already active in the
+                    # zone configuration, also do not restore date,
+                    # sender and timeout
+                    continue
+                try:
                     if key == "icmp_blocks":
                         self.add_icmp_block(zone, args)
                     elif key == "forward_ports":
@@ -354,11 +475,13 @@ class FirewallZone(object):
                     elif key == "ports":
                         self.add_port(zone, *args)
                     elif key == "protocols":
-                        self.add_protocol(zone, *args)
+                        self.add_protocol(zone, args)
                     elif key == "masquerade":
                         self.add_masquerade(zone)
                     elif key == "rules":
-                        self.add_rule(zone, Rich_Rule(rule_str=args))
+                        self.add_rule(zone, rich_rule_cache.get(args),
+                                      self.__remaining_timeout(
+                                          settings[key][args]))
                     elif key == "interfaces":
                         self.change_zone_of_interface(zone, args)
                     elif key == "sources":
@@ -366,25 +489,29 @@ class FirewallZone(object):
                     else:
                         log.error("Zone '%s': Unknown setting '%s:%s', "
                                   "unable to restore.", zone, key, args)
-                    # restore old date, sender and timeout
-                    if args in _obj.settings[key]:
-                        _obj.settings[key][args] = settings[key][args]
-
-        except FirewallError as msg:
-            log.error(msg)
+                except FirewallError as msg:
+                    log.error(msg)
+                    continue
+                # restore old date, sender and timeout, but keep the mark
+                # that has been allocated now
+                if args in _obj.settings[key]:
+                    _settings = settings[key][args].copy()
+                    _settings["mark"] = _obj.settings[key][args].get("mark")
+                    _obj.settings[key][args] = _settings
 
     def __zone_settings(self, enable, zone):
         obj = self.get_zone(zone)
         if (enable and obj.applied) or (not enable and not obj.applied):
             return
         settings = self.get_settings(zone)
+        rule_sets = [ ]
         for key in settings:
             for args in settings[key]:
                 try:
                     if key == "icmp_blocks":
                         self.__icmp_block(enable, zone, args)
                     elif key == "forward_ports":
-                        mark = obj.settings["forward_ports"][args]["mark"]
+                        mark = obj.settings["forward_ports"][args].get("mark")
                         self.__forward_port(enable, zone, *args, mark_id=mark)
                     elif key == "services":
                         self.__service(enable, zone, args)
@@ -395,9 +522,20 @@ class FirewallZone(object):
                     elif key == "masquerade":
                         self.__masquerade(enable, zone)
                     elif key == "rules":
-                        mark = self.__rule(enable, zone,
-                                           Rich_Rule(rule_str=args), None)
-                        obj.settings["rules"][args]["mark"] = mark
+                        rule = rich_rule_cache.get(args)
+                        _settings = obj.settings["rules"][args]
+                        if _settings["timeout"] > 0 and \
+                           self.__timed_rule_entry(rule) is not None:
+                            self.__timed_rule(
+                                enable, zone, rule,
+                                self.__remaining_timeout(_settings))
+                            continue
+                        if self.__rule_set_entry(rule) is not None:
+                            rule_sets.append(rule)
+                            continue
+                        mark = self.__rule(enable, zone, rule,
+                                           _settings.get("mark"))
+                        _settings["mark"] = mark
                     elif key == "interfaces":
                         self.__interface(enable, zone, args)
                     elif key == "sources":
@@ -407,6 +545,10 @@ class FirewallZone(object):
                                   "unable to apply", zone, key, args)
                 except FirewallError as msg:
                     log.error(msg)
+        if enable:
+            self.__rule_sets_apply(zone, rule_sets)
+        else:
+            self.__rule_sets_unapply(zone)
         obj.applied = enable
 
     def apply_zone_settings(self, zone):
@@ -420,10 +562,23 @@ class FirewallZone(object):
         if len(obj.interfaces) == 0 and len(obj.sources) == 0:
             self.unapply_zone_settings(zone)
 
+    def __settings_changed(self, zone):
+        # invalidates the cached config with settings of the zone
+        self._generation[zone] = self._generation.get(zone, 0) + 1
+
     def get_config_with_settings(self, zone):
         """
         :return: exported config updated with runtime settings
+
+        The returned tuple is cached until the runtime settings of the zone
+        are changed, it must not be modified.
         """
+        zone = self._fw.check_zone(zone)
+        generation = self._generation.get(zone, 0)
+        if zone in self._config_cache and \
+           self._config_cache[zone][0] == generation:
+            return self._config_cache[zone][1]
+
         config = list(self.get_zone(zone).export_config())
         config[5] = self.list_services(zone)
         config[6] = self.list_ports(zone)
@@ -434,7 +589,9 @@ class FirewallZone(object):
         config[11] = self.list_sources(zone)
         config[12] = self.list_rules(zone)
         config[13] = self.list_protocols(zone)
-        return tuple(config)
+        config = tuple(config)
+        self._config_cache[zone] = (generation, config)
+        return config
 
     # handle chains, modules and rules for a zone
     def handle_cmr(self, zone, chains, modules, rules, enable):
@@ -558,6 +715,7 @@ class FirewallZone(object):
             self.__gen_settings(0, sender)
         # add information whether we add to default or specific zone
         _obj.settings["interfaces"][interface_id]["__default__"] = (not zone or zone == "")
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -601,6 +759,7 @@ class FirewallZone(object):
 
         if interface_id in _obj.settings["interfaces"]:
             del _obj.settings["interfaces"][interface_id]
+        self.__settings_changed(_zone)
 
 #        self.unapply_zone_settings_if_unused(_zone)
         return _zone
@@ -744,6 +903,7 @@ class FirewallZone(object):
             self.__gen_settings(0, sender)
         # add information whether we add to default or specific zone
         _obj.settings["sources"][source_id]["__default__"] = (not zone or zone == "")
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -784,6 +944,7 @@ class FirewallZone(object):
 
         if source_id in _obj.settings["sources"]:
             del _obj.settings["sources"][source_id]
+        self.__settings_changed(_zone)
 
 #        self.unapply_zone_settings_if_unused(_zone)
         return _zone
@@ -803,7 +964,7 @@ class FirewallZone(object):
 
     def __rule_id(self, rule):
         self.check_rule(rule)
-        return (str(rule))
+        return rule.canonical()
 
     def __rule_source_ipv(self, source):
         if not source:
@@ -817,6 +978,8 @@ class FirewallZone(object):
         elif hasattr(source, "mac") and source.mac:
             return ""
         elif hasattr(source, "ipset") and source.ipset:
+            if source.ipset in self._rule_set_names:
+                return self._rule_set_names[source.ipset]
             return self.ipset_family(source.ipset)
 
         return None
@@ -842,6 +1005,10 @@ class FirewallZone(object):
 
     def __rule_destination(self, destination, command):
         if destination:
+            if type(destination) == _Rich_Set_Destination:
+                command += [ "-m", "set", "--match-set", destination.ipset,
+                             "dst" ]
+                return
             if destination.invert:
                 command.append("!")
             command += [ "-d", destination.addr ]
@@ -914,6 +1081,7 @@ class FirewallZone(object):
         chains = [ ]
         modules = [ ]
         rules = [ ]
+        allocated = False
 
         if rule.family is not None:
             ipvs = [ rule.family ]
@@ -1078,16 +1246,11 @@ class FirewallZone(object):
                 toaddr = rule.element.to_address
                 self.check_forward_port(ipv, port, protocol, toport, toaddr)
 
-                if enable:
-                    mark_id = self._fw.new_mark()
-
                 filter_chain = "INPUT" if not toaddr else "FORWARD_IN"
 
-                chains.append([ "mangle", "PREROUTING" ])
                 chains.append([ "nat", "PREROUTING" ])
                 chains.append([ "filter", filter_chain ])
 
-                mark_str = "0x%x" % mark_id
                 port_str = portStr(port)
 
                 to = ""
@@ -1097,31 +1260,53 @@ class FirewallZone(object):
                 if toport and toport != "":
                     to += ":%s" % portStr(toport, "-")
 
-                mark = [ "-m", "mark", "--mark", mark_str ]
-
                 target = DEFAULT_ZONE_TARGET.format(chain=SHORTCUTS["PREROUTING"],
                                                     zone=zone)
-                command = [ ]
-                self.__rule_source(rule.source, command)
-                self.__rule_destination(rule.destination, command)
-                command += [ "-p", protocol, "--dport", port_str,
-                             "-j", "MARK", "--set-mark", mark_str ]
-                rules.append((ipv, "mangle", "%s_allow" % target, command))
 
-                # local and remote
-                command = [ "-p", protocol ] + mark + \
-                    [ "-j", "DNAT", "--to-destination", to ]
-                rules.append((ipv, "nat", "%s_allow" % target, command))
+                if enable and mark_id is None and self._fw._forward_port_marks:
+                    mark_id = self._fw.new_mark()
+                    allocated = True
 
-                target = DEFAULT_ZONE_TARGET.format(chain=SHORTCUTS[filter_chain],
-                                                    zone=zone)
-                command = [ "-m", "conntrack", "--ctstate", "NEW" ] + \
-                    mark + [ "-j", "ACCEPT" ]
-                rules.append((ipv, "filter", "%s_allow" % target, command))
+                if mark_id is None:
+                    # no mark: DNAT directly, forwarded traffic is accepted
+                    # with the conntrack DNAT state of this forward port
+                    command = [ ]
+                    self.__rule_source(rule.source, command)
+                    self.__rule_destination(rule.destination, command)
+                    command += [ "-p", protocol, "--dport", port_str,
+                                 "-j", "DNAT", "--to-destination", to ]
+                    rules.append((ipv, "nat", "%s_allow" % target, command))
 
-                if not enable:
-                    self._fw.del_mark(mark_id)
-                    mark_id = None
+                    target = DEFAULT_ZONE_TARGET.format(
+                        chain=SHORTCUTS[filter_chain], zone=zone)
+                    command = [ ]
+                    self.__rule_source(rule.source, command)
+                    command += self.__dnat_accept_rule(protocol, port, toport,
+                                                       toaddr)
+                    rules.append((ipv, "filter", "%s_allow" % target, command))
+                else:
+                    chains.append([ "mangle", "PREROUTING" ])
+
+                    mark_str = "0x%x" % mark_id
+                    mark = [ "-m", "mark", "--mark", mark_str ]
+
+                    command = [ ]
+                    self.__rule_source(rule.source, command)
+                    self.__rule_destination(rule.destination, command)
+                    command += [ "-p", protocol, "--dport", port_str,
+                                 "-j", "MARK", "--set-mark", mark_str ]
+                    rules.append((ipv, "mangle", "%s_allow" % target, command))
+
+                    # local and remote
+                    command = [ "-p", protocol ] + mark + \
+                        [ "-j", "DNAT", "--to-destination", to ]
+                    rules.append((ipv, "nat", "%s_allow" % target, command))
+
+                    target = DEFAULT_ZONE_TARGET.format(
+                        chain=SHORTCUTS[filter_chain], zone=zone)
+                    command = [ "-m", "conntrack", "--ctstate", "NEW" ] + \
+                        mark + [ "-j", "ACCEPT" ]
+                    rules.append((ipv, "filter", "%s_allow" % target, command))
 
             # ICMP BLOCK
             elif type(rule.element) == Rich_IcmpBlock:
@@ -1198,12 +1383,432 @@ class FirewallZone(object):
                 raise FirewallError(INVALID_RULE, "Unknown element %s" % 
                                     type(rule.element))
 
+        (rules, source_groups) = self.__source_group_rules(enable, zone,
+                                                           rule, rules)
+        if enable:
+            self.__source_group_chains(True, source_groups)
+
         msg = self.handle_cmr(zone, chains, modules, rules, enable)
         if msg is not None:
+            if enable:
+                # remove the sub chains created for this rule
+                self.__source_group_chains(False, source_groups, failed=True)
+                # only free the mark if it has been allocated here, a mark
+                # that has been passed in is still in use by the caller
+                if allocated:
+                    self._fw.del_mark(mark_id)
             raise FirewallError(COMMAND_FAILED, msg)
 
+        if not enable:
+            self.__source_group_chains(False, source_groups)
+        self.__source_group_ref(source_groups)
+
+        if not enable and mark_id is not None:
+            self._fw.del_mark(mark_id)
+            mark_id = None
+
         return mark_id
 
+    # rich rules grouped by source
+
+    def __source_group_rules(self, enable, zone, rule, rules):
+        # Rich rules with a source in the log, deny and allow chains of the
+        # input target of the zone are moved into a sub chain per source and
+        # chain, that is entered by one rule matching the source. A packet
+        # is only checked against the rules of its sources this way. There
+        # is no defined order for rules with different sources in these
+        # chains, therefore the order is not changed by the grouping.
+        # Returns the rules to apply and the changes of the groups, that
+        # need to be committed with __source_group_ref after the rules have
+        # been applied.
+        changes = { } # key -> [ sub chain, change of the number of rules ]
+        prefix = [ ]
+        self.__rule_source(rule.source, prefix)
+        if not prefix:
+            return (rules, changes)
+        target = DEFAULT_ZONE_TARGET.format(chain=SHORTCUTS["INPUT"],
+                                            zone=zone)
+        chains = [ "%s_%s" % (target, x) for x in [ "log", "deny", "allow" ] ]
+
+        _rules = [ ]
+        for (ipv, table, chain, command) in rules:
+            if ipv not in [ "ipv4", "ipv6" ] or table != "filter" or \
+               chain not in chains or command[:len(prefix)] != prefix:
+                _rules.append((ipv, table, chain, command))
+                continue
+            key = (zone, ipv, chain, tuple(prefix))
+            (name, count) = self._source_groups.get(key, (None, 0))
+            if key not in changes:
+                if enable and count == 0:
+                    name = self.__new_source_chain(ipv, target, changes)
+                changes[key] = [ name, 0 ]
+            count += changes[key][1]
+            changes[key][1] += 1 if enable else -1
+            if name is None:
+                # no free chain name, the rules of the source are not
+                # grouped as long as there are rules
+                _rules.append((ipv, table, chain, command))
+                continue
+            jump = prefix + [ "-j", name ]
+            if enable and count == 0:
+                _rules.append((ipv, table, chain, jump))
+            _rules.append((ipv, table, name, command[len(prefix):]))
+            if not enable and count == 1:
+                _rules.append((ipv, table, chain, jump))
+        return (_rules, changes)
+
+    def __new_source_chain(self, ipv, target, changes):
+        # first free sub chain name for target, None if the name is too long
+        used = set([ name for (key, (name, count))
+                     in self._source_groups.items() if key[1] == ipv ])
+        used.update([ name for (key, (name, change)) in changes.items()
+                      if key[1] == ipv ])
+        n = 1
+        while "%s_src_%d" % (target, n) in used:
+            n += 1
+        name = "%s_src_%d" % (target, n)
+        if len(name) > 28:
+            return None
+        return name
+
+    def __source_group_chains(self, enable, changes, failed=False):
+        # create the sub chains of new groups or remove the sub chains of
+        # empty groups, failed: remove the chains of new groups again
+        chains = [ ]
+        for (key, (name, change)) in changes.items():
+            count = self._source_groups.get(key, (None, 0))[1]
+            if name is None or \
+               (enable and count > 0) or (failed and count > 0) or \
+               (not enable and not failed and count + change > 0):
+                continue
+            chains.append((key[1], [ name, "-t", "filter" ]))
+            if enable:
+                OUR_CHAINS["filter"].add(name)
+        if not chains:
+            return
+        ret = self._fw.handle_chains(chains, enable)
+        if ret:
+            (cleanup_chains, msg) = ret
+            if not enable:
+                log.error(msg)
+                return
+            self._fw.handle_chains(cleanup_chains, not enable)
+            raise FirewallError(COMMAND_FAILED, msg)
+
+    def __source_group_ref(self, changes):
+        for (key, (name, change)) in changes.items():
+            count = self._source_groups.get(key, (None, 0))[1] + change
+            if count > 0:
+                self._source_groups[key] = (name, count)
+            elif key in self._source_groups:
+                del self._source_groups[key]
+
+    # rich rules aggregated in ipsets
+
+    def __rule_set_entry(self, rule):
+        # Rich rules with the same element, log, audit and action, that only
+        # differ in the source or the destination address are aggregated:
+        # the addresses are the entries of a hidden hash:net ipset, that is
+        # matched by one rule instead of a rule for every address. The first
+        # rule is applied as is, the ipset is created with the second rule.
+        # Returns (key, direction, address) or None if the rule is not
+        # usable.
+        if not self._fw.ipset_enabled or rule.family not in [ "ipv4", "ipv6" ]:
+            return None
+        if type(rule.element) in [ Rich_ForwardPort, Rich_Masquerade ]:
+            # forward ports are using marks per rule, masquerade is using
+            # the source as destination
+            return None
+        if (rule.action and rule.action.limit) or \
+           (rule.log and rule.log.limit) or (rule.audit and rule.audit.limit):
+            # every rule has its own rate limit, one rule for all addresses
+            # would share it
+            return None
+        placeholder = "0.0.0.0/0" if rule.family == "ipv4" else "::/0"
+        if rule.source and rule.source.addr and not rule.source.invert:
+            direction = "src"
+            addr = rule.source.addr
+            _rule = rule.replace(source=Rich_Source(placeholder, None, None))
+        elif rule.destination and not rule.destination.invert:
+            direction = "dst"
+            addr = rule.destination.addr
+            _rule = rule.replace(destination=Rich_Destination(placeholder))
+        else:
+            return None
+        if addr.endswith("/0"):
+            # not usable in hash:net
+            return None
+        return (_rule.canonical(), direction, addr)
+
+    def __rule_set_rule(self, rule, direction, name):
+        # the rule matching the addresses in the ipset name
+        if direction == "src":
+            return rule.replace(source=Rich_Source(None, None, name))
+        return rule.replace(destination=_Rich_Set_Destination(name))
+
+    def __new_rule_set_name(self, zone):
+        # the reserved prefix is not usable for ipsets of the configuration
+        n = 1
+        while "%srules_%d" % (IPSET_RESERVED_PREFIX, n) in \
+              self._rule_set_names:
+            n += 1
+        return "%srules_%d" % (IPSET_RESERVED_PREFIX, n)
+
+    def __rule_set_create(self, zone, group, direction, members):
+        # create the ipset with the addresses of the rules of the group and
+        # the new members, apply the rule matching the ipset and remove the
+        # rules of the group, that have been applied one by one
+        ipv = group[1]
+        name = self.__new_rule_set_name(zone)
+        _rule = self.__rule_set_rule(members[0][1], direction, name)
+        entries = [ x[1] for x in group[3].values() ] + \
+                  [ x[2] for x in members ]
+        options = { "family": "inet" if ipv == "ipv4" else "inet6" }
+        try:
+            # a set with the name might have been left over by a previous
+            # run, it is unused after the flush at start
+            if name in self._fw._ipset.names():
+                self._fw._ipset.destroy(name)
+            self._fw._ipset.restore(name, "hash:net", entries, options)
+        except Exception as msg:
+            raise FirewallError(COMMAND_FAILED, msg)
+        self._rule_set_names[name] = ipv
+
+        removed = [ ]
+        try:
+            self.__rule(True, zone, _rule, None)
+            try:
+                for (rule, addr) in group[3].values():
+                    self.__rule(False, zone, rule, None)
+                    removed.append(rule)
+            except FirewallError:
+                for rule in removed + [ _rule ]:
+                    try:
+                        self.__rule(rule is not _rule, zone, rule, None)
+                    except FirewallError as msg:
+                        log.error(msg)
+                raise
+        except FirewallError:
+            del self._rule_set_names[name]
+            try:
+                self._fw._ipset.destroy(name)
+            except Exception as msg:
+                log.debug1("Failed to destroy ipset '%s': %s", name, msg)
+            raise
+        group[0] = name
+        group[2] = _rule
+
+    def __rule_set_remove(self, zone, key):
+        # remove the rules of the group and the ipset
+        (name, ipv, _rule, members) = self._rule_sets.pop(key)
+        if name is None:
+            for (rule, addr) in members.values():
+                self.__rule(False, zone, rule, None)
+            return
+        try:
+            self.__rule(False, zone, _rule, None)
+        except FirewallError:
+            del self._rule_set_names[name]
+            raise
+        # the ipset is destroyed after the rule using it has been removed,
+        # the name is not reused before
+        self._fw.after_rules(self.__rule_set_destroy, name)
+
+    def __rule_set_destroy(self, name):
+        del self._rule_set_names[name]
+        self.__ipset_destroy(name)
+
+    def __ipset_destroy(self, name):
+        try:
+            self._fw._ipset.destroy(name)
+        except Exception as msg:
+            log.debug1("Failed to destroy ipset '%s': %s", name, msg)
+
+    def __rule_set(self, enable, zone, rule):
+        (key, direction, addr) = self.__rule_set_entry(rule)
+        key = (zone, key)
+        rule_id = self.__rule_id(rule)
+        group = self._rule_sets.get(key, [ None, rule.family, None, { } ])
+
+        if enable:
+            if group[0] is None and len(group[3]) == 0:
+                self.__rule(True, zone, rule, None)
+            elif group[0] is None:
+                self.__rule_set_create(zone, group, direction,
+                                       [ (rule_id, rule, addr) ])
+            else:
+                try:
+                    self._fw._ipset.add(group[0], addr)
+                except Exception as msg:
+                    raise FirewallError(COMMAND_FAILED, msg)
+            group[3][rule_id] = (rule, addr)
+            self._rule_sets[key] = group
+            return
+
+        if rule_id not in group[3]:
+            return
+        if group[0] is None:
+            self.__rule(False, zone, rule, None)
+        else:
+            try:
+                self._fw._ipset.delete(group[0], addr)
+            except Exception as msg:
+                raise FirewallError(COMMAND_FAILED, msg)
+        del group[3][rule_id]
+        if len(group[3]) == 0:
+            self.__rule_set_remove(zone, key)
+
+    def __rule_sets_apply(self, zone, rules):
+        # apply the rules of a zone, that are usable for ipsets, with one
+        # ipset per group instead of adding the addresses one by one
+        groups = { }
+        for rule in rules:
+            (key, direction, addr) = self.__rule_set_entry(rule)
+            groups.setdefault((zone, key), (direction, [ ]))[1].append(
+                (self.__rule_id(rule), rule, addr))
+        for (key, (direction, members)) in groups.items():
+            group = [ None, members[0][1].family, None, { } ]
+            if len(members) > 1:
+                try:
+                    self.__rule_set_create(zone, group, direction, members)
+                except FirewallError as msg:
+                    log.error(msg)
+                else:
+                    for (rule_id, rule, addr) in members:
+                        group[3][rule_id] = (rule, addr)
+                    self._rule_sets[key] = group
+                    continue
+            # a single rule or the ipset could not be created
+            for (rule_id, rule, addr) in members:
+                try:
+                    self.__rule(True, zone, rule, None)
+                except FirewallError as msg:
+                    log.error(msg)
+                else:
+                    group[3][rule_id] = (rule, addr)
+            if len(group[3]) > 0:
+                self._rule_sets[key] = group
+
+    def __rule_sets_unapply(self, zone):
+        for key in [ x for x in self._rule_sets if x[0] == zone ]:
+            try:
+                self.__rule_set_remove(zone, key)
+            except FirewallError as msg:
+                log.error(msg)
+
+    # timed rich rules using ipsets with timeout
+
+    def __timed_rule_entry(self, rule):
+        # Timed rich rules, that are only accepting a source address with
+        # an optional port are added as entries with timeout to ipsets, that
+        # are matched by a fixed rule in the zone. The kernel removes the
+        # entries when the timeout is reached, also if firewalld is busy or
+        # stalled. The ipsets are destroyed with the zone rules on stop and
+        # reload like all other runtime settings, their names are using the
+        # reserved prefix to not collide with configured ipsets.
+        # Returns (ipv, ipset type, entry) or None if the rule is not usable.
+        if not self._fw.ipset_enabled:
+            return None
+        if type(rule.action) != Rich_Accept or rule.action.limit or \
+           rule.log or rule.audit or rule.destination:
+            return None
+        if not rule.source or not rule.source.addr or rule.source.invert:
+            return None
+        ipv = self.__rule_source_ipv(rule.source)
+        if rule.family is not None and rule.family != ipv:
+            return None
+        addr = rule.source.addr
+        if addr.endswith("/0"):
+            # not usable in hash:net
+            return None
+        if rule.element is None:
+            return (ipv, "hash:net", addr)
+        if type(rule.element) == Rich_Port and \
+           rule.element.protocol in [ "tcp", "udp" ]:
+            return (ipv, "hash:net,port",
+                    "%s,%s:%s" % (addr, rule.element.protocol,
+                                  portStr(rule.element.port, "-")))
+        return None
+
+    def __timed_rule_name(self, zone, ipv, ipset_type):
+        return "%s%s_timed%s%s" % (IPSET_RESERVED_PREFIX, zone, ipv[-1],
+                                   "p" if ipset_type == "hash:net,port"
+                                   else "")
+
+    def __timed_rule(self, enable, zone, rule, timeout):
+        (ipv, ipset_type, entry) = self.__timed_rule_entry(rule)
+        target = DEFAULT_ZONE_TARGET.format(chain=SHORTCUTS["INPUT"],
+                                            zone=zone)
+        name = self.__timed_rule_name(zone, ipv, ipset_type)
+        command = [ "%s_allow" % target, "-t", "filter",
+                    "-m", "set", "--match-set", name ]
+        if ipset_type == "hash:net,port":
+            command += [ "src,dst", "-m", "conntrack", "--ctstate", "NEW" ]
+        else:
+            command += [ "src" ]
+        command += [ "-j", "ACCEPT" ]
+
+        if enable:
+            if name not in self._timed_ipsets:
+                self.add_chain(zone, "filter", "INPUT")
+                options = { "family": "inet" if ipv == "ipv4" else "inet6",
+                            "timeout": "0" }
+                try:
+                    # a set with the name might have been left over by a
+                    # previous run, it is unused after the flush at start
+                    if name in self._fw._ipset.names():
+                        self._fw._ipset.destroy(name)
+                    self._fw._ipset.restore(name, ipset_type, [ ], options)
+                except Exception as msg:
+                    raise FirewallError(COMMAND_FAILED, msg)
+                ret = self._fw.handle_rules([ (ipv, command) ], True)
+                if ret:
+                    (cleanup_rules, msg) = ret
+                    try:
+                        self._fw._ipset.destroy(name)
+                    except Exception:
+                        pass
+                    self.remove_chain(zone, "filter", "INPUT")
+                    raise FirewallError(COMMAND_FAILED, msg)
+                self._timed_ipsets[name] = [ 0, zone, ipv, ipset_type ]
+            try:
+                self._fw._ipset.add(name, entry, [ "timeout", timeout,
+                                                   "-exist" ])
+            except Exception as msg:
+                if self._timed_ipsets[name][0] < 1:
+                    # remove the unused ipset and rule again
+                    del self._timed_ipsets[name]
+                    try:
+                        self.__timed_rule_remove(zone, ipv, name, command)
+                    except FirewallError as error:
+                        log.debug1(error)
+                raise FirewallError(COMMAND_FAILED, msg)
+            self._timed_ipsets[name][0] += 1
+        else:
+            if name not in self._timed_ipsets:
+                return
+            try:
+                self._fw._ipset.delete(name, entry)
+            except Exception as msg:
+                # the entry has already been removed by the kernel
+                log.debug1("Failed to remove entry '%s' from ipset '%s': %s",
+                           entry, name, msg)
+            self._timed_ipsets[name][0] -= 1
+            if self._timed_ipsets[name][0] > 0:
+                return
+            del self._timed_ipsets[name]
+            self.__timed_rule_remove(zone, ipv, name, command)
+
+    def __timed_rule_remove(self, zone, ipv, name, command):
+        # remove the rule matching the ipset and the ipset
+        ret = self._fw.handle_rules([ (ipv, command) ], False)
+        if ret:
+            (cleanup_rules, msg) = ret
+            raise FirewallError(COMMAND_FAILED, msg)
+        # the ipset is destroyed after the rule using it has been removed
+        self._fw.after_rules(self.__ipset_destroy, name)
+        self.remove_chain(zone, "filter", "INPUT")
+
     def add_rule(self, zone, rule, timeout=0, sender=None):
         _zone = self._fw.check_zone(zone)
         self._fw.check_timeout(timeout)
@@ -1215,13 +1820,18 @@ class FirewallZone(object):
             raise FirewallError(ALREADY_ENABLED,
                                 "'%s' already in '%s'" % (rule, _zone))
 
+        mark = None
         if _obj.applied:
-            mark = self.__rule(True, _zone, rule, None)
-        else:
-            mark = None
+            if timeout > 0 and self.__timed_rule_entry(rule) is not None:
+                self.__timed_rule(True, _zone, rule, timeout)
+            elif self.__rule_set_entry(rule) is not None:
+                self.__rule_set(True, _zone, rule)
+            else:
+                mark = self.__rule(True, _zone, rule, None)
 
         _obj.settings["rules"][rule_id] = \
             self.__gen_settings(timeout, sender, mark=mark)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1240,15 +1850,37 @@ class FirewallZone(object):
         else:
             mark = None
         if _obj.applied:
-            self.__rule(False, _zone, rule, mark)
+            if _obj.settings["rules"][rule_id]["timeout"] > 0 and \
+               self.__timed_rule_entry(rule) is not None:
+                self.__timed_rule(False, _zone, rule, 0)
+            elif self.__rule_set_entry(rule) is not None:
+                self.__rule_set(False, _zone, rule)
+            else:
+                self.__rule(False, _zone, rule, mark)
 
         if rule_id in _obj.settings["rules"]:
             del _obj.settings["rules"][rule_id]
+        self.__settings_changed(_zone)
 
         return _zone
 
     def query_rule(self, zone, rule):
-        return self.__rule_id(rule) in self.get_settings(zone)["rules"]
+        _zone = self._fw.check_zone(zone)
+        rule_id = self.__rule_id(rule)
+        _settings = self.get_settings(_zone)["rules"].get(rule_id)
+        if _settings is None:
+            return False
+        if _settings["timeout"] > 0 and self._zones[_zone].applied and \
+           self.__timed_rule_entry(rule) is not None:
+            # the kernel might have expired the entry already
+            (ipv, ipset_type, entry) = self.__timed_rule_entry(rule)
+            name = self.__timed_rule_name(_zone, ipv, ipset_type)
+            if name in self._timed_ipsets:
+                try:
+                    self._fw._ipset.test(name, entry)
+                except Exception:
+                    return False
+        return True
 
     def list_rules(self, zone):
         return list(self.get_settings(zone)["rules"].keys())
@@ -1335,6 +1967,7 @@ class FirewallZone(object):
 
         _obj.settings["services"][service_id] = \
             self.__gen_settings(timeout, sender)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1353,6 +1986,7 @@ class FirewallZone(object):
 
         if service_id in _obj.settings["services"]:
             del _obj.settings["services"][service_id]
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1413,6 +2047,7 @@ class FirewallZone(object):
 
         _obj.settings["ports"][port_id] = \
             self.__gen_settings(timeout, sender)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1431,6 +2066,7 @@ class FirewallZone(object):
 
         if port_id in _obj.settings["ports"]:
             del _obj.settings["ports"][port_id]
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1489,6 +2125,7 @@ class FirewallZone(object):
 
         _obj.settings["protocols"][protocol_id] = \
             self.__gen_settings(timeout, sender)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1507,6 +2144,7 @@ class FirewallZone(object):
 
         if protocol_id in _obj.settings["protocols"]:
             del _obj.settings["protocols"][protocol_id]
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1566,6 +2204,7 @@ class FirewallZone(object):
 
         _obj.settings["masquerade"][masquerade_id] = \
             self.__gen_settings(timeout, sender)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1584,6 +2223,7 @@ class FirewallZone(object):
 
         if masquerade_id in _obj.settings["masquerade"]:
             del _obj.settings["masquerade"][masquerade_id]
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1609,9 +2249,23 @@ class FirewallZone(object):
         return (portStr(port, "-"), protocol,
                 portStr(toport, "-"), str(toaddr))
 
+    def __dnat_accept_rule(self, protocol, port, toport=None, toaddr=None):
+        # Forward ports without marks: the filter rule accepts new
+        # connections, that have been DNATed for this forward port. The
+        # original destination port and the reply source are matched, DNAT
+        # rules of other tools are therefore not accepted by this rule.
+        command = [ "-p", protocol,
+                    "-m", "conntrack", "--ctstate", "NEW",
+                    "-m", "conntrack", "--ctstate", "DNAT",
+                    "--ctorigdstport", portStr(port) ]
+        if toaddr:
+            command += [ "--ctreplsrc", toaddr ]
+        if toport and toport != "":
+            command += [ "--ctreplsrcport", portStr(toport) ]
+        return command + [ "-j", "ACCEPT" ]
+
     def __forward_port(self, enable, zone, port, protocol, toport=None,
                        toaddr=None, mark_id=None):
-        mark_str = "0x%x" % mark_id
         port_str = portStr(port)
 
         to = ""
@@ -1623,10 +2277,9 @@ class FirewallZone(object):
         if toport and toport != "":
             to += ":%s" % portStr(toport, "-")
 
-        mark = [ "-m", "mark", "--mark", mark_str ]
-
         if enable:
-            self.add_chain(zone, "mangle", "PREROUTING")
+            if mark_id is not None:
+                self.add_chain(zone, "mangle", "PREROUTING")
             self.add_chain(zone, "nat", "PREROUTING")
             self.add_chain(zone, "filter", filter_chain)
             enable_ip_forwarding("ipv4")
@@ -1635,6 +2288,24 @@ class FirewallZone(object):
         for ipv in [ "ipv4" ]: # IPv4 only!
             target = DEFAULT_ZONE_TARGET.format(
                 chain=SHORTCUTS["PREROUTING"], zone=zone)
+
+            if mark_id is None:
+                # no mark: DNAT directly, forwarded traffic is accepted with
+                # the conntrack DNAT state of this forward port
+                rules.append((ipv, [ "%s_allow" % (target),
+                                     "-t", "nat",
+                                     "-p", protocol, "--dport", port_str,
+                                     "-j", "DNAT", "--to-destination", to ]))
+                target = DEFAULT_ZONE_TARGET.format(
+                    chain=SHORTCUTS[filter_chain], zone=zone)
+                rules.append((ipv, [ "%s_allow" % (target), "-t", "filter" ] +
+                              self.__dnat_accept_rule(protocol, port, toport,
+                                                      toaddr)))
+                continue
+
+            mark_str = "0x%x" % mark_id
+            mark = [ "-m", "mark", "--mark", mark_str ]
+
             rules.append((ipv, [ "%s_allow" % (target),
                                  "-t", "mangle",
                                  "-p", protocol, "--dport", port_str,
@@ -1657,12 +2328,12 @@ class FirewallZone(object):
         if ret:
             (cleanup_rules, msg) = ret
             self._fw.handle_rules(cleanup_rules, not enable)
-            if enable:
-                self._fw.del_mark(mark_id)
+            # the mark is owned by the caller
             raise FirewallError(COMMAND_FAILED, msg)
 
         if not enable:
-            self.remove_chain(zone, "mangle", "PREROUTING")
+            if mark_id is not None:
+                self.remove_chain(zone, "mangle", "PREROUTING")
             self.remove_chain(zone, "nat", "PREROUTING")
             self.remove_chain(zone, "filter", filter_chain)
 
@@ -1679,13 +2350,21 @@ class FirewallZone(object):
                                 "'%s:%s:%s:%s' already in '%s'" % \
                                 (port, protocol, toport, toaddr, _zone))
 
-        mark = self._fw.new_mark()
+        mark = None
+        if self._fw._forward_port_marks:
+            mark = self._fw.new_mark()
         if _obj.applied:
-            self.__forward_port(True, _zone, port, protocol, toport, toaddr,
-                                mark_id=mark)
+            try:
+                self.__forward_port(True, _zone, port, protocol, toport,
+                                    toaddr, mark_id=mark)
+            except Exception:
+                if mark is not None:
+                    self._fw.del_mark(mark)
+                raise
 
         _obj.settings["forward_ports"][forward_id] = \
             self.__gen_settings(timeout, sender, mark=mark)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1701,7 +2380,7 @@ class FirewallZone(object):
                                 "'%s:%s:%s:%s' not in '%s'" % \
                                 (port, protocol, toport, toaddr, _zone))
 
-        mark = _obj.settings["forward_ports"][forward_id]["mark"]
+        mark = _obj.settings["forward_ports"][forward_id].get("mark")
 
         if _obj.applied:
             self.__forward_port(False, _zone, port, protocol, toport, toaddr,
@@ -1709,7 +2388,9 @@ class FirewallZone(object):
 
         if forward_id in _obj.settings["forward_ports"]:
             del _obj.settings["forward_ports"][forward_id]
-        self._fw.del_mark(mark)
+        self.__settings_changed(_zone)
+        if mark is not None:
+            self._fw.del_mark(mark)
 
         return _zone
 
@@ -1787,6 +2468,7 @@ class FirewallZone(object):
 
         _obj.settings["icmp_blocks"][icmp_id] = \
             self.__gen_settings(timeout, sender)
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -1805,6 +2487,7 @@ class FirewallZone(object):
 
         if icmp_id in _obj.settings["icmp_blocks"]:
             del _obj.settings["icmp_blocks"][icmp_id]
+        self.__settings_changed(_zone)
 
         return _zone
 
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import tempfile
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from firewall.config import VERSION
+from firewall.core.logger import log
+
+def _parse(job):
+    # parse a file in a worker process, errors are reported again by the
+    # reader in the main process
+    (reader, filename, path) = job
+    try:
+        return pickle.dumps(reader(filename, path), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+
+class ConfigCache(object):
+    """ On-disk cache of parsed configuration files
+
+    The objects created by the icmptype, service, zone and ipset readers are
+    stored pickled together with the inode, modification and change time and
+    size of the file they have been read from. The change time can not be
+    set from user space, a file replaced by one with the same size and
+    modification time is detected with it. The cache is only valid for the firewalld and
+    python version it has been written with. If a file does not match its
+    cache entry, it is parsed again by the reader.
+    """
+
+    # to be increased if the layout of the cached objects changes
+    FORMAT = 4
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = { }
+        self._used = set()
+        self._changed = False
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__, self.filename,
+                               len(self._entries))
+
+    def _header(self):
+        return (VERSION, self.FORMAT, sys.version_info[0],
+                pickle.HIGHEST_PROTOCOL)
+
+    def cleanup(self):
+        self._entries.clear()
+        self._used.clear()
+        self._changed = False
+
+    def read(self):
+        self.cleanup()
+        try:
+            with open(self.filename, "rb") as f:
+                (header, entries) = pickle.load(f)
+        except IOError:
+            return
+        except Exception as msg:
+            log.debug1("Ignoring config cache '%s': %s", self.filename, msg)
+            return
+        if header != self._header() or not isinstance(entries, dict):
+            log.debug1("Ignoring outdated config cache '%s'", self.filename)
+            return
+        self._entries = entries
+
+    def __stamp(self, name):
+        try:
+            st = os.stat(name)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+
+    def get(self, reader, filename, path):
+        """ Return the object for filename in path, either from the cache or
+            created with reader(filename, path).
+        """
+        name = "%s/%s" % (path, filename)
+        key = (reader.__name__, name)
+        stamp = self.__stamp(name)
+        if stamp is None:
+            # let the reader report the error
+            return reader(filename, path)
+
+        self._used.add(key)
+        if key in self._entries and self._entries[key][0] == stamp:
+            try:
+                return pickle.loads(self._entries[key][1])
+            except Exception as msg:
+                log.debug1("Failed to load '%s' from config cache: %s",
+                           name, msg)
+
+        obj = reader(filename, path)
+        try:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except Exception as msg:
+            log.debug1("Failed to add '%s' to config cache: %s", name, msg)
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (stamp, data)
+        self._changed = True
+        return obj
+
+    def preload(self, jobs, processes=None):
+        """ Parse all files of jobs [ (reader, filename, path), .. ], that
+            are not in the cache or have been changed, in a pool of worker
+            processes. The results are added to the cache and used by get.
+            Nothing is done if the process has other threads, forking is
+            not safe then.
+        """
+        if threading.active_count() > 1:
+            log.debug1("Not parsing files in parallel, threads are running")
+            return
+        todo = [ ]
+        for (reader, filename, path) in jobs:
+            name = "%s/%s" % (path, filename)
+            key = (reader.__name__, name)
+            stamp = self.__stamp(name)
+            if stamp is None or \
+               (key in self._entries and self._entries[key][0] == stamp):
+                continue
+            todo.append(((reader, filename, path), key, stamp))
+        if len(todo) < 2:
+            return
+
+        import multiprocessing
+        if processes is None:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        processes = min(processes, len(todo))
+        if processes < 2:
+            return
+
+        log.debug1("Parsing %d files in %d processes", len(todo), processes)
+        try:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_parse, [ x[0] for x in todo ])
+            finally:
+                pool.terminate()
+                pool.join()
+        except Exception as msg:
+            log.debug1("Failed to parse files in parallel: %s", msg)
+            return
+
+        for ((job, key, stamp), data) in zip(todo, results):
+            # the file might have been changed while it was parsed
+            if data is not None and self.__stamp(key[1]) == stamp:
+                self._entries[key] = (stamp, data)
+                self._changed = True
+
+    def write(self):
+        # drop entries of files, that have not been used since read
+        for key in list(self._entries.keys()):
+            if key not in self._used:
+                del self._entries[key]
+                self._changed = True
+        if not self._changed:
+            return
+
+        dirname = os.path.dirname(self.filename)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0o750)
+            temp_file = tempfile.NamedTemporaryFile(
+                mode='wb', prefix="%s." % os.path.basename(self.filename),
+                dir=dirname, delete=False)
+        except Exception as msg:
+            log.debug1("Failed to write config cache '%s': %s",
+                       self.filename, msg)
+            return
+
+        try:
+            pickle.dump((self._header(), self._entries), temp_file,
+                        pickle.HIGHEST_PROTOCOL)
+            temp_file.close()
+            os.rename(temp_file.name, self.filename)
+        except Exception as msg:
+            log.debug1("Failed to write config cache '%s': %s",
+                       self.filename, msg)
+            try:
+                temp_file.close()
+                os.remove(temp_file.name)
+            except Exception:
+                pass
+            return
+        self._changed = False
@@ -20,6 +20,7 @@
 #
 
 import xml.sax as sax
+import copy
 import os
 import io
 import shutil
@@ -129,6 +130,8 @@ class Direct(IO_Object):
     PARSER_OPTIONAL_ELEMENT_ATTRS = {
         }
 
+    __slots__ = ( "chains", "rules", "passthroughs" )
+
     def __init__(self, filename):
         super(Direct, self).__init__()
         self.filename = filename
@@ -173,7 +176,12 @@ class Direct(IO_Object):
                 for x in config[i]:
                     self.add_passthrough(*x)
 
+    def _copy_shared(self, name, value):
+        # chains, rules and passthroughs contain lists and dicts
+        return copy.deepcopy(value)
+
     def cleanup(self):
+        self._forget_shared()
         self.chains.clear()
         self.rules.clear()
         self.passthroughs.clear()
@@ -212,6 +220,7 @@ class Direct(IO_Object):
 
     def add_chain(self, ipv, table, chain):
         self._check_ipv_table(ipv, table)
+        self.unshare("chains")
         key = (ipv, table)
         if key not in self.chains:
             self.chains[key] = [ ]
@@ -224,6 +233,7 @@ class Direct(IO_Object):
 
     def remove_chain(self, ipv, table, chain):
         self._check_ipv_table(ipv, table)
+        self.unshare("chains")
         key = (ipv, table)
         if key in self.chains and chain in self.chains[key]:
             self.chains[key].remove(chain)
@@ -255,6 +265,7 @@ class Direct(IO_Object):
 
     def add_rule(self, ipv, table, chain, priority, args):
         self._check_ipv_table(ipv, table)
+        self.unshare("rules")
         key = (ipv, table, chain)
         if key not in self.rules:
             self.rules[key] = LastUpdatedOrderedDict()
@@ -269,6 +280,7 @@ class Direct(IO_Object):
 
     def remove_rule(self, ipv, table, chain, priority, args):
         self._check_ipv_table(ipv, table)
+        self.unshare("rules")
         key = (ipv, table, chain)
         value = (priority, tuple(args))
         if key in self.rules and value in self.rules[key]:
@@ -282,6 +294,7 @@ class Direct(IO_Object):
 
     def remove_rules(self, ipv, table, chain):
         self._check_ipv_table(ipv, table)
+        self.unshare("rules")
         key = (ipv, table, chain)
         if key in self.rules:
             for value in self.rules[key].keys():
@@ -311,6 +324,7 @@ class Direct(IO_Object):
 #
     def add_passthrough(self, ipv, args):
         self._check_ipv(ipv)
+        self.unshare("passthroughs")
         if ipv not in self.passthroughs:
             self.passthroughs[ipv] = [ ]
         if args not in self.passthroughs[ipv]:
@@ -322,6 +336,7 @@ class Direct(IO_Object):
 
     def remove_passthrough(self, ipv, args):
         self._check_ipv(ipv)
+        self.unshare("passthroughs")
         if ipv in self.passthroughs and args in self.passthroughs[ipv]:
             self.passthroughs[ipv].remove(args)
             if len(self.passthroughs[ipv]) == 0:
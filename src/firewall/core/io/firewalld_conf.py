@@ -27,33 +27,50 @@ import shutil
 from firewall.config import ETC_FIREWALLD, \
     FALLBACK_ZONE, FALLBACK_MINIMAL_MARK, \
     FALLBACK_CLEANUP_ON_EXIT, FALLBACK_LOCKDOWN, FALLBACK_IPV6_RPFILTER, \
-    FALLBACK_INDIVIDUAL_CALLS, FALLBACK_LOG_DENIED, LOG_DENIED_VALUES
+    FALLBACK_INDIVIDUAL_CALLS, FALLBACK_LOG_DENIED, LOG_DENIED_VALUES, \
+    FALLBACK_FORWARD_PORT_MARKS, FALLBACK_PARALLEL_CONFIG_LOADING, \
+    FALLBACK_GROUP_COMMIT_WINDOW, FALLBACK_GROUP_COMMIT_MAX_BATCH
 from firewall.core.logger import log
 from firewall.functions import b2u, u2b, PY2
 
 valid_keys = [ "DefaultZone", "MinimalMark", "CleanupOnExit", "Lockdown", 
-               "IPv6_rpfilter", "IndividualCalls", "LogDenied" ]
+               "IPv6_rpfilter", "IndividualCalls", "LogDenied",
+               "ForwardPortMarks", "ParallelConfigLoading",
+               "GroupCommitWindow", "GroupCommitMaxBatch" ]
 
 class firewalld_conf(object):
     def __init__(self, filename):
         self._config = { }
         self._deleted = [ ]
+        self._shared = False
         self.filename = filename
         self.clear()
 
+    def __copy__(self):
+        # copy-on-write: config and deleted are shared until set is used
+        obj = firewalld_conf(self.filename)
+        obj._config = self._config
+        obj._deleted = self._deleted
+        obj._shared = self._shared = True
+        return obj
+
     def clear(self):
         self._config = { }
         self._deleted = [ ]
+        self._shared = False
 
     def cleanup(self):
-        self._config.clear()
-        self._deleted = [ ]
+        self.clear()
 
     def get(self, key):
         return self._config.get(key.strip())
 
     def set(self, key, value):
         _key = b2u(key.strip())
+        if self._shared:
+            self._config = self._config.copy()
+            self._deleted = list(self._deleted)
+            self._shared = False
         self._config[_key] = b2u(value.strip())
         if _key in self._deleted:
             self._deleted.remove(_key)
@@ -80,6 +97,13 @@ class firewalld_conf(object):
             self.set("IPv6_rpfilter","yes" if FALLBACK_IPV6_RPFILTER else "no")
             self.set("IndividualCalls", FALLBACK_INDIVIDUAL_CALLS)
             self.set("LogDenied", FALLBACK_LOG_DENIED)
+            self.set("ForwardPortMarks",
+                     "yes" if FALLBACK_FORWARD_PORT_MARKS else "no")
+            self.set("ParallelConfigLoading",
+                     "yes" if FALLBACK_PARALLEL_CONFIG_LOADING else "no")
+            self.set("GroupCommitWindow", str(FALLBACK_GROUP_COMMIT_WINDOW))
+            self.set("GroupCommitMaxBatch",
+                     str(FALLBACK_GROUP_COMMIT_MAX_BATCH))
             raise
 
         for line in f:
@@ -157,6 +181,47 @@ class firewalld_conf(object):
                       value, FALLBACK_LOG_DENIED)
             self.set("LogDenied", str(FALLBACK_LOG_DENIED))
 
+        # check forward port marks
+        value = self.get("ForwardPortMarks")
+        if not value or value.lower() not in [ "yes", "true", "no", "false" ]:
+            log.error("ForwardPortMarks '%s' is not valid, using default "
+                      "value %s", value if value else '',
+                      FALLBACK_FORWARD_PORT_MARKS)
+            self.set("ForwardPortMarks",
+                     "yes" if FALLBACK_FORWARD_PORT_MARKS else "no")
+
+        # check parallel config loading
+        value = self.get("ParallelConfigLoading")
+        if not value or value.lower() not in [ "yes", "true", "no", "false" ]:
+            log.error("ParallelConfigLoading '%s' is not valid, using default "
+                      "value %s", value if value else '',
+                      FALLBACK_PARALLEL_CONFIG_LOADING)
+            self.set("ParallelConfigLoading",
+                     "yes" if FALLBACK_PARALLEL_CONFIG_LOADING else "no")
+
+        # check group commit window
+        value = self.get("GroupCommitWindow")
+        try:
+            if int(value) < 0:
+                raise ValueError(value)
+        except (TypeError, ValueError):
+            log.error("GroupCommitWindow '%s' is not valid, using default "
+                      "value '%d'", value if value else '',
+                      FALLBACK_GROUP_COMMIT_WINDOW)
+            self.set("GroupCommitWindow", str(FALLBACK_GROUP_COMMIT_WINDOW))
+
+        # check group commit max batch
+        value = self.get("GroupCommitMaxBatch")
+        try:
+            if int(value) < 1:
+                raise ValueError(value)
+        except (TypeError, ValueError):
+            log.error("GroupCommitMaxBatch '%s' is not valid, using default "
+                      "value '%d'", value if value else '',
+                      FALLBACK_GROUP_COMMIT_MAX_BATCH)
+            self.set("GroupCommitMaxBatch",
+                     str(FALLBACK_GROUP_COMMIT_MAX_BATCH))
+
     # save to self.filename if there are key/value changes
     def write(self):
         if len(self._config) < 1:
@@ -49,6 +49,8 @@ class IcmpType(IO_Object):
         "destination": [ "ipv4", "ipv6" ],
         }
 
+    __slots__ = ( "version", "short", "description", "destination" )
+
     def __init__(self):
         super(IcmpType, self).__init__()
         self.version = ""
@@ -57,6 +59,7 @@ class IcmpType(IO_Object):
         self.destination = [ ]
 
     def cleanup(self):
+        self._forget_shared()
         self.version = ""
         self.short = ""
         self.description = ""
@@ -28,11 +28,130 @@ from firewall.config import *
 from firewall.errors import *
 from firewall import functions
 from firewall.functions import b2u
+from firewall.fw_types import LastUpdatedOrderedDict
 
 PY2 = sys.version < '3'
 
+def _immutable(structure):
+    if type(structure) == tuple:
+        return all(_immutable(x) for x in structure)
+    return type(structure) not in [ list, dict ]
+
+def copy_value(value, structure=None):
+    """ Copy value, that is following structure of IMPORT_EXPORT_STRUCTURE.
+        Strings, numbers and tuples of them are immutable and therefore not
+        copied, lists and dicts of these only need a shallow copy.
+    """
+    if type(structure) == list and _immutable(structure[0]):
+        return copy.copy(value)
+    if type(structure) == dict and _immutable(list(structure.items())[0]):
+        return copy.copy(value)
+    if isinstance(value, (list, dict)):
+        return copy.deepcopy(value)
+    return value
+
+_slot_names = { }
+
+def slot_names(cls):
+    """ Names of the slots of cls and its base classes """
+    if cls not in _slot_names:
+        names = [ ]
+        for _cls in cls.__mro__:
+            for name in _cls.__dict__.get("__slots__", ( )):
+                if name not in names:
+                    names.append(name)
+        _slot_names[cls] = names
+    return _slot_names[cls]
+
+def _type_error(config, _type):
+    return FirewallError(INVALID_TYPE, "'%s' not of type %s, but %s" % \
+                         (config, _type, type(config)))
+
+def compile_structure_check(structure):
+    """ Create a function, that is checking if a config value is following
+        structure of IMPORT_EXPORT_STRUCTURE. The function raises a
+        FirewallError with INVALID_TYPE if not.
+    """
+    _type = type(structure)
+
+    if _type == list:
+        # same type elements, else struct
+        if len(structure) != 1:
+            def check(config):
+                if type(config) != _type:
+                    raise _type_error(config, _type)
+                raise FirewallError(INVALID_TYPE,
+                                    "len('%s') != 1" % structure)
+        elif type(structure[0]) not in [ list, tuple, dict ]:
+            element_type = type(structure[0])
+            def check(config):
+                if type(config) != _type:
+                    raise _type_error(config, _type)
+                if len(set(map(type, config)) - set([ element_type ])) > 0:
+                    for x in config:
+                        if type(x) != element_type:
+                            raise _type_error(x, element_type)
+        else:
+            check_element = compile_structure_check(structure[0])
+            def check(config):
+                if type(config) != _type:
+                    raise _type_error(config, _type)
+                for x in config:
+                    check_element(x)
+
+    elif _type == tuple:
+        checks = [ compile_structure_check(x) for x in structure ]
+        def check(config):
+            if type(config) != _type:
+                raise _type_error(config, _type)
+            if len(config) != len(checks):
+                raise FirewallError(INVALID_TYPE,
+                                    "len('%s') != %d" % (config, len(checks)))
+            for i,x in enumerate(config):
+                checks[i](x)
+
+    elif _type == dict:
+        # only one key value pair in structure
+        (skey, svalue) = list(structure.items())[0]
+        key_type = type(skey)
+        value_type = type(svalue)
+        def check(config):
+            if type(config) != _type:
+                raise _type_error(config, _type)
+            for (key, value) in config.items():
+                if type(key) != key_type:
+                    raise _type_error(key, key_type)
+                if type(value) != value_type:
+                    raise _type_error(value, value_type)
+
+    else:
+        def check(config):
+            if type(config) != _type:
+                raise _type_error(config, _type)
+
+    return check
+
+_structure_checks = { }
+
+def structure_checks(cls):
+    """ Compiled checks for the elements of IMPORT_EXPORT_STRUCTURE of cls """
+    if cls not in _structure_checks:
+        _structure_checks[cls] = [ compile_structure_check(value) for
+                                   (element, value) in
+                                   cls.IMPORT_EXPORT_STRUCTURE ]
+    return _structure_checks[cls]
+
 class IO_Object(object):
-    """ Abstract IO_Object as base for icmptype, service and zone """
+    """ Abstract IO_Object as base for icmptype, service and zone
+
+    Copies of an IO_Object created with copy.copy are copy-on-write: The
+    lists and dicts of the objects are shared until one of the objects is
+    going to modify them in place, which has to be prepared with unshare.
+    Attributes that are replaced by setattr do not need to be unshared.
+
+    The attributes of the objects are stored in slots, sub classes have to
+    declare all attributes they are using in __slots__.
+    """
 
     IMPORT_EXPORT_STRUCTURE = ( )
     DBUS_SIGNATURE = '()'
@@ -40,25 +159,68 @@ class IO_Object(object):
     PARSER_REQUIRED_ELEMENT_ATTRS = { }
     PARSER_OPTIONAL_ELEMENT_ATTRS = { }
 
+    # _shared: names of the lists and dicts shared with copies of the object
+    __slots__ = ( "filename", "path", "name", "builtin", "default", "_shared" )
+
     def __init__(self):
         self.filename = ""
         self.path = ""
         self.name = ""
+        self._shared = frozenset()
+
+    def __copy__(self):
+        obj = self.__class__.__new__(self.__class__)
+        values = [ (name, getattr(self, name))
+                   for name in slot_names(self.__class__)
+                   if hasattr(self, name) ]
+        if hasattr(self, "__dict__"):
+            values += list(self.__dict__.items())
+        shared = set(self._shared)
+        for (name, value) in values:
+            setattr(obj, name, value)
+            if isinstance(value, (list, dict, LastUpdatedOrderedDict)):
+                shared.add(name)
+        self._shared = obj._shared = frozenset(shared)
+        return obj
+
+    def _copy_shared(self, name, value):
+        # to be overloaded by sub classes with nested lists or dicts
+        structure = dict(self.IMPORT_EXPORT_STRUCTURE).get(name, [ "" ])
+        return copy_value(value, structure)
+
+    def unshare(self, *names):
+        """ Replace the shared lists and dicts in names (default: all) by
+            private copies, needs to be called before modifying them in place.
+        """
+        if not self._shared:
+            return
+        if not names:
+            names = self._shared
+        for name in names:
+            if name in self._shared:
+                setattr(self, name, self._copy_shared(name, getattr(self, name)))
+        self._shared = self._shared.difference(names)
+
+    def _forget_shared(self):
+        # replace shared lists and dicts by empty ones, used by cleanup
+        for name in self._shared:
+            setattr(self, name, getattr(self, name).__class__())
+        self._shared = frozenset()
 
     def export_config(self):
         ret = [ ]
-        for x in self.IMPORT_EXPORT_STRUCTURE:
-            ret.append(copy.deepcopy(getattr(self, x[0])))
+        for (element, value) in self.IMPORT_EXPORT_STRUCTURE:
+            ret.append(copy_value(getattr(self, element), value))
         return tuple(ret)
 
     def import_config(self, config):
         self.check_config(config)
         for i,(element,value) in enumerate(self.IMPORT_EXPORT_STRUCTURE):
             if isinstance(config[i], list):
-                # remove duplicates
-                setattr(self, element, copy.deepcopy(list(set(config[i]))))
+                # remove duplicates, this is creating a new list
+                setattr(self, element, list(set(config[i])))
             else:
-                setattr(self, element, copy.deepcopy(config[i]))
+                setattr(self, element, copy_value(config[i], value))
 
     def check_name(self, name):
         if type(name) != type(""):
@@ -77,45 +239,15 @@ class IO_Object(object):
             raise FirewallError(INVALID_TYPE,
                                 "structure size mismatch %d != %d" % (\
                     len(config), len(self.IMPORT_EXPORT_STRUCTURE)))
+        checks = structure_checks(self.__class__)
         for i,(element,value) in enumerate(self.IMPORT_EXPORT_STRUCTURE):
-            self._check_config_structure(config[i], value)
+            checks[i](config[i])
             self._check_config(config[i], element)
 
     def _check_config(self, config, item):
         # to be overloaded by sub classes
         return
 
-    def _check_config_structure(self, config, structure):
-        if not type(config) == type(structure):
-            raise FirewallError(INVALID_TYPE,
-                                "'%s' not of type %s, but %s" % (\
-                    config, type(structure), type(config)))
-        if type(structure) == list:
-            # same type elements, else struct
-            if len(structure) != 1:
-                raise FirewallError(INVALID_TYPE, "len('%s') != 1" % structure)
-            for x in config:
-                self._check_config_structure(x, structure[0])
-        elif type(structure) == tuple:
-            if len(structure) != len(config):
-                raise FirewallError(INVALID_TYPE,
-                                    "len('%s') != %d" % (config,
-                                                         len(structure)))
-            for i,value in enumerate(structure):
-                self._check_config_structure(config[i], value)
-        elif type(structure) == dict:
-            # only one key value pair in structure
-            (skey, svalue) = list(structure.items())[0]
-            for (key, value) in config.items():
-                if type(key) != type(skey):
-                    raise FirewallError(INVALID_TYPE,
-                                        "'%s' not of type %s, but %s" % (\
-                            key, type(skey), type(key)))
-                if type(value) != type(svalue):
-                    raise FirewallError(INVALID_TYPE,
-                                        "'%s' not of type %s, but %s" % (\
-                            value, type(svalue), type(value)))
-
     # check required elements and attributes and also optional attributes
     def parser_check_element_attrs(self, name, attrs):
         _attrs = attrs.getNames()
@@ -23,14 +23,15 @@ import xml.sax as sax
 import os
 import io
 import shutil
+import mmap
 
 from firewall.config import ETC_FIREWALLD
 from firewall.errors import *
-from firewall.functions import checkProtocol, check_address, \
-                               checkIPnMask, checkIP6nMask, u2b_if_py2, \
-                               check_mac
+from firewall.functions import checkProtocol, check_address, checkIP, \
+                               checkIP6, checkIPnMask, checkIP6nMask, \
+                               u2b_if_py2, check_mac
 from firewall.core.io.io_object import *
-from firewall.core.ipset import IPSET_TYPES
+from firewall.core.ipset import IPSET_TYPES, IPSET_RESERVED_PREFIX
 from firewall.core.logger import log
 
 class IPSet(IO_Object):
@@ -50,12 +51,16 @@ class IPSet(IO_Object):
         "ipset": [ "type" ],
         "option": [ "name" ],
         "entry": None,
+        "entries": [ "file" ],
     }
     PARSER_OPTIONAL_ELEMENT_ATTRS = {
         "ipset": [ "version" ],
         "option": [ "value" ],
     }
 
+    __slots__ = ( "version", "short", "description", "type", "entries",
+                  "entries_file", "options", "applied" )
+
     def __init__(self):
         super(IPSet, self).__init__()
         self.version = ""
@@ -63,15 +68,18 @@ class IPSet(IO_Object):
         self.description = ""
         self.type = ""
         self.entries = [ ]
+        self.entries_file = ""
         self.options = { }
         self.applied = False
 
     def cleanup(self):
+        self._forget_shared()
         self.version = ""
         self.short = ""
         self.description = ""
         self.type = ""
         del self.entries[:]
+        self.entries_file = ""
         self.options.clear()
         self.applied = False
 
@@ -85,53 +93,72 @@ class IPSet(IO_Object):
         self.type = u2b_if_py2(self.type)
         self.options = {u2b_if_py2(k):u2b_if_py2(v) for k,v in self.options.items()}
         self.entries = [u2b_if_py2(e) for e in self.entries]
+        self.entries_file = u2b_if_py2(self.entries_file)
+
+    def get_entries_file(self):
+        """ Return the absolute path of the entries file or None, relative
+            paths are relative to the directory of the ipset file.
+        """
+        if not self.entries_file:
+            return None
+        if os.path.isabs(self.entries_file):
+            return self.entries_file
+        return "%s/%s" % (self.path, self.entries_file)
 
     @staticmethod
-    def check_entry(entry, options, ipset_type):
+    def entry_checker(options, ipset_type):
+        """ Return a function to check entries of an ipset with options and
+            ipset_type, the family and type are only looked up once.
+        """
         family = "ipv4"
         if "family" in options:
             if options["family"] == "inet6":
                 family = "ipv6"
 
+        def _error(entry):
+            raise FirewallError(INVALID_ENTRY,
+                                "entry '%s' does not match ipset type '%s'" % \
+                                (entry, ipset_type))
+
+        check_ip = checkIP if family == "ipv4" else checkIP6
+        check_ipnmask = checkIPnMask if family == "ipv4" else checkIP6nMask
+
         if ipset_type == "hash:ip":
-            if "-" in entry:
-                splits = entry.split("-")
-                if len(splits) != 2:
-                    raise FirewallError(
-                        INVALID_ENTRY,
-                        "entry '%s' does not match ipset type '%s'" % \
-                        (entry, ipset_type))
-                for split in splits:
-                    if (family == "ipv4" and not checkIP(entry)) or \
-                       (family == "ipv6" and not checkIP6(entry)):
-                        raise FirewallError(
-                            INVALID_ENTRY,
-                            "entry '%s' does not match ipset type '%s'" % \
-                            (entry, ipset_type))
-            else:
-                if (family == "ipv4" and not checkIPnMask(entry)) or \
-                   (family == "ipv6" and not checkIP6nMask(entry)):
-                    raise FirewallError(
-                        INVALID_ENTRY,
-                        "entry '%s' does not match ipset type '%s'" % \
-                        (entry, ipset_type))
+            def check(entry):
+                if "-" in entry:
+                    splits = entry.split("-")
+                    if len(splits) != 2:
+                        _error(entry)
+                    for split in splits:
+                        if not check_ip(split):
+                            _error(entry)
+                elif not check_ipnmask(entry):
+                    _error(entry)
         elif ipset_type == "hash:net":
-            if (family == "ipv4" and not checkIPnMask(entry)) or \
-               (family == "ipv6" and not checkIP6nMask(entry)):
-                raise FirewallError(
-                    INVALID_ENTRY,
-                    "entry '%s' does not match ipset type '%s'" % \
-                    (entry, ipset_type))
+            def check(entry):
+                if not check_ipnmask(entry):
+                    _error(entry)
         elif ipset_type == "hash:mac":
-            # ipset does not allow to add 00:00:00:00:00:00
-            if not check_mac(entry) or entry == "00:00:00:00:00:00":
-                raise FirewallError(
-                    INVALID_ENTRY,
-                    "entry '%s' does not match ipset type '%s'" % \
-                    (entry, ipset_type))
+            def check(entry):
+                # ipset does not allow to add 00:00:00:00:00:00
+                if not check_mac(entry) or entry == "00:00:00:00:00:00":
+                    _error(entry)
         else:
-            raise FirewallError(INVALID_IPSET,
-                                "ipset type '%s' not usable" % ipset_type)
+            def check(entry):
+                raise FirewallError(INVALID_IPSET,
+                                    "ipset type '%s' not usable" % ipset_type)
+        return check
+
+    @staticmethod
+    def check_entry(entry, options, ipset_type):
+        IPSet.entry_checker(options, ipset_type)(entry)
+
+    def check_name(self, name):
+        super(IPSet, self).check_name(name)
+        if name.startswith(IPSET_RESERVED_PREFIX):
+            raise FirewallError(INVALID_NAME,
+                                "'%s' is reserved for internal ipsets" % \
+                                IPSET_RESERVED_PREFIX)
 
     def _check_config(self, config, item):
         if item == "type":
@@ -140,8 +167,9 @@ class IPSet(IO_Object):
                                     "'%s' is not valid ipset type" % config)
 
     def import_config(self, config):
+        check = IPSet.entry_checker(config[4], config[3])
         for entry in config[5]:
-            IPSet.check_entry(entry, config[4], config[3])
+            check(entry)
         super(IPSet, self).import_config(config)
 
 # PARSER
@@ -193,13 +221,16 @@ class ipset_ContentHandler(IO_Object_ContentHandler):
                 log.warning("Option %s already set, ignoring.", attrs["name"])
         elif name == "entry":
             pass
+        elif name == "entries":
+            if self.item.entries_file:
+                log.warning("Entries file already set, ignoring.")
+            else:
+                self.item.entries_file = attrs["file"]
     def endElement(self, name):
         IO_Object_ContentHandler.endElement(self, name)
         if name == "entry":
-            if self._element not in self.item.entries:
-                self.item.entries.append(self._element)
-            else:
-                log.warning("Entry %s already set, ignoring.", self._element)
+            # duplicates are removed in ipset_reader
+            self.item.entries.append(self._element)
 
 def ipset_reader(filename, path):
     ipset = IPSet()
@@ -224,15 +255,27 @@ def ipset_reader(filename, path):
         # no entries visible for ipsets with timeout
         log.warning("timeout option is set, entries are removed")
         del ipset.entries[:]
-    i = 0
-    while i < len(ipset.entries):
+    # Duplicate and invalid entries are removed in place after sorting,
+    # the entries of a large ipset are only kept in this list. The order of
+    # the entries is not significant.
+    check = ipset.entry_checker(ipset.options, ipset.type)
+    entries = ipset.entries
+    entries.sort()
+    n = 0
+    last = None
+    for (i, entry) in enumerate(entries):
+        if i > 0 and entry == last:
+            log.warning("Entry %s already set, ignoring.", entry)
+            continue
+        last = entry
         try:
-            ipset.check_entry(ipset.entries[i], ipset.options, ipset.type)
+            check(entry)
         except FirewallError as e:
             log.warning("%s, ignoring.", e)
-            ipset.entries.pop(i)
-        else:
-            i += 1
+            continue
+        entries[n] = entry
+        n += 1
+    del entries[n:]
     if PY2:
         ipset.encode_strings()
 
@@ -294,6 +337,12 @@ def ipset_writer(ipset, path=None):
             handler.simpleElement("option", { "name": key })
         handler.ignorableWhitespace("\n")
 
+    # entries file
+    if ipset.entries_file:
+        handler.ignorableWhitespace("  ")
+        handler.simpleElement("entries", { "file": ipset.entries_file })
+        handler.ignorableWhitespace("\n")
+
     # entries
     for entry in ipset.entries:
         handler.ignorableWhitespace("  ")
@@ -308,3 +357,30 @@ def ipset_writer(ipset, path=None):
     handler.endDocument()
     f.close()
     del handler
+
+def ipset_entries_file_reader(filename):
+    """ Generator for the entries of an entries file: one entry per line,
+        empty lines and lines starting with '#' are ignored. The file is
+        mapped into memory and scanned line by line, it is never read as a
+        whole.
+    """
+    with open(filename, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        try:
+            size = len(data)
+            pos = 0
+            while pos < size:
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    end = size
+                line = data[pos:end].strip()
+                pos = end + 1
+                if not line or line.startswith(b"#"):
+                    continue
+                yield line if PY2 else line.decode('utf-8')
+        finally:
+            data.close()
@@ -80,6 +80,69 @@ class lockdown_whitelist_ContentHandler(IO_Object_ContentHandler):
             log.error('Unknown XML element %s' % name)
             return
 
+class _Whitelist_Matcher(object):
+    """ Compiled form of a lockdown whitelist: hash sets for the entries
+        and a prefix trie for the commands ending with '*'.
+    """
+    __slots__ = ( "commands", "contexts", "users", "uids", "prefixes" )
+
+    def __init__(self, whitelist):
+        self.commands = set(whitelist.commands)
+        self.contexts = set(whitelist.contexts)
+        self.users = set(whitelist.users)
+        self.uids = set(whitelist.uids)
+        # trie of the command prefixes: character -> node, None -> end of
+        # a prefix
+        self.prefixes = { }
+        for command in self.commands:
+            if command.endswith("*"):
+                self.add_prefix(command[:-1])
+
+    def add_prefix(self, prefix):
+        node = self.prefixes
+        for c in prefix:
+            node = node.setdefault(c, { })
+        node[None] = True
+
+    def remove_prefix(self, prefix):
+        path = [ ]
+        node = self.prefixes
+        for c in prefix:
+            path.append((node, c))
+            node = node[c]
+        del node[None]
+        # remove the nodes, that are not used anymore
+        for (parent, c) in reversed(path):
+            if parent[c]:
+                break
+            del parent[c]
+
+    def add_command(self, command):
+        self.commands.add(command)
+        if command.endswith("*"):
+            self.add_prefix(command[:-1])
+
+    def remove_command(self, command):
+        self.commands.discard(command)
+        if command.endswith("*"):
+            self.remove_prefix(command[:-1])
+
+    def match_command(self, command):
+        if command is None:
+            return False
+        if command in self.commands:
+            return True
+        node = self.prefixes
+        if None in node:
+            return True
+        for c in command:
+            if c not in node:
+                return False
+            node = node[c]
+            if None in node:
+                return True
+        return False
+
 class LockdownWhitelist(IO_Object):
     """ LockdownWhitelist class """
 
@@ -103,6 +166,9 @@ class LockdownWhitelist(IO_Object):
 #        "group": [ "id", "name" ],
         }
 
+    __slots__ = ( "parser", "commands", "contexts", "users", "uids",
+                  "_matcher" )
+
     def __init__(self, filename):
         super(LockdownWhitelist, self).__init__()
         self.filename = filename
@@ -113,6 +179,25 @@ class LockdownWhitelist(IO_Object):
         self.uids = [ ]
 #        self.gids = [ ]
 #        self.groups = [ ]
+        # compiled whitelist, created on first use and updated with the
+        # add and remove methods
+        self._matcher = None
+
+    def __copy__(self):
+        obj = super(LockdownWhitelist, self).__copy__()
+        # the compiled whitelist is not shared, it is created again for the
+        # copy if needed
+        obj._matcher = None
+        return obj
+
+    def _compiled(self):
+        if self._matcher is None:
+            self._matcher = _Whitelist_Matcher(self)
+        return self._matcher
+
+    def import_config(self, config):
+        super(LockdownWhitelist, self).import_config(config)
+        self._matcher = None
 
     def _check_config(self, config, item):
         if item in [ "commands", "contexts", "users", "uids" ]:
@@ -132,12 +217,14 @@ class LockdownWhitelist(IO_Object):
                 raise FirewallError(INVALID_UID, config)
 
     def cleanup(self):
+        self._forget_shared()
         del self.commands[:]
         del self.contexts[:]
         del self.users[:]
         del self.uids[:]
 #        del self.gids[:]
 #        del self.groups[:]
+        self._matcher = None
 
     def encode_strings(self):
         """ HACK. I haven't been able to make sax parser return
@@ -146,37 +233,37 @@ class LockdownWhitelist(IO_Object):
         self.commands = [ u2b_if_py2(x) for x in self.commands ]
         self.contexts = [ u2b_if_py2(x) for x in self.contexts ]
         self.users = [ u2b_if_py2(x) for x in self.users ]
+        self._matcher = None
 
     # commands
 
     def add_command(self, command):
         if not checkCommand(command):
             raise FirewallError(INVALID_COMMAND, command)
-        if command not in self.commands:
+        if not self.has_command(command):
+            self.unshare("commands")
             self.commands.append(command)
+            if self._matcher is not None:
+                self._matcher.add_command(command)
         else:
             raise FirewallError(ALREADY_ENABLED,
                                 'Command "%s" already in whitelist' % command)
 
     def remove_command(self, command):
-        if command in self.commands:
+        if self.has_command(command):
+            self.unshare("commands")
             self.commands.remove(command)
+            if self._matcher is not None:
+                self._matcher.remove_command(command)
         else:
             raise FirewallError(NOT_ENABLED,
                                 'Command "%s" not in whitelist.' % command)
 
     def has_command(self, command):
-        return (command in self.commands)
+        return (command in self._compiled().commands)
 
     def match_command(self, command):
-        for _command in self.commands:
-            if _command.endswith("*"):
-                if command.startswith(_command[:-1]):
-                    return True
-            else:
-                if _command == command:
-                    return True
-        return False
+        return self._compiled().match_command(command)
 
     def get_commands(self):
         return sorted(self.commands)
@@ -186,25 +273,31 @@ class LockdownWhitelist(IO_Object):
     def add_uid(self, uid):
         if not checkUid(uid):
             raise FirewallError(INVALID_UID, str(uid))
-        if uid not in self.uids:
+        if not self.has_uid(uid):
+            self.unshare("uids")
             self.uids.append(uid)
+            if self._matcher is not None:
+                self._matcher.uids.add(uid)
         else:
             raise FirewallError(ALREADY_ENABLED,
                                 'Uid "%s" already in whitelist' % uid)
 
 
     def remove_uid(self, uid):
-        if uid in self.uids:
+        if self.has_uid(uid):
+            self.unshare("uids")
             self.uids.remove(uid)
+            if self._matcher is not None:
+                self._matcher.uids.discard(uid)
         else:
             raise FirewallError(NOT_ENABLED,
                                 'Uid "%s" not in whitelist.' % uid)
 
     def has_uid(self, uid):
-        return (uid in self.uids)
+        return (uid in self._compiled().uids)
 
     def match_uid(self, uid):
-        return (uid in self.uids)
+        return (uid in self._compiled().uids)
 
     def get_uids(self):
         return sorted(self.uids)
@@ -214,25 +307,31 @@ class LockdownWhitelist(IO_Object):
     def add_user(self, user):
         if not checkUser(user):
             raise FirewallError(INVALID_USER, user)
-        if user not in self.users:
+        if not self.has_user(user):
+            self.unshare("users")
             self.users.append(user)
+            if self._matcher is not None:
+                self._matcher.users.add(user)
         else:
             raise FirewallError(ALREADY_ENABLED,
                                 'User "%s" already in whitelist' % user)
 
 
     def remove_user(self, user):
-        if user in self.users:
+        if self.has_user(user):
+            self.unshare("users")
             self.users.remove(user)
+            if self._matcher is not None:
+                self._matcher.users.discard(user)
         else:
             raise FirewallError(NOT_ENABLED,
                                 'User "%s" not in whitelist.' % user)
 
     def has_user(self, user):
-        return (user in self.users)
+        return (user in self._compiled().users)
 
     def match_user(self, user):
-        return (user in self.users)
+        return (user in self._compiled().users)
 
     def get_users(self):
         return sorted(self.users)
@@ -286,25 +385,31 @@ class LockdownWhitelist(IO_Object):
     def add_context(self, context):
         if not checkContext(context):
             raise FirewallError(INVALID_CONTEXT, context)
-        if context not in self.contexts:
+        if not self.has_context(context):
+            self.unshare("contexts")
             self.contexts.append(context)
+            if self._matcher is not None:
+                self._matcher.contexts.add(context)
         else:
             raise FirewallError(ALREADY_ENABLED,
                                 'Context "%s" already in whitelist' % context)
 
 
     def remove_context(self, context):
-        if context in self.contexts:
+        if self.has_context(context):
+            self.unshare("contexts")
             self.contexts.remove(context)
+            if self._matcher is not None:
+                self._matcher.contexts.discard(context)
         else:
             raise FirewallError(NOT_ENABLED,
                                 'Context "%s" not in whitelist.' % context)
 
     def has_context(self, context):
-        return (context in self.contexts)
+        return (context in self._compiled().contexts)
 
     def match_context(self, context):
-        return (context in self.contexts)
+        return (context in self._compiled().contexts)
 
     def get_contexts(self):
         return sorted(self.contexts)
@@ -56,6 +56,9 @@ class Service(IO_Object):
         "destination": [ "ipv4", "ipv6" ],
         }
 
+    __slots__ = ( "version", "short", "description", "ports", "protocols",
+                  "modules", "destination" )
+
     def __init__(self):
         super(Service, self).__init__()
         self.version = ""
@@ -67,6 +70,7 @@ class Service(IO_Object):
         self.destination = { }
 
     def cleanup(self):
+        self._forget_shared()
         self.version = ""
         self.short = ""
         self.description = ""
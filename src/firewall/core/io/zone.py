@@ -22,6 +22,7 @@ import xml.sax as sax
 import os
 import io
 import shutil
+import collections
 
 from firewall.config import ETC_FIREWALLD
 from firewall.errors import *
@@ -84,6 +85,11 @@ class Zone(IO_Object):
         "reject": [ "type" ],
         }
 
+    __slots__ = ( "version", "short", "description", "UNUSED", "target",
+                  "services", "ports", "protocols", "icmp_blocks", "masquerade",
+                  "forward_ports", "interfaces", "sources", "fw_config",
+                  "rules", "combined", "applied", "settings" )
+
     @staticmethod
     def index_of (element):
         for i, (el, val) in enumerate(Zone.IMPORT_EXPORT_STRUCTURE):
@@ -107,11 +113,12 @@ class Zone(IO_Object):
         self.interfaces = [ ]
         self.sources = [ ]
         self.fw_config = None # to be able to check services and a icmp_blocks
-        self.rules = [ ]
+        self.rules = collections.OrderedDict() # canonical form: rule
         self.combined = False
         self.applied = False
 
     def cleanup(self):
+        self._forget_shared()
         self.version = ""
         self.short = ""
         self.description = ""
@@ -126,7 +133,7 @@ class Zone(IO_Object):
         del self.interfaces[:]
         del self.sources[:]
         self.fw_config = None # to be able to check services and a icmp_blocks
-        del self.rules[:]
+        self.rules.clear()
         self.combined = False
         self.applied = False
 
@@ -145,26 +152,26 @@ class Zone(IO_Object):
         self.forward_ports = [(u2b_if_py2(p1),u2b_if_py2(p2),u2b_if_py2(p3),u2b_if_py2(p4)) for (p1,p2,p3,p4) in self.forward_ports]
         self.interfaces = [u2b_if_py2(i) for i in self.interfaces]
         self.sources = [u2b_if_py2(s) for s in self.sources]
-        self.rules = [u2b_if_py2(s) for s in self.rules]
 
-    def __getattr__(self, name):
-        if name == "rules_str":
-            rules_str = [str(rule) for rule in self.rules]
-            return rules_str
-        else:
-            return object.__getattr__(self, name)
+    @property
+    def rules_str(self):
+        return [str(rule) for rule in self.rules.values()]
 
-    def __setattr__(self, name, value):
-        if name == "rules_str":
-            self.rules = [Rich_Rule(rule_str=s) for s in value]
-        else:
-            object.__setattr__(self, name, value)
+    @rules_str.setter
+    def rules_str(self, value):
+        rules = collections.OrderedDict()
+        for s in value:
+            rule = rich_rule_cache.get(s)
+            rules.setdefault(rule.canonical(), rule)
+        self.rules = rules
+
+    def query_rule(self, rule):
+        return rule.canonical() in self.rules
 
     def _check_config(self, config, item):
         if item == "services" and self.fw_config:
-            existing_services = self.fw_config.get_services()
             for service in config:
-                if not service in existing_services:
+                if not self.fw_config.query_service(service):
                     raise FirewallError(INVALID_SERVICE,
                                   "'%s' not among existing services" % service)
         elif item == "ports":
@@ -175,9 +182,8 @@ class Zone(IO_Object):
             for proto in config:
                 check_protocol(proto)
         elif item == "icmp_blocks" and self.fw_config:
-            existing_icmptypes = self.fw_config.get_icmptypes()
             for icmptype in config:
-                if not icmptype in existing_icmptypes:
+                if not self.fw_config.query_icmptype(icmptype):
                     raise FirewallError(INVALID_ICMPTYPE,
                                "'%s' not among existing icmp types" % icmptype)
         elif item == "forward_ports":
@@ -207,7 +213,7 @@ class Zone(IO_Object):
                     raise FirewallError(INVALID_ADDR, source)
         elif item == "rules_str":
             for rule in config:
-                Rich_Rule(rule_str=rule)
+                rich_rule_cache.get(rule)
 
     def check_name(self, name):
         super(Zone, self).check_name(name)
@@ -222,6 +228,7 @@ class Zone(IO_Object):
                                 "'%s' has %d chars, max is %d" % (name, len(name), max_zone_name_len()))
 
     def combine(self, zone):
+        self.unshare()
         self.combined = True
         self.filename = None
         self.version = ""
@@ -251,8 +258,8 @@ class Zone(IO_Object):
         for forward in zone.forward_ports:
             if forward not in self.forward_ports:
                 self.forward_ports.append(forward)
-        for rule in zone.rules:
-            self.rules.append(rule)
+        for (key, rule) in zone.rules.items():
+            self.rules.setdefault(key, rule)
 
 # PARSER
 
@@ -297,7 +304,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                                 str(self._rule))
                     self._rule_error = True
                     return
-                self._rule.element = Rich_Service(attrs["name"])
+                self._rule = self._rule.replace(
+                    element=Rich_Service(attrs["name"]))
                 return
             if attrs["name"] not in self.item.services:
                 self.item.services.append(attrs["name"])
@@ -312,8 +320,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                                 str(self._rule))
                     self._rule_error = True
                     return
-                self._rule.element = Rich_Port(attrs["port"],
-                                               attrs["protocol"])
+                self._rule = self._rule.replace(
+                    element=Rich_Port(attrs["port"], attrs["protocol"]))
                 return
             check_port(attrs["port"])
             check_tcpudp(attrs["protocol"])
@@ -331,7 +339,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                                 str(self._rule))
                     self._rule_error = True
                     return
-                self._rule.element = Rich_Protocol(attrs["value"])
+                self._rule = self._rule.replace(
+                    element=Rich_Protocol(attrs["value"]))
             else:
                 check_protocol(attrs["value"])
                 if attrs["value"] not in self.item.protocols:
@@ -346,7 +355,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                                 str(self._rule))
                     self._rule_error = True
                     return
-                self._rule.element = Rich_IcmpBlock(attrs["name"])
+                self._rule = self._rule.replace(
+                    element=Rich_IcmpBlock(attrs["name"]))
                 return
             if attrs["name"] not in self.item.icmp_blocks:
                 self.item.icmp_blocks.append(attrs["name"])
@@ -364,7 +374,7 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                                 str(self._rule))
                     self._rule_error = True
                     return
-                self._rule.element = Rich_Masquerade()
+                self._rule = self._rule.replace(element=Rich_Masquerade())
             else:
                 if self.item.masquerade:
                     log.warning("Masquerade already set, ignoring.")
@@ -385,9 +395,9 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                                 str(self._rule))
                     self._rule_error = True
                     return
-                self._rule.element = Rich_ForwardPort(attrs["port"],
-                                                      attrs["protocol"],
-                                                      to_port, to_addr)
+                self._rule = self._rule.replace(
+                    element=Rich_ForwardPort(attrs["port"], attrs["protocol"],
+                                             to_port, to_addr))
                 return
 
             check_port(attrs["port"])
@@ -444,7 +454,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                     mac = attrs["mac"]
                 if "ipset" in attrs:
                     ipset = attrs["ipset"]
-                self._rule.source = Rich_Source(addr, mac, ipset, invert=invert)
+                self._rule = self._rule.replace(
+                    source=Rich_Source(addr, mac, ipset, invert=invert))
                 return
             # zone bound to source
             if "address" not in attrs and not "ipset" in attrs:
@@ -492,8 +503,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
             if "invert" in attrs and \
                     attrs["invert"].lower() in [ "yes", "true" ]:
                 invert = True
-            self._rule.destination = Rich_Destination(attrs["address"],
-                                                      invert)
+            self._rule = self._rule.replace(
+                destination=Rich_Destination(attrs["address"], invert))
 
         elif name in [ "accept", "reject", "drop", "mark" ]:
             if not self._rule:
@@ -505,18 +516,19 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                 self._rule_error = True
                 return
             if name == "accept":
-                self._rule.action = Rich_Accept()
+                action = Rich_Accept()
             elif name == "reject":
                 _type = None
                 if "type" in attrs:
                     _type = attrs["type"]
-                self._rule.action = Rich_Reject(_type)
+                action = Rich_Reject(_type)
             elif name == "drop":
-                self._rule.action = Rich_Drop()
+                action = Rich_Drop()
             elif name == "mark":
                 _set = attrs["set"]
-                self._rule.action = Rich_Mark(_set)
-            self._limit_ok = self._rule.action
+                action = Rich_Mark(_set)
+            self._rule = self._rule.replace(action=action)
+            self._limit_ok = "action"
 
         elif name == "log":
             if not self._rule:
@@ -534,8 +546,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                     self._rule_error = True
                     return
             prefix = attrs["prefix"] if "prefix" in attrs else None
-            self._rule.log = Rich_Log(prefix, level)
-            self._limit_ok = self._rule.log
+            self._rule = self._rule.replace(log=Rich_Log(prefix, level))
+            self._limit_ok = "log"
 
         elif name == "audit":
             if not self._rule:
@@ -546,8 +558,8 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                             str(self._rule))
                 self._rule_error = True
                 return            
-            self._rule.audit = Rich_Audit()
-            self._limit_ok = self._rule.audit
+            self._rule = self._rule.replace(audit=Rich_Audit())
+            self._limit_ok = "audit"
 
         elif name == "rule":
             family = None
@@ -565,13 +577,16 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                 log.warning('Invalid rule: Limit outside of action, log and audit')
                 self._rule_error = True
                 return
-            if self._limit_ok.limit:
+            # the limit is part of the action, log or audit element
+            part = getattr(self._rule, self._limit_ok)
+            if part.limit:
                 log.warning("Invalid rule: More than one limit in rule '%s', ignoring.",
                             str(self._rule))
                 self._rule_error = True
                 return
             value = attrs["value"]
-            self._limit_ok.limit = Rich_Limit(value)
+            self._rule = self._rule.replace(
+                **{ self._limit_ok: part.replace(limit=Rich_Limit(value)) })
 
         else:
             log.warning("Unknown XML element '%s'", name)
@@ -587,9 +602,9 @@ class zone_ContentHandler(IO_Object_ContentHandler):
                 except Exception as e:
                     log.warning("%s: %s", e, str(self._rule))
                 else:
-                    if str(self._rule) not in \
-                       [ str(x) for x in self.item.rules ]:
-                        self.item.rules.append(self._rule)
+                    key = self._rule.canonical()
+                    if key not in self.item.rules:
+                        self.item.rules[key] = self._rule
                     else:
                         log.warning("Rule '%s' already set, ignoring.",
                                     str(self._rule))
@@ -730,7 +745,7 @@ def zone_writer(zone, path=None):
         handler.ignorableWhitespace("\n")
 
     # rules
-    for rule in zone.rules:
+    for rule in zone.rules.values():
         attrs = { }
         if rule.family:
             attrs["family"] = rule.family
@@ -20,13 +20,17 @@
 #
 
 import os.path
+import socket
+import binascii
 
-from firewall.core.prog import runProg
+from firewall.core.prog import runProg, runProgStream
 from firewall.core.logger import log
-from firewall.functions import tempFile, readfile
 from firewall.config import COMMANDS
 
 IPSET_MAXNAMELEN = 32
+# prefix of the ipsets firewalld creates internally, not usable for ipsets
+# of the configuration
+IPSET_RESERVED_PREFIX = "fwd_"
 IPSET_TYPES = [
     # bitmap and set types are currently not supported
     # "bitmap:ip",
@@ -48,6 +52,10 @@ IPSET_TYPES = [
 
     "hash:mac",
 ]
+# additional types, that are only used for ipsets managed by firewalld
+IPSET_MANAGED_TYPES = [
+    "hash:net,port",
+]
 IPSET_CREATE_OPTIONS = {
     "family": "inet|inet6",
     "hashsize": "value",
@@ -96,7 +104,7 @@ class ipset:
         return ret
 
     def check_type(self, type_name):
-        if len(type_name) > IPSET_MAXNAMELEN or type_name not in IPSET_TYPES:
+        if len(type_name) > IPSET_MAXNAMELEN or type_name not in IPSET_TYPES + IPSET_MANAGED_TYPES:
             raise FirewallError(INVALID_TYPE,
                                 "ipset type name '%s' is not valid" % type_name)
 
@@ -119,19 +127,19 @@ class ipset:
     def add(self, set_name, entry, options=None):
         args = [ "add", set_name, entry ]
         if options:
-            args.append("%s" % " ".join(options))
+            args += options
         return self.__run(args)
 
     def delete(self, set_name, entry, options=None):
         args = [ "del", set_name, entry ]
         if options:
-            args.append("%s" % " ".join(options))
+            args += options
         return self.__run(args)
 
     def test(self, set_name, entry, options=None):
         args = [ "test", set_name, entry ]
         if options:
-            args.append("%s" % " ".join(options))
+            args += options
         return self.__run(args)
 
     def list(self, set_name=None):
@@ -140,6 +148,23 @@ class ipset:
             args.append(set_name)
         return self.__run(args).split()
 
+    def names(self):
+        """ Return the names of the sets in the kernel """
+        return self.__run([ "list", "-n" ]).split()
+
+    def get_entries(self, set_name):
+        """ Return the entries of the set as listed by ipset """
+        entries = [ ]
+        in_members = False
+        for line in self.__run([ "list", set_name ]).splitlines():
+            if in_members:
+                splits = line.split()
+                if splits:
+                    entries.append(splits[0])
+            elif line.startswith("Members:"):
+                in_members = True
+        return entries
+
     def save(self, set_name=None):
         args = [ "save" ]
         if set_name:
@@ -148,10 +173,32 @@ class ipset:
 
     def restore(self, set_name, type_name, entries,
                 create_options=None, entry_options=None):
+        """ Create the set if it does not exist and add the entries with one
+            ipset restore call. The entries are streamed to ipset, they can
+            be given by a generator. Existing entries are ignored.
+        """
         self.check_name(set_name)
         self.check_type(type_name)
 
-        temp_file = tempFile()
+        log.debug2("%s: %s restore %s", self.__class__, self._command,
+                   set_name)
+
+        args = [ "restore" ]
+        (status, ret) = runProgStream(self._command, args,
+                                      self.__restore_lines(set_name,
+                                                           type_name,
+                                                           entries,
+                                                           create_options,
+                                                           entry_options))
+
+        if status != 0:
+            raise ValueError("'%s %s' failed: %s" % (self._command,
+                                                     " ".join(args), ret))
+        return ret
+
+    def __restore_lines(self, set_name, type_name, entries,
+                        create_options, entry_options):
+        debug = log.getDebugLogLevel() > 2
 
         if ' ' in set_name:
             set_name = "'%s'" % set_name
@@ -161,46 +208,61 @@ class ipset:
                 args.append(k)
                 if v != "":
                     args.append(v)
-        temp_file.write("%s\n" % " ".join(args))
-
+        line = "%s\n" % " ".join(args)
+        if debug:
+            log.debug3("%8d: %s" % (1, line), nofmt=1, nl=0)
+        yield line
+
+        if entry_options:
+            fmt = "add %s %%s %s -exist\n" % (set_name,
+                                               " ".join(entry_options))
+        else:
+            fmt = "add %s %%s -exist\n" % set_name
+        i = 1
         for entry in entries:
             if ' ' in entry:
                 entry = "'%s'" % entry
-            if entry_options:
-                temp_file.write("add %s %s %s\n" % (set_name, entry,
-                                                    " ".join(entry_options)))
-            else:
-                temp_file.write("add %s %s\n" % (set_name, entry))
-        temp_file.close()
+            line = fmt % entry
+            if debug:
+                i += 1
+                log.debug3("%8d: %s" % (i, line), nofmt=1, nl=0)
+            yield line
+
+    def update(self, set_name, added, removed):
+        """ Add and remove entries of an existing set with one ipset restore
+            call. Existing added and missing removed entries are ignored.
+        """
+        self.check_name(set_name)
 
-        stat = os.stat(temp_file.name)
         log.debug2("%s: %s restore %s", self.__class__, self._command,
-                   "%s: %d" % (temp_file.name, stat.st_size))
+                   set_name)
 
         args = [ "restore" ]
-        (status, ret) = runProg(self._command, args,
-                                stdin=temp_file.name)
-
-        if log.getDebugLogLevel() > 2:
-            try:
-                lines = readfile(temp_file.name)
-            except:
-                pass
-            else:
-                i = 1
-                for line in readfile(temp_file.name):
-                    log.debug3("%8d: %s" % (i, line), nofmt=1, nl=0)
-                    if not line.endswith("\n"):
-                        log.debug3("", nofmt=1)
-                    i += 1
-
-        os.unlink(temp_file.name)
-
+        (status, ret) = runProgStream(self._command, args,
+                                      self.__update_lines(set_name, added,
+                                                          removed))
         if status != 0:
             raise ValueError("'%s %s' failed: %s" % (self._command,
                                                      " ".join(args), ret))
         return ret
 
+    def __update_lines(self, set_name, added, removed):
+        debug = log.getDebugLogLevel() > 2
+
+        if ' ' in set_name:
+            set_name = "'%s'" % set_name
+        i = 0
+        for (command, entries) in [ ("del", removed), ("add", added) ]:
+            fmt = "%s %s %%s -exist\n" % (command, set_name)
+            for entry in entries:
+                if ' ' in entry:
+                    entry = "'%s'" % entry
+                line = fmt % entry
+                if debug:
+                    i += 1
+                    log.debug3("%8d: %s" % (i, line), nofmt=1, nl=0)
+                yield line
+
     def flush(self, set_name):
         args = [ "flush" ]
         if set_name:
@@ -216,8 +278,93 @@ class ipset:
     def version(self):
         return self.__run([ "version" ])
 
+class ipset_journal(object):
+    """ ipset backend recording the changes of the sets to undo them
+
+    The calls are passed to the backend. undo destroys the sets created with
+    restore, deletes the added entries and adds the deleted entries again.
+    Destroyed sets are not restored.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._undo = [ ] # (func, args)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def restore(self, set_name, type_name, entries,
+                create_options=None, entry_options=None):
+        created = set_name not in self.backend.names()
+        ret = self.backend.restore(set_name, type_name, entries,
+                                   create_options, entry_options)
+        if created:
+            self._undo.append((self.backend.destroy, (set_name, )))
+        return ret
+
+    def add(self, set_name, entry, options=None):
+        if options and "-exist" in options:
+            # the entry might be there already
+            try:
+                self.backend.test(set_name, entry)
+            except Exception:
+                pass
+            else:
+                return self.backend.add(set_name, entry, options)
+        ret = self.backend.add(set_name, entry, options)
+        self._undo.append((self.backend.delete, (set_name, entry)))
+        return ret
+
+    def delete(self, set_name, entry, options=None):
+        ret = self.backend.delete(set_name, entry, options)
+        self._undo.append((self.backend.add, (set_name, entry)))
+        return ret
+
+    def undo(self):
+        """ Undo the recorded changes in reverse order """
+        undo = self._undo
+        self._undo = [ ]
+        for (func, args) in reversed(undo):
+            try:
+                func(*args)
+            except Exception as msg:
+                log.error("Failed to undo ipset change: %s", msg)
+
+def normalize_entry(entry, ipset_type, family="ipv4"):
+    """ Return the entry as it is listed by ipset for a set of ipset_type,
+        or None if the kernel is splitting the entry up (ranges and
+        networks in hash:ip sets).
+    """
+    if ipset_type == "hash:mac":
+        return entry.upper()
+    if ipset_type not in [ "hash:ip", "hash:net" ] or "-" in entry:
+        return None
+
+    (af, bits) = (socket.AF_INET6, 128) if family == "ipv6" \
+                 else (socket.AF_INET, 32)
+    if "/" in entry:
+        (addr, mask) = entry.split("/", 1)
+        try:
+            mask = int(mask)
+        except ValueError:
+            return None
+    else:
+        (addr, mask) = (entry, bits)
+    try:
+        data = socket.inet_pton(af, addr)
+    except (socket.error, ValueError):
+        return None
+    if mask == bits:
+        return socket.inet_ntop(af, data)
+    if ipset_type == "hash:ip" or mask < 0 or mask > bits:
+        return None
+    # the kernel clears the host bits of networks
+    value = int(binascii.hexlify(data), 16)
+    value &= ((1 << bits) - 1) ^ ((1 << (bits - mask)) - 1)
+    data = binascii.unhexlify("%0*x" % (bits // 4, value))
+    return "%s/%d" % (socket.inet_ntop(af, data), mask)
 
 def check_ipset_name(ipset):
-    if len(ipset) > IPSET_MAXNAMELEN:
+    if len(ipset) > IPSET_MAXNAMELEN or \
+       ipset.startswith(IPSET_RESERVED_PREFIX):
         return False
     return True
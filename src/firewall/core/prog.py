@@ -20,6 +20,8 @@
 #
 
 import os
+import errno
+import tempfile
 
 def runProg(prog, argv=[ ], stdin=None):
     args = [ prog ] + argv
@@ -55,3 +57,63 @@ def runProg(prog, argv=[ ], stdin=None):
 
     cret = cret.rstrip().decode('utf-8', 'replace')
     return (status, cret)
+
+def runProgStream(prog, argv=[ ], lines=[ ], chunk_size=65536):
+    """ Run prog with lines streamed to its stdin in chunks of about
+        chunk_size bytes. lines can be any iterable of strings, it is only
+        consumed while writing, so that the input is never in memory at
+        once. Returns (status, output) like runProg.
+    """
+    args = [ prog ] + argv
+
+    # the output is collected in a file, the child is not blocked by a full
+    # output pipe while we are still writing its input
+    out_file = tempfile.TemporaryFile()
+    (rfd, wfd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(wfd)
+            if rfd != 0:
+                os.dup2(rfd, 0)
+                os.close(rfd)
+            os.dup2(out_file.fileno(), 1)
+            os.dup2(1, 2)
+            e = { "LANG": "C" }
+            os.execve(args[0], args, e)
+        finally:
+            os._exit(255)
+    os.close(rfd)
+
+    def _write(data):
+        data = data.encode('utf-8')
+        while data:
+            data = data[os.write(wfd, data):]
+
+    try:
+        try:
+            chunk = [ ]
+            size = 0
+            for line in lines:
+                chunk.append(line)
+                size += len(line)
+                if size >= chunk_size:
+                    _write("".join(chunk))
+                    chunk = [ ]
+                    size = 0
+            if chunk:
+                _write("".join(chunk))
+        except OSError as msg:
+            # the child stopped reading, the status is reporting the error
+            if msg.errno != errno.EPIPE:
+                raise
+    finally:
+        os.close(wfd)
+        (cpid, status) = os.waitpid(pid, 0)
+
+    out_file.seek(0)
+    cret = out_file.read()
+    out_file.close()
+
+    cret = cret.rstrip().decode('utf-8', 'replace')
+    return (status, cret)
@@ -19,6 +19,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+import re
+import socket
+import binascii
+
 from firewall import functions
 from firewall.errors import *
 from firewall.core.ipset import check_ipset_name
@@ -28,7 +33,86 @@ REJECT_TYPES = {
     "ipv6": ["icmp6-adm-prohibited", "adm-prohibited", "icmp6-no-route", "no-route", "icmp6-addr-unreachable", "addr-unreach", "icmp6-port-unreachable", "port-unreach", "tcp-reset"]
 }
 
-class Rich_Source(object):
+# reject type aliases of REJECT_TYPES
+REJECT_TYPE_ALIASES = {
+    "ipv4": { "host-prohib": "icmp-host-prohibited",
+              "net-unreach": "icmp-net-unreachable",
+              "host-unreach": "icmp-host-unreachable",
+              "port-unreach": "icmp-port-unreachable",
+              "proto-unreach": "icmp-proto-unreachable",
+              "net-prohib": "icmp-net-prohibited",
+              "tcp-rst": "tcp-reset",
+              "admin-prohib": "icmp-admin-prohibited" },
+    "ipv6": { "adm-prohibited": "icmp6-adm-prohibited",
+              "no-route": "icmp6-no-route",
+              "addr-unreach": "icmp6-addr-unreachable",
+              "port-unreach": "icmp6-port-unreachable" },
+}
+
+RICH_RULE_CACHE_SIZE = 8192
+
+class _Rich_Immutable(object):
+    """ Base class of the rule and the rule elements
+
+    The attributes are set in __init__ and can not be changed afterwards,
+    rules are shared by the rule cache. Use replace() to get a copy with
+    changed attributes.
+    """
+    __slots__ = ( "_frozen", )
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("'%s' object is immutable" %
+                                 type(self).__name__)
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("'%s' object is immutable" %
+                                 type(self).__name__)
+        object.__delattr__(self, name)
+
+    def _freeze(self):
+        object.__setattr__(self, "_frozen", True)
+
+    def _attributes(self):
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ( )):
+                if not name.startswith("_"):
+                    yield name
+
+    def replace(self, **attributes):
+        """ Copy with the given attributes replaced """
+        obj = object.__new__(type(self))
+        for name in self._attributes():
+            object.__setattr__(obj, name,
+                               attributes.pop(name, getattr(self, name)))
+        if attributes:
+            raise TypeError("'%s' object has no attribute '%s'" %
+                            (type(self).__name__, list(attributes)[0]))
+        obj._freeze()
+        return obj
+
+    # immutable objects are not copied
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name))
+                    for name in self._attributes())
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            object.__setattr__(self, name, value)
+        self._freeze()
+
+class Rich_Source(_Rich_Immutable):
+    __slots__ = ( "addr", "mac", "ipset", "invert" )
+
     def __init__(self, addr, mac, ipset, invert=False):
         self.addr = addr
         if self.addr == "":
@@ -42,6 +126,7 @@ class Rich_Source(object):
         if self.ipset == "":
             self.ipset = None
         self.invert = invert
+        self._freeze()
 
     def __str__(self):
         if self.addr:
@@ -52,52 +137,71 @@ class Rich_Source(object):
             x = ' ipset="%s"' % self.ipset
         return 'source%s%s' % (" NOT" if self.invert else "", x)
 
-class Rich_Destination(object):
+class Rich_Destination(_Rich_Immutable):
+    __slots__ = ( "addr", "invert" )
+
     def __init__(self, addr, invert=False):
         self.addr = addr
         self.invert = invert
+        self._freeze()
 
     def __str__(self):
         return 'destination %saddress="%s"' % ("not " if self.invert else "",
                                                self.addr)
 
-class Rich_Service(object):
+class Rich_Service(_Rich_Immutable):
+    __slots__ = ( "name", )
+
     def __init__(self, name):
         self.name = name
+        self._freeze()
 
     def __str__(self):
         return 'service name="%s"' % (self.name)
 
-class Rich_Port(object):
+class Rich_Port(_Rich_Immutable):
+    __slots__ = ( "port", "protocol" )
+
     def __init__(self, port, protocol):
         self.port = port
         self.protocol = protocol
+        self._freeze()
 
     def __str__(self):
         return 'port port="%s" protocol="%s"' % (self.port, self.protocol)
 
-class Rich_Protocol(object):
+class Rich_Protocol(_Rich_Immutable):
+    __slots__ = ( "value", )
+
     def __init__(self, value):
         self.value = value
+        self._freeze()
 
     def __str__(self):
         return 'protocol value="%s"' % (self.value)
 
-class Rich_Masquerade(object):
+class Rich_Masquerade(_Rich_Immutable):
+    __slots__ = ( )
+
     def __init__(self):
-        pass
+        self._freeze()
 
     def __str__(self):
         return 'masquerade'
 
-class Rich_IcmpBlock(object):
+class Rich_IcmpBlock(_Rich_Immutable):
+    __slots__ = ( "name", )
+
     def __init__(self, name):
         self.name = name
+        self._freeze()
 
     def __str__(self):
         return 'icmp-block name="%s"' % (self.name)
 
-class Rich_ForwardPort(object):
+class Rich_ForwardPort(_Rich_Immutable):
+    __slots__ = ( "port", "protocol", "to_port", "to_address" )
+
     def __init__(self, port, protocol, to_port, to_address):
         self.port = port
         self.protocol = protocol
@@ -108,6 +212,7 @@ class Rich_ForwardPort(object):
             self.to_port = ""
         if self.to_address is None:
             self.to_address = ""
+        self._freeze()
 
     def __str__(self):
         return 'forward-port port="%s" protocol="%s"%s%s' % \
@@ -115,12 +220,15 @@ class Rich_ForwardPort(object):
              ' to-port="%s"' % self.to_port if self.to_port != "" else '',
              ' to-addr="%s"' % self.to_address if self.to_address != "" else '')
 
-class Rich_Log(object):
+class Rich_Log(_Rich_Immutable):
+    __slots__ = ( "prefix", "level", "limit" )
+
     def __init__(self, prefix=None, level=None, limit=None):
         #TODO check default level in iptables
         self.prefix = prefix
         self.level = level
         self.limit = limit
+        self._freeze()
 
     def __str__(self):
         return 'log%s%s%s' % \
@@ -128,25 +236,34 @@ class Rich_Log(object):
              ' level="%s"' % (self.level) if self.level else "",
              " %s" % self.limit if self.limit else "")
 
-class Rich_Audit(object):
+class Rich_Audit(_Rich_Immutable):
+    __slots__ = ( "limit", )
+
     def __init__(self, limit=None):
         #TODO check default level in iptables
         self.limit = limit
+        self._freeze()
 
     def __str__(self):
         return 'audit%s' % (" %s" % self.limit if self.limit else "")
 
-class Rich_Accept(object):
+class Rich_Accept(_Rich_Immutable):
+    __slots__ = ( "limit", )
+
     def __init__(self, limit=None):
         self.limit = limit
+        self._freeze()
 
     def __str__(self):
         return "accept%s" % (" %s" % self.limit if self.limit else "")
 
-class Rich_Reject(object):
+class Rich_Reject(_Rich_Immutable):
+    __slots__ = ( "type", "limit" )
+
     def __init__(self, _type=None, limit=None):
         self.type = _type
         self.limit = limit
+        self._freeze()
 
     def __str__(self):
         return "reject%s%s" % (' type="%s"' % self.type if self.type else "",
@@ -162,14 +279,19 @@ class Rich_Reject(object):
                 raise FirewallError(INVALID_RULE, "Wrong reject type %s.\nUse one of: %s." % (self.type, valid_types))
 
 class Rich_Drop(Rich_Accept):
+    __slots__ = ( )
+
     def __str__(self):
         return "drop%s" % (" %s" % self.limit if self.limit else "")
 
 
-class Rich_Mark(object):
+class Rich_Mark(_Rich_Immutable):
+    __slots__ = ( "set", "limit" )
+
     def __init__(self, _set, limit=None):
         self.set = _set
         self.limit = limit
+        self._freeze()
 
     def __str__(self):
         return "mark set=%s%s" % (self.set,
@@ -194,7 +316,9 @@ class Rich_Mark(object):
                 # value is uint32
                 raise FirewallError(INVALID_MARK, x)
 
-class Rich_Limit(object):
+class Rich_Limit(_Rich_Immutable):
+    __slots__ = ( "value", )
+
     def __init__(self, value):
         self.value = value
         if "/" in self.value:
@@ -202,6 +326,7 @@ class Rich_Limit(object):
             if len(splits) == 2 and \
                splits[1] in [ "second", "minute", "hour", "day" ]:
                 self.value = "%s/%s" % (splits[0], splits[1][:1])
+        self._freeze()
 
     def check(self):
         splits = None
@@ -241,240 +366,277 @@ class Rich_Limit(object):
     def command(self):
         return ''
 
-class Rich_Rule(object):
-    def __init__(self, family=None, rule_str=None):
-        if family is not None:
-            self.family = str(family)
+# PARSER
+
+# Words of a rule string as split by shlex: unquoted characters and quoted
+# strings. Backslash escapes and unbalanced quotes are left to shlex.
+_WORD_RE = re.compile(r'''((?:[^ \t\r\n"'\\]+|"[^"\\]*"|'[^']*')+)''')
+_QUOTED_RE = re.compile(r'"([^"]*)"|\'([^\']*)\'')
+_WHITESPACE = " \t\r\n"
+
+def _unquote(match):
+    return match.group(1) if match.group(1) is not None else match.group(2)
+
+def _split(rule_str):
+    # words and separators alternate, the separators must be whitespace
+    splits = _WORD_RE.split(rule_str)
+    if "".join(splits[::2]).strip(_WHITESPACE) != "":
+        try:
+            return functions.splitArgs(rule_str)
+        except ValueError as msg:
+            raise FirewallError(INVALID_RULE, "%s: %s" % (msg, rule_str))
+    words = splits[1::2]
+    for (i, word) in enumerate(words):
+        if '"' in word:
+            if "'" in word:
+                words[i] = _QUOTED_RE.sub(_unquote, word)
+            else:
+                words[i] = word.replace('"', '')
+        elif "'" in word:
+            words[i] = word.replace("'", '')
+    return words
+
+_EOL = ('EOL', None)
+
+def _lexer(rule_str):
+    """ Lexical analysis: (element, None) or (None, (name, value)) tokens,
+    followed by the EOL token """
+    tokens = [ ]
+    for r in _split(rule_str):
+        if "=" in r:
+            attr = r.split('=')
+            if len(attr) != 2 or not attr[0] or not attr[1]:
+                raise FirewallError(INVALID_RULE, 'internal error in _lexer(): %s' % r)
+            tokens.append((None, (attr[0], attr[1])))
         else:
-            self.family = None
+            tokens.append((r, None))
+    tokens.append(_EOL)
+    return tokens
+
+_ATTRIBUTES = frozenset([ 'family', 'address', 'mac', 'ipset', 'invert',
+                          'value', 'port', 'protocol', 'to-port', 'to-addr',
+                          'name', 'prefix', 'level', 'type', 'set' ])
+
+# element: index of the rule part
+_SOURCE, _DESTINATION, _ELEMENT, _LOG, _AUDIT, _ACTION = range(1, 7)
+_ELEMENTS = {
+    'rule': None, 'not': None, 'NOT': None, 'EOL': None, 'limit': None,
+    'source': _SOURCE, 'destination': _DESTINATION,
+    'protocol': _ELEMENT, 'service': _ELEMENT, 'port': _ELEMENT,
+    'icmp-block': _ELEMENT, 'masquerade': _ELEMENT, 'forward-port': _ELEMENT,
+    'log': _LOG, 'audit': _AUDIT,
+    'accept': _ACTION, 'drop': _ACTION, 'reject': _ACTION, 'mark': _ACTION,
+}
 
-        self.source = None
-        self.destination = None
-        self.element = None
-        self.log = None
-        self.audit = None
-        self.action = None
+# Elements with one attribute: element: (attribute, class). The element is
+# complete with the attribute, any other token is an error.
+_SINGLE = {
+    'protocol': ('value', Rich_Protocol),
+    'service': ('name', Rich_Service),
+    'icmp-block': ('name', Rich_IcmpBlock),
+}
 
-        if rule_str:
-            self._import_from_string(rule_str)
+# Elements with optional attributes: element: (attributes, "not" allowed,
+# "limit" allowed, constructor). The element is complete with the first
+# token, that does not belong to it. This token is used again in the
+# enclosing element.
+_MULTI = {
+    'source': (frozenset([ 'address', 'mac', 'ipset', 'invert' ]), True, False,
+               lambda a: Rich_Source(a.get('address'), a.get('mac'),
+                                     a.get('ipset'), a.get('invert'))),
+    'destination': (frozenset([ 'address', 'invert' ]), True, False,
+                    lambda a: Rich_Destination(a.get('address'),
+                                               a.get('invert'))),
+    'port': (frozenset([ 'port', 'protocol' ]), False, False,
+             lambda a: Rich_Port(a.get('port'), a.get('protocol'))),
+    'masquerade': (frozenset(), False, False, lambda a: Rich_Masquerade()),
+    'forward-port': (frozenset([ 'port', 'protocol', 'to-port', 'to-addr' ]),
+                     False, False,
+                     lambda a: Rich_ForwardPort(a.get('port'),
+                                                a.get('protocol'),
+                                                a.get('to-port'),
+                                                a.get('to-addr'))),
+    'log': (frozenset([ 'prefix', 'level' ]), False, True,
+            lambda a: Rich_Log(a.get('prefix'), a.get('level'),
+                               a.get('limit'))),
+    'audit': (frozenset(), False, True, lambda a: Rich_Audit(a.get('limit'))),
+    'accept': (frozenset(), False, True, lambda a: Rich_Accept(a.get('limit'))),
+    'drop': (frozenset(), False, True, lambda a: Rich_Drop(a.get('limit'))),
+    'reject': (frozenset([ 'type' ]), False, True,
+               lambda a: Rich_Reject(a.get('type'), a.get('limit'))),
+    'mark': (frozenset([ 'set' ]), False, True,
+             lambda a: Rich_Mark(a.get('set'), a.get('limit'))),
+}
 
-    def _lexer(self, rule_str):
-        """ Lexical analysis """
-        tokens = []
+def _duplicate_error(element, part, value):
+    if part == _ELEMENT:
+        return FirewallError(INVALID_RULE, "more than one element. There cannot be both '%s' and '%s' in one rule." % (element, value))
+    if part == _ACTION:
+        return FirewallError(INVALID_RULE, "more than one 'action' element. There cannot be both '%s' and '%s' in one rule." % (element, value))
+    return FirewallError(INVALID_RULE, "more than one '%s' element" % element)
+
+def _parse(rule_str):
+    """ Parse a rule string into the tuple (family, source, destination,
+    element, log, audit, action), the rule is not checked """
+    if not rule_str:
+        raise FirewallError(INVALID_RULE, 'empty rule')
+
+    tokens = _lexer(rule_str)
+    if tokens[0] == _EOL:
+        raise FirewallError(INVALID_RULE, 'empty rule')
+    if tokens[0][0] is None:
+        attr_name = tokens[0][1][0]
+        if attr_name not in _ATTRIBUTES:
+            raise FirewallError(INVALID_RULE, "bad attribute '%s'" % attr_name)
+        if attr_name == 'family':
+            raise FirewallError(INVALID_RULE, "'family' outside of rule. Use 'rule family=...'.")
+        raise FirewallError(INVALID_RULE, "'%s' outside of any element. Use 'rule <element> %s= ...'." % (attr_name, attr_name))
+    if tokens[0][0] not in _ELEMENTS:
+        raise FirewallError(INVALID_RULE, "unknown element %s" % tokens[0][0])
+    if tokens[0][0] != 'rule':
+        raise FirewallError(INVALID_RULE, "'%s' outside of rule. Use 'rule ... %s ...'." % (tokens[0][0], tokens[0][0]))
+
+    parts = [ None ] * 7
+    attrs = { }      # attributes of the current element
+    in_element = None
+    in_limit = False
+    index = 1
+    while True:
+        (element, attr) = tokens[index]
+        if attr is not None:
+            (attr_name, attr_value) = attr
+            if attr_name not in _ATTRIBUTES:
+                raise FirewallError(INVALID_RULE, "bad attribute '%s'" % attr_name)
+        else:
+            attr_name = None
+            part = _ELEMENTS.get(element, 0)
+            if part == 0:
+                raise FirewallError(INVALID_RULE, "unknown element %s" % element)
+            if part is not None and parts[part] is not None:
+                raise _duplicate_error(element, part, parts[part])
+
+        if in_limit:
+            if attr_name != 'value':
+                raise FirewallError(INVALID_RULE, "invalid 'limit' element")
+            attrs['limit'] = Rich_Limit(attr_value)
+            in_limit = False
+
+        elif in_element is None:
+            # in rule
+            if attr_name == 'family':
+                if attr_value not in ['ipv4', 'ipv6']:
+                    raise FirewallError(INVALID_RULE, "'family' attribute cannot have '%s' value. Use 'ipv4' or 'ipv6' instead." % attr_value)
+                parts[0] = attr_value
+            elif attr_name:
+                if attr_name == 'protocol':
+                    err_msg = "wrong 'protocol' usage. Use either 'rule protocol value=...' or  'rule [forward-]port protocol=...'."
+                else:
+                    err_msg = "attribute '%s' outside of any element. Use 'rule <element> %s= ...'." % (attr_name, attr_name)
+                raise FirewallError(INVALID_RULE, err_msg)
+            elif element == 'EOL':
+                break
+            elif element == 'limit':
+                in_limit = True
+            elif element in _SINGLE or element in _MULTI:
+                in_element = element
+            else:
+                raise FirewallError(INVALID_RULE, "'%s' not allowed in rule" % element)
+
+        elif in_element in _SINGLE:
+            (name, cls) = _SINGLE[in_element]
+            if attr_name != name:
+                raise FirewallError(INVALID_RULE, "invalid '%s' element" % in_element)
+            parts[_ELEMENT] = cls(attr_value)
+            in_element = None
 
-        for r in functions.splitArgs(rule_str):
-            if "=" in r:
-                attr = r.split('=')
-                if len(attr) != 2 or not attr[0] or not attr[1]:
-                    raise FirewallError(INVALID_RULE, 'internal error in _lexer(): %s' % r)
-                tokens.append({'attr_name':attr[0], 'attr_value':attr[1]})
+        else:
+            (names, invert, limit, cls) = _MULTI[in_element]
+            if attr_name in names:
+                attrs[attr_name] = attr_value
+            elif invert and element in ['not', 'NOT']:
+                attrs['invert'] = True
+            elif limit and element == 'limit':
+                in_limit = True
             else:
-                tokens.append({'element':r})
-        tokens.append({'element':'EOL'})
+                parts[_ELEMENTS[in_element]] = cls(attrs)
+                attrs.clear()
+                in_element = None
+                # use the token again in rule
+                continue
 
-        return tokens
+        index += 1
 
-    def _import_from_string(self, rule_str):
-        if not rule_str:
-            raise FirewallError(INVALID_RULE, 'empty rule')
+    return tuple(parts)
 
-        self.family = None
-        self.source = None
-        self.destination = None
-        self.element = None
-        self.log = None
-        self.audit = None
-        self.action = None
+# CANONICAL FORM
 
-        tokens = self._lexer(rule_str)
-        if tokens and tokens[0].get('element')  == 'EOL':
-            raise FirewallError(INVALID_RULE, 'empty rule')
+_FAMILIES = { "ipv4": (socket.AF_INET, 32), "ipv6": (socket.AF_INET6, 128) }
 
-        attrs = {}       # attributes of elements
-        in_elements = [] # stack with elements we are in
-        index = 0        # index into tokens
-        while not (tokens[index].get('element')  == 'EOL' and in_elements == ['rule']):
-            element = tokens[index].get('element')
-            attr_name = tokens[index].get('attr_name')
-            attr_value = tokens[index].get('attr_value')
-            #print ("in_elements: ", in_elements)
-            #print ("index: %s, element: %s, attribute: %s=%s" % (index, element, attr_name, attr_value))
-            if attr_name:     # attribute
-                if attr_name not in ['family', 'address', 'mac', 'ipset',
-                                     'invert', 'value',
-                                     'port', 'protocol', 'to-port', 'to-addr',
-                                     'name', 'prefix', 'level', 'type',
-                                     'set']:
-                    raise FirewallError(INVALID_RULE, "bad attribute '%s'" % attr_name)
-            else:             # element
-                if element in ['rule', 'source', 'destination', 'protocol',
-                               'service', 'port', 'icmp-block', 'masquerade',
-                               'forward-port', 'log', 'audit',
-                               'accept', 'drop', 'reject', 'mark', 'limit', 'not', 'NOT', 'EOL']:
-                    if element == 'source' and self.source:
-                        raise FirewallError(INVALID_RULE, "more than one 'source' element")
-                    elif element == 'destination' and self.destination:
-                        raise FirewallError(INVALID_RULE, "more than one 'destination' element")
-                    elif element in ['protocol', 'service', 'port', 'icmp-block',
-                                     'masquerade', 'forward-port'] and self.element:
-                        raise FirewallError(INVALID_RULE, "more than one element. There cannot be both '%s' and '%s' in one rule." % (element, self.element))
-                    elif element == 'log' and self.log:
-                        raise FirewallError(INVALID_RULE, "more than one 'log' element")
-                    elif element == 'audit' and self.audit:
-                        raise FirewallError(INVALID_RULE, "more than one 'audit' element")
-                    elif element in ['accept', 'drop', 'reject', 'mark'] and self.action:
-                        raise FirewallError(INVALID_RULE, "more than one 'action' element. There cannot be both '%s' and '%s' in one rule." % (element, self.action))
-                else:
-                    raise FirewallError(INVALID_RULE, "unknown element %s" % element)
-
-            in_element = in_elements[len(in_elements)-1] if len(in_elements) > 0 else ''
-
-            if in_element == '':
-                if not element and attr_name:
-                    if attr_name == 'family':
-                        raise FirewallError(INVALID_RULE, "'family' outside of rule. Use 'rule family=...'.")
-                    else:
-                        raise FirewallError(INVALID_RULE, "'%s' outside of any element. Use 'rule <element> %s= ...'." % (attr_name, attr_name))
-                elif 'rule' not in element:
-                    raise FirewallError(INVALID_RULE, "'%s' outside of rule. Use 'rule ... %s ...'." % (element, element))
-                else:
-                    in_elements.append('rule') # push into stack
-            elif in_element == 'rule':
-                if attr_name == 'family':
-                    if attr_value not in ['ipv4', 'ipv6']:
-                        raise FirewallError(INVALID_RULE, "'family' attribute cannot have '%s' value. Use 'ipv4' or 'ipv6' instead." % attr_value)
-                    self.family = attr_value
-                elif attr_name:
-                    if attr_name == 'protocol':
-                        err_msg = "wrong 'protocol' usage. Use either 'rule protocol value=...' or  'rule [forward-]port protocol=...'."
-                    else:
-                        err_msg = "attribute '%s' outside of any element. Use 'rule <element> %s= ...'." % (attr_name, attr_name)
-                    raise FirewallError(INVALID_RULE, err_msg)
-                else:
-                    in_elements.append(element) # push into stack
-            elif in_element == 'source':
-                if attr_name in ['address', 'mac', 'ipset', 'invert']:
-                    attrs[attr_name] = attr_value
-                elif element in ['not', 'NOT']:
-                    attrs['invert'] = True
-                else:
-                    self.source = Rich_Source(attrs.get('address'), attrs.get('mac'), attrs.get('ipset'), attrs.get('invert'))
-                    in_elements.pop() # source
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'destination':
-                if attr_name in ['address', 'invert']:
-                    attrs[attr_name] = attr_value
-                elif element in ['not', 'NOT']:
-                    attrs['invert'] = True
-                else:
-                    self.destination = Rich_Destination(attrs.get('address'), attrs.get('invert'))
-                    in_elements.pop() # destination
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'protocol':
-                if attr_name == 'value':
-                    self.element = Rich_Protocol(attr_value)
-                    in_elements.pop() # protocol
-                else:
-                    raise FirewallError(INVALID_RULE, "invalid 'protocol' element")
-            elif in_element == 'service':
-                if attr_name == 'name':
-                    self.element = Rich_Service(attr_value)
-                    in_elements.pop() # service
-                else:
-                    raise FirewallError(INVALID_RULE, "invalid 'service' element")
-            elif in_element == 'port':
-                if attr_name in ['port', 'protocol']:
-                    attrs[attr_name] = attr_value
-                else:
-                    self.element = Rich_Port(attrs.get('port'), attrs.get('protocol'))
-                    in_elements.pop() # port
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'icmp-block':
-                if attr_name == 'name':
-                    self.element = Rich_IcmpBlock(attr_value)
-                    in_elements.pop() # icmp-block
-                else:
-                    raise FirewallError(INVALID_RULE, "invalid 'icmp-block' element")
-            elif in_element == 'masquerade':
-                self.element = Rich_Masquerade()
-                in_elements.pop()
-                attrs.clear()
-                index = index -1 # return token to input
-            elif in_element == 'forward-port':
-                if attr_name in ['port', 'protocol', 'to-port', 'to-addr']:
-                    attrs[attr_name] = attr_value
-                else:
-                    self.element = Rich_ForwardPort(attrs.get('port'), attrs.get('protocol'), attrs.get('to-port'), attrs.get('to-addr'))
-                    in_elements.pop() # forward-port
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'log':
-                if attr_name in ['prefix', 'level']:
-                    attrs[attr_name] = attr_value
-                elif element == 'limit':
-                    in_elements.append('limit')
-                else:
-                    self.log = Rich_Log(attrs.get('prefix'), attrs.get('level'), attrs.get('limit'))
-                    in_elements.pop() # log
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'audit':
-                if element == 'limit':
-                    in_elements.append('limit')
-                else:
-                    self.audit = Rich_Audit(attrs.get('limit'))
-                    in_elements.pop() # audit
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'accept':
-                if element == 'limit':
-                    in_elements.append('limit')
-                else:
-                    self.action = Rich_Accept(attrs.get('limit'))
-                    in_elements.pop() # accept
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'drop':
-                if element == 'limit':
-                    in_elements.append('limit')
-                else:
-                    self.action = Rich_Drop(attrs.get('limit'))
-                    in_elements.pop() # drop
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'reject':
-                if attr_name == 'type':
-                    attrs[attr_name] = attr_value
-                elif element == 'limit':
-                    in_elements.append('limit')
-                else:
-                    self.action = Rich_Reject(attrs.get('type'), attrs.get('limit'))
-                    in_elements.pop() # accept
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'mark':
-                if attr_name == 'set':
-                    attrs[attr_name] = attr_value
-                elif element == 'limit':
-                    in_elements.append('limit')
-                else:
-                    self.action = Rich_Mark(attrs.get('set'),
-                                            attrs.get('limit'))
-                    in_elements.pop() # accept
-                    attrs.clear()
-                    index = index -1 # return token to input
-            elif in_element == 'limit':
-                if attr_name == 'value':
-                    attrs['limit'] = Rich_Limit(attr_value)
-                    in_elements.pop() # limit
-                else:
-                    raise FirewallError(INVALID_RULE, "invalid 'limit' element")
+def _canonical_address(family, addr):
+    # address in inet_ntop notation with the host bits cleared, like iptables
+    # is using it, without the mask for a single host
+    if family not in _FAMILIES or addr is None:
+        return addr
+    (af, bits) = _FAMILIES[family]
+    if "/" in addr:
+        (addr, mask) = addr.split("/", 1)
+        try:
+            mask = int(mask)
+        except ValueError:
+            return addr
+    else:
+        mask = bits
+    try:
+        packed = socket.inet_pton(af, addr)
+    except socket.error:
+        return addr
+    if mask < bits:
+        value = int(binascii.hexlify(packed), 16)
+        value &= ((1 << bits) - 1) ^ ((1 << (bits - mask)) - 1)
+        packed = binascii.unhexlify("%0*x" % (bits // 4, value))
+    addr = socket.inet_ntop(af, packed)
+    if mask < bits:
+        return "%s/%d" % (addr, mask)
+    return addr
+
+def _canonical_port(port):
+    # port or port range with port ids instead of names
+    _range = functions.getPortRange(port)
+    if not isinstance(_range, tuple):
+        return port
+    if len(_range) == 1:
+        return str(_range[0])
+    return "%d-%d" % _range
+
+class Rich_Rule(_Rich_Immutable):
+    __slots__ = ( "family", "source", "destination", "element", "log", "audit",
+                  "action", "_canonical" )
+
+    def __init__(self, family=None, rule_str=None, source=None,
+                 destination=None, element=None, log=None, audit=None,
+                 action=None):
+        if family is not None:
+            self.family = str(family)
+        else:
+            self.family = None
+
+        self.source = source
+        self.destination = destination
+        self.element = element
+        self.log = log
+        self.audit = audit
+        self.action = action
 
-            index = index + 1
+        if rule_str:
+            self._import_from_string(rule_str)
+            # parsed rules are used as keys, rules created from parts are
+            # getting their canonical form with the first use
+            self._canonical = self._canonical_form()
+        self._freeze()
 
+    def _import_from_string(self, rule_str):
+        (self.family, self.source, self.destination, self.element, self.log,
+         self.audit, self.action) = _parse(rule_str)
         self.check()
 
     def check(self):
@@ -620,6 +782,65 @@ class Rich_Rule(object):
             if self.action.limit is not None:
                 self.action.limit.check()
 
+    def canonical(self):
+        """ Canonical string form of the checked rule: rules, that differ
+        only in the order of attributes, in spacing and quoting or in the
+        notation of addresses, ports and reject types, have the same
+        canonical form. It is a valid rule string itself.
+        """
+        try:
+            return self._canonical
+        except AttributeError:
+            pass
+        # the rule is immutable, the canonical form does not change
+        canonical = self._canonical_form()
+        object.__setattr__(self, "_canonical", canonical)
+        return canonical
+
+    def _canonical_form(self):
+        parts = { }
+        if self.source is not None and self.source.addr is not None:
+            parts["source"] = Rich_Source(
+                _canonical_address(self.family, self.source.addr),
+                None, None, self.source.invert)
+        if self.destination is not None:
+            parts["destination"] = Rich_Destination(
+                _canonical_address(self.family, self.destination.addr),
+                self.destination.invert)
+        if type(self.element) == Rich_Port:
+            parts["element"] = Rich_Port(_canonical_port(self.element.port),
+                                         self.element.protocol)
+        elif type(self.element) == Rich_ForwardPort:
+            parts["element"] = Rich_ForwardPort(
+                _canonical_port(self.element.port), self.element.protocol,
+                _canonical_port(self.element.to_port)
+                if self.element.to_port else "",
+                _canonical_address(self.family, self.element.to_address)
+                if self.element.to_address else "")
+        if type(self.action) == Rich_Reject and self.action.type and \
+           self.family in REJECT_TYPE_ALIASES:
+            parts["action"] = Rich_Reject(
+                REJECT_TYPE_ALIASES[self.family].get(self.action.type,
+                                                     self.action.type),
+                self.action.limit)
+        return str(self.replace(**parts))
+
+    # Rules are equal if their canonical forms are equal, the canonical form
+    # is computed once per rule.
+
+    def __eq__(self, other):
+        if not isinstance(other, Rich_Rule):
+            return NotImplemented
+        return self.canonical() == other.canonical()
+
+    def __ne__(self, other):
+        if not isinstance(other, Rich_Rule):
+            return NotImplemented
+        return self.canonical() != other.canonical()
+
+    def __hash__(self):
+        return hash(self.canonical())
+
     def __str__(self):
         ret = 'rule'
         if self.family:
@@ -640,6 +861,61 @@ class Rich_Rule(object):
         return (functions.u2b(ret)) if functions.PY2 else ret
 
 
+class Rich_Rule_Cache(object):
+    """ Bounded cache of parsed and checked rich rules
+
+    Rules are looked up by the rule string as given and interned by their
+    canonical form, so that equal rules share one object. The returned
+    rules are shared, they are immutable.
+    """
+    def __init__(self, size=RICH_RULE_CACHE_SIZE):
+        self._size = size
+        self._rules = collections.OrderedDict() # rule string -> rule
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__, self._size, len(self._rules))
+
+    def __len__(self):
+        return len(self._rules)
+
+    def clear(self):
+        self._rules.clear()
+
+    def __lookup(self, key):
+        # lookup and mark as recently used
+        rule = self._rules.pop(key, None)
+        if rule is not None:
+            self._rules[key] = rule
+        return rule
+
+    def __store(self, key, rule):
+        self._rules[key] = rule
+        while len(self._rules) > self._size:
+            self._rules.popitem(last=False)
+
+    def get(self, rule_str):
+        if not rule_str:
+            raise FirewallError(INVALID_RULE, 'empty rule')
+        key = rule_str.strip()
+        rule = self.__lookup(key)
+        if rule is not None:
+            return rule
+
+        # parse and check, errors are not cached
+        rule = Rich_Rule(rule_str=key)
+        canonical = rule.canonical()
+        interned = self.__lookup(canonical)
+        if interned is not None:
+            rule = interned
+        else:
+            self.__store(canonical, rule)
+        if key != canonical:
+            self.__store(key, rule)
+        return rule
+
+# shared by runtime, permanent configuration and D-Bus layers
+rich_rule_cache = Rich_Rule_Cache()
+
 #class Rich_RawRule(object):
 #class Rich_RuleSet(object):
 #class Rich_AddressList(object):
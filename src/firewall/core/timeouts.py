@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import heapq
+import itertools
+import math
+import time
+
+from gi.repository import GLib
+
+from firewall.core.logger import log
+
+class Timeouts(object):
+    """ Scheduler for timed runtime settings
+
+    All timeouts are kept in a min heap ordered by deadline. There is only
+    one GLib source, which is armed for the next deadline. All timeouts that
+    are due at that time are expired in one batch.
+    """
+
+    def __init__(self):
+        self._timeouts = { } # key -> (deadline, callback, args)
+        self._heap = [ ] # (deadline, seq, key)
+        self._seq = itertools.count()
+        self._source = None
+        self._source_deadline = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__, self._timeouts)
+
+    def __len__(self):
+        return len(self._timeouts)
+
+    def __contains__(self, key):
+        return key in self._timeouts
+
+    def add(self, key, deadline, callback, *args):
+        """ Call callback(*args) at deadline (seconds since the epoch).
+            An existing timeout for key is replaced.
+        """
+        self._timeouts[key] = (deadline, callback, args)
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        if self._source_deadline is None or deadline < self._source_deadline:
+            self._arm()
+
+    def remove(self, key):
+        # heap entries of removed keys are dropped lazily
+        if key in self._timeouts:
+            del self._timeouts[key]
+        if len(self._timeouts) < 1:
+            self.clear()
+        elif len(self._heap) > 2 * len(self._timeouts) + 64:
+            self._heap = [ (deadline, next(self._seq), key) for (key, \
+                (deadline, callback, args)) in self._timeouts.items() ]
+            heapq.heapify(self._heap)
+
+    def get_deadline(self, key):
+        return self._timeouts[key][0]
+
+    def clear(self):
+        self._timeouts.clear()
+        del self._heap[:]
+        self._disarm()
+
+    def _disarm(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+        self._source = None
+        self._source_deadline = None
+
+    def _arm(self):
+        self._disarm()
+        # drop stale heap entries of removed or replaced timeouts
+        while self._heap:
+            (deadline, seq, key) = self._heap[0]
+            if key in self._timeouts and self._timeouts[key][0] == deadline:
+                break
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        deadline = self._heap[0][0]
+        delay = max(int(math.ceil(deadline - time.time())), 0)
+        self._source = GLib.timeout_add_seconds(delay, self._expire)
+        self._source_deadline = deadline
+
+    def _expire(self):
+        self._source = None
+        self._source_deadline = None
+
+        now = time.time()
+        expired = [ ]
+        while self._heap and self._heap[0][0] <= now:
+            (deadline, seq, key) = heapq.heappop(self._heap)
+            if key in self._timeouts and self._timeouts[key][0] == deadline:
+                expired.append(self._timeouts.pop(key))
+
+        log.debug1("Expiring %d timeouts", len(expired))
+        for (deadline, callback, args) in expired:
+            try:
+                callback(*args)
+            except Exception as msg:
+                log.error("Failed to expire timeout: %s", msg)
+
+        self._arm()
+        # remove this GLib source
+        return False
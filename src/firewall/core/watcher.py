@@ -19,27 +19,248 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from gi.repository import Gio, GLib
+import os
+import sys
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from gi.repository import GLib
+from firewall.core.logger import log
+
+PY2 = sys.version < '3'
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+          IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+          IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+class _Inotify(object):
+    """ Monitor directories with inotify(7) in the GLib main loop without
+        GIO. Files are watched through their directory, so that replacing a
+        file by rename is seen. Directories that do not exist are watched
+        through their nearest existing parent and added once created.
+    """
+    def __init__(self, callback):
+        self._callback = callback
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p,
+                                     ctypes.c_uint32 ]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._wds = { }      # wd: directory
+        self._dirs = { }     # directory: wd
+        self._watched = { }  # directory: None (all entries) or set of names
+        self._source = GLib.io_add_watch(self._fd, GLib.PRIORITY_DEFAULT,
+                                         GLib.IO_IN, self._read_cb)
+
+    def close(self):
+        GLib.source_remove(self._source)
+        os.close(self._fd)
+        self._wds.clear()
+        self._dirs.clear()
+        self._watched.clear()
+
+    def add_dir(self, directory):
+        self._watched[directory] = None
+        self._watch(directory)
+
+    def add_file(self, filename):
+        (directory, name) = os.path.split(filename)
+        if self._watched.get(directory, set()) is not None:
+            self._watched.setdefault(directory, set()).add(name)
+        self._watch(directory)
+
+    def _watch(self, directory):
+        if directory in self._dirs:
+            return True
+        path = directory if PY2 else os.fsencode(directory)
+        wd = self._add_watch(self._fd, path, IN_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            parent = os.path.dirname(directory)
+            if e not in [ errno.ENOENT, errno.ENOTDIR ] or \
+               parent == directory:
+                log.debug1("Failed to watch '%s': %s", directory,
+                           os.strerror(e))
+                return False
+            # wait for the directory to be created
+            name = os.path.basename(directory)
+            if self._watched.get(parent, set()) is not None:
+                self._watched.setdefault(parent, set()).add(name)
+            return self._watch(parent)
+        self._wds[wd] = directory
+        self._dirs[directory] = wd
+        return True
+
+    def _created(self, directory):
+        # a missing directory has been created: watch it and report the
+        # entries, that have been created before the watch was added
+        if not self._watch(directory):
+            return
+        if self._watched.get(directory, ()) is None:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                names = [ ]
+        else:
+            names = [ x for x in self._watched.get(directory, ())
+                      if os.path.exists("%s/%s" % (directory, x)) ]
+        for name in sorted(names):
+            filename = "%s/%s" % (directory, name)
+            if filename in self._watched:
+                self._created(filename)
+            else:
+                self._callback(filename)
+
+    def _removed(self, directory):
+        wd = self._dirs.pop(directory, None)
+        if wd is not None:
+            del self._wds[wd]
+            # a moved directory is still watched by the kernel
+            self._rm_watch(self._fd, wd)
+        if directory in self._watched:
+            # watch for the directory to come back
+            self._watch(directory)
+
+    def _read_cb(self, fd, condition):
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno not in [ errno.EAGAIN, errno.EINTR ]:
+                log.error("Failed to read inotify events: %s", e)
+            return True
+
+        i = 0
+        while i + _EVENT_HEADER.size <= len(data):
+            (wd, mask, cookie, length) = _EVENT_HEADER.unpack_from(data, i)
+            i += _EVENT_HEADER.size
+            name = data[i:i+length].rstrip(b"\0")
+            i += length
+            if not PY2:
+                name = os.fsdecode(name)
+
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Lost inotify events, reporting all watched entries")
+                for directory in list(self._watched):
+                    self._created(directory)
+                continue
+            if wd not in self._wds:
+                continue
+            directory = self._wds[wd]
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._removed(directory)
+                continue
+            if not name:
+                continue
+            filename = "%s/%s" % (directory, name)
+            if filename in self._watched and \
+               mask & (IN_CREATE | IN_MOVED_TO) and filename not in self._dirs:
+                self._created(filename)
+            elif self._watched.get(directory, ()) is None or \
+                 name in self._watched.get(directory, ()):
+                self._callback(filename)
+        return True
+
+class _GioMonitor(object):
+    """ Monitor directories and files with GIO. """
+    def __init__(self, callback):
+        from gi.repository import Gio
+        self._gio = Gio
+        self._callback = callback
+        self._monitors = { }
+
+    def close(self):
+        for monitor in self._monitors.values():
+            monitor.cancel()
+        self._monitors.clear()
+
+    def add_dir(self, directory):
+        gfile = self._gio.File.new_for_path(directory)
+        self._monitors[directory] = gfile.monitor_directory(\
+            self._gio.FileMonitorFlags.NONE, None)
+        self._monitors[directory].connect("changed", self._file_changed_cb)
+
+    def add_file(self, filename):
+        gfile = self._gio.File.new_for_path(filename)
+        self._monitors[filename] = gfile.monitor_file(\
+            self._gio.FileMonitorFlags.NONE, None)
+        self._monitors[filename].connect("changed", self._file_changed_cb)
+
+    def _file_changed_cb(self, monitor, gio_file, gio_other_file, event):
+        if event == self._gio.FileMonitorEvent.CHANGED or \
+                event == self._gio.FileMonitorEvent.CREATED or \
+                event == self._gio.FileMonitorEvent.DELETED or \
+                event == self._gio.FileMonitorEvent.ATTRIBUTE_CHANGED:
+            self._callback(gio_file.get_parse_name())
 
 class Watcher(object):
-    def __init__(self, callback, timeout):
+    """ Watch directories and files for changes
+
+    The callback is called with the name of the changed file after timeout
+    seconds without further changes of this file. With batch enabled, the
+    changes of all watched paths are collected instead and the callback is
+    called with the list of changed files after timeout seconds without
+    further changes at all, but at the latest after max_delay times timeout
+    seconds.
+
+    The backend is either "inotify" or "gio", the default is to use inotify
+    if available.
+    """
+    def __init__(self, callback, timeout, batch=False, backend=None,
+                 max_delay=6):
         self._callback = callback
         self._timeout = timeout
-        self._monitors = { }
+        self._batch = batch
+        self._max_delay = max_delay
         self._timeouts = { }
         self._blocked = [ ]
+        self._changed = [ ]
+        self._batch_start = None
+        self._monitor = None
+        if backend in [ None, "inotify" ]:
+            try:
+                self._monitor = _Inotify(self._file_changed)
+            except Exception as msg:
+                if backend is not None:
+                    raise
+                log.debug1("inotify not usable, using GIO: %s", msg)
+        if self._monitor is None:
+            self._monitor = _GioMonitor(self._file_changed)
+
+    def close(self):
+        self.clear_timeouts()
+        self._monitor.close()
 
     def add_watch_dir(self, directory):
-        gfile = Gio.File.new_for_path(directory)
-        self._monitors[directory] = gfile.monitor_directory(\
-            Gio.FileMonitorFlags.NONE, None)
-        self._monitors[directory].connect("changed", self._file_changed_cb)
+        self._monitor.add_dir(directory)
 
     def add_watch_file(self, filename):
-        gfile = Gio.File.new_for_path(filename)
-        self._monitors[filename] = gfile.monitor_file(\
-            Gio.FileMonitorFlags.NONE, None)
-        self._monitors[filename].connect("changed", self._file_changed_cb)
+        self._monitor.add_file(filename)
 
     def block_source(self, filename):
         if filename not in self._blocked:
@@ -50,29 +271,51 @@ class Watcher(object):
             self._blocked.remove(filename)
 
     def clear_timeouts(self):
-        for filename in self._timeouts.keys():
+        for filename in list(self._timeouts.keys()):
             GLib.source_remove(self._timeouts[filename])
             del self._timeouts[filename]
+        del self._changed[:]
+        self._batch_start = None
 
     def _call_callback(self, filename):
         if filename not in self._blocked:
             self._callback(filename)
         del self._timeouts[filename]
 
-    def _file_changed_cb(self, monitor, gio_file, gio_other_file, event):
-        filename = gio_file.get_parse_name()
+    def _call_batch_callback(self):
+        del self._timeouts[None]
+        changed = [ x for x in self._changed if x not in self._blocked ]
+        del self._changed[:]
+        self._batch_start = None
+        if len(changed) > 0:
+            self._callback(changed)
+        # remove this GLib source
+        return False
+
+    def _file_changed(self, filename):
         if filename in self._blocked:
             if filename in self._timeouts:
                 GLib.source_remove(self._timeouts[filename])
                 del self._timeouts[filename]
             return
 
-        if event == Gio.FileMonitorEvent.CHANGED or \
-                event == Gio.FileMonitorEvent.CREATED or \
-                event == Gio.FileMonitorEvent.DELETED or \
-                event == Gio.FileMonitorEvent.ATTRIBUTE_CHANGED:
-            if filename in self._timeouts:
-                GLib.source_remove(self._timeouts[filename])
-                del self._timeouts[filename]
-            self._timeouts[filename] = GLib.timeout_add_seconds(\
-                self._timeout, self._call_callback, filename)
+        if self._batch:
+            if filename not in self._changed:
+                self._changed.append(filename)
+            now = time.time()
+            if self._batch_start is None:
+                self._batch_start = now
+            elif now - self._batch_start >= self._max_delay * self._timeout:
+                # do not postpone a batch forever on continuous changes
+                return
+            if None in self._timeouts:
+                GLib.source_remove(self._timeouts[None])
+            self._timeouts[None] = GLib.timeout_add_seconds(\
+                self._timeout, self._call_batch_callback)
+            return
+
+        if filename in self._timeouts:
+            GLib.source_remove(self._timeouts[filename])
+            del self._timeouts[filename]
+        self._timeouts[filename] = GLib.timeout_add_seconds(\
+            self._timeout, self._call_callback, filename)
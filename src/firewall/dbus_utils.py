@@ -91,6 +91,76 @@ def command_of_sender(bus, sender):
 def user_of_sender(bus, sender):
     return user_of_uid(uid_of_sender(bus, sender))
 
+class Sender_Cache(object):
+    """ Identity of D-Bus senders for the lockdown access checks
+
+    The SELinux context, uid, user and command of a sender are resolved on
+    first use only and kept per unique bus name, using one proxy of the bus
+    daemon. Unique names are not reused by the bus daemon, the entries are
+    removed when the name vanishes (NameOwnerChanged). Only successful
+    lookups are kept, a lookup fails for a sender, that has vanished.
+    """
+    def __init__(self):
+        self._bus = None
+        self._iface = None
+        self._senders = { }
+
+    def __connect(self):
+        self._bus = dbus.SystemBus()
+        dbus_obj = self._bus.get_object('org.freedesktop.DBus',
+                                        '/org/freedesktop/DBus')
+        self._iface = dbus.Interface(dbus_obj, 'org.freedesktop.DBus')
+        self._bus.add_signal_receiver(self.__name_owner_changed,
+                                      signal_name='NameOwnerChanged',
+                                      dbus_interface='org.freedesktop.DBus',
+                                      path='/org/freedesktop/DBus')
+
+    def __name_owner_changed(self, name, old_owner, new_owner):
+        if not new_owner and name in self._senders:
+            del self._senders[name]
+
+    def __resolve(self, sender, key):
+        if key == "context":
+            try:
+                context = self._iface.GetConnectionSELinuxSecurityContext(
+                    sender)
+            except:
+                return None
+            return "".join(map(chr, dbus_to_python(context)))
+        elif key == "uid":
+            try:
+                return int(self._iface.GetConnectionUnixUser(sender))
+            except ValueError:
+                return None
+        elif key == "user":
+            return user_of_uid(self.get(sender, "uid"))
+        elif key == "command":
+            try:
+                pid = int(self._iface.GetConnectionUnixProcessID(sender))
+            except ValueError:
+                return None
+            return command_of_pid(pid)
+        raise KeyError(key)
+
+    def get(self, sender, key):
+        """ Return the context, uid, user or command of sender """
+        if self._iface is None:
+            self.__connect()
+        info = self._senders.get(sender)
+        if info is not None and key in info:
+            return info[key]
+        value = self.__resolve(sender, key)
+        if value is not None:
+            # failed lookups are not cached: the sender might have vanished
+            # already, the entry would not be removed anymore
+            self._senders.setdefault(sender, { })[key] = value
+        return value
+
+    def clear(self):
+        self._senders.clear()
+
+sender_cache = Sender_Cache()
+
 def dbus_to_python(obj, expected_type=None):
     if obj is None:
         python_obj = obj
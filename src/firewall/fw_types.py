@@ -19,6 +19,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import bisect
+import collections
+
 class LastUpdatedOrderedDict(object):
     def __init__(self, x=None):
         self._dict = { }
@@ -75,3 +78,113 @@ class LastUpdatedOrderedDict(object):
         else:
             self[key] = value
             return value
+
+class PriorityOrderedDict(object):
+    """ Keys with a priority in the order of rules in a chain: ordered by
+    priority and by insertion within the same priority.
+
+    Membership and removal are O(1), the number of keys up to a priority
+    is O(log p) for p priorities with a Fenwick tree over the sorted
+    priorities. Only the first use of a priority is O(p). Iterating is
+    giving the keys in order without sorting.
+    """
+    def __init__(self, x=None):
+        self._priorities = { }  # key: priority
+        self._keys = { }        # priority: OrderedDict of keys
+        self._sorted = [ ]      # sorted priorities
+        self._tree = [ 0 ]      # Fenwick tree of counts, 1-based
+        if x:
+            self.update(x)
+
+    def clear(self):
+        self._priorities.clear()
+        self._keys.clear()
+        del self._sorted[:]
+        self._tree = [ 0 ]
+
+    def update(self, x):
+        for key,value in x.items():
+            self[key] = value
+
+    def __tree_add(self, i, n):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += n
+            i += i & -i
+
+    def __tree_rebuild(self):
+        self._tree = [ 0 ] * (len(self._sorted) + 1)
+        for (i, priority) in enumerate(self._sorted):
+            self.__tree_add(i, len(self._keys[priority]))
+
+    def position(self, priority):
+        """ Return the number of keys with a priority lower or equal to
+            priority, a new key with priority is inserted after them.
+        """
+        i = bisect.bisect_right(self._sorted, priority)
+        n = 0
+        while i > 0:
+            n += self._tree[i]
+            i -= i & -i
+        return n
+
+    def __setitem__(self, key, priority):
+        if key in self._priorities:
+            if self._priorities[key] == priority:
+                return
+            del self[key]
+        if priority not in self._keys:
+            self._keys[priority] = collections.OrderedDict()
+            bisect.insort(self._sorted, priority)
+            self._keys[priority][key] = None
+            self._priorities[key] = priority
+            self.__tree_rebuild()
+            return
+        self._keys[priority][key] = None
+        self._priorities[key] = priority
+        self.__tree_add(bisect.bisect_left(self._sorted, priority), 1)
+
+    def __getitem__(self, key):
+        return self._priorities[key]
+
+    def __delitem__(self, key):
+        priority = self._priorities.pop(key)
+        del self._keys[priority][key]
+        # the priority is kept for later use with a count of 0
+        self.__tree_add(bisect.bisect_left(self._sorted, priority), -1)
+
+    def __contains__(self, key):
+        return key in self._priorities
+
+    def __len__(self):
+        return len(self._priorities)
+
+    def __iter__(self):
+        for priority in self._sorted:
+            for key in self._keys[priority]:
+                yield key
+
+    def __repr__(self):
+        return '%s([%s])' % (self.__class__.__name__, ', '.join(
+                ['(%r, %r)' % (key, self[key]) for key in self]))
+
+    def copy(self):
+        x = PriorityOrderedDict()
+        x._priorities = self._priorities.copy()
+        x._keys = dict((priority, keys.copy())
+                       for (priority, keys) in self._keys.items())
+        x._sorted = self._sorted[:]
+        x._tree = self._tree[:]
+        return x
+
+    def get(self, key, default=None):
+        return self._priorities.get(key, default)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [ self._priorities[key] for key in self ]
+
+    def items(self):
+        return [ (key, self._priorities[key]) for key in self ]
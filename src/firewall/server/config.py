@@ -33,6 +33,7 @@ from firewall.config.dbus import *
 from firewall.core.watcher import Watcher
 from firewall.core.logger import log
 from firewall.server.decorators import *
+from firewall.server.worker import worker
 from firewall.server.config_icmptype import FirewallDConfigIcmpType
 from firewall.server.config_service import FirewallDConfigService
 from firewall.server.config_zone import FirewallDConfigZone
@@ -43,8 +44,7 @@ from firewall.core.io.icmptype import IcmpType
 from firewall.core.io.ipset import IPSet
 from firewall.core.io.lockdown_whitelist import LockdownWhitelist
 from firewall.core.io.direct import Direct
-from firewall.dbus_utils import dbus_to_python, \
-    command_of_sender, context_of_sender, uid_of_sender, user_of_uid
+from firewall.dbus_utils import dbus_to_python, sender_cache
 from firewall.errors import *
 
 ############################################################################
@@ -67,7 +67,7 @@ class FirewallDConfig(slip.dbus.service.Object):
         self.config = config
         self.path = args[0]
         self._init_vars()
-        self.watcher = Watcher(self.watch_updater, 5)
+        self.watcher = Watcher(self._watch_updater_cb, 5, batch=True)
         self.watcher.add_watch_dir(FIREWALLD_IPSETS)
         self.watcher.add_watch_dir(ETC_FIREWALLD_IPSETS)
         self.watcher.add_watch_dir(FIREWALLD_ICMPTYPES)
@@ -80,6 +80,9 @@ class FirewallDConfig(slip.dbus.service.Object):
         self.watcher.add_watch_file(FIREWALLD_DIRECT)
         self.watcher.add_watch_file(FIREWALLD_CONF)
 
+        # coalesce writes of the permanent configuration
+        self.config.set_write_delay(1)
+
     @handle_exceptions
     def _init_vars(self):
         self.ipsets = [ ]
@@ -124,8 +127,37 @@ class FirewallDConfig(slip.dbus.service.Object):
             del x
         self._init_vars()
 
+    def _watch_updater_cb(self, names):
+        # the configuration is reloaded by the worker in a thread, updates
+        # are serialized with the changes done over D-Bus
+        worker.call(self.watch_updater, names)
+
     @handle_exceptions
-    def watch_updater(self, name):
+    def watch_updater(self, names):
+        """update the configuration for a batch of changed files
+        """
+        # firewalld.conf first, zones after the services and icmptypes
+        # they are using, each file only once
+        order = [ FIREWALLD_CONF, FIREWALLD_IPSETS, ETC_FIREWALLD_IPSETS,
+                  FIREWALLD_ICMPTYPES, ETC_FIREWALLD_ICMPTYPES,
+                  FIREWALLD_SERVICES, ETC_FIREWALLD_SERVICES,
+                  FIREWALLD_ZONES, ETC_FIREWALLD_ZONES, LOCKDOWN_WHITELIST,
+                  FIREWALLD_DIRECT ]
+        def _key(name):
+            for i in range(len(order)):
+                if name == order[i] or name.startswith(order[i] + "/"):
+                    return i
+            return len(order)
+        names = sorted(set(names), key=lambda x: (_key(x), x))
+        if len(names) > 1:
+            log.debug1("config: Updating %d changed files", len(names))
+        for name in names:
+            try:
+                self._watch_update(name)
+            except Exception as msg:
+                log.error("Failed to update '%s': %s", name, msg)
+
+    def _watch_update(self, name):
         if name == FIREWALLD_CONF:
             old_props = self.GetAll(DBUS_INTERFACE_CONFIG)
             log.debug1("config: Reloading firewalld config file '%s'",
@@ -333,19 +365,11 @@ class FirewallDConfig(slip.dbus.service.Object):
             if sender is None:
                 log.error("Lockdown not possible, sender not set.")
                 return
-            bus = dbus.SystemBus()
-            context = context_of_sender(bus, sender)
-            if self.config.access_check("context", context):
-                return
-            uid = uid_of_sender(bus, sender)
-            if self.config.access_check("uid", uid):
-                return
-            user = user_of_uid(uid)
-            if self.config.access_check("user", user):
-                return
-            command = command_of_sender(bus, sender)
-            if self.config.access_check("command", command):
-                return
+            # only the sender attributes, that are used in the whitelist
+            # are resolved, they are cached per sender
+            for key in self.config.access_check_keys():
+                if self.config.access_check(key, sender_cache.get(sender, key)):
+                    return
             raise FirewallError(ACCESS_DENIED, "lockdown is enabled")
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -356,10 +380,13 @@ class FirewallDConfig(slip.dbus.service.Object):
     def _get_property(self, prop):
         if prop in [ "DefaultZone", "MinimalMark", "CleanupOnExit",
                      "Lockdown", "IPv6_rpfilter", "IndividualCalls",
-                     "LogDenied" ]:
+                     "LogDenied", "ForwardPortMarks",
+                     "ParallelConfigLoading", "GroupCommitWindow",
+                     "GroupCommitMaxBatch" ]:
             value = self.config.get_firewalld_conf().get(prop)
             if value is not None:
-                if prop == "MinimalMark":
+                if prop in [ "MinimalMark", "GroupCommitWindow",
+                             "GroupCommitMaxBatch" ]:
                     value = int(value)
                 return value
             else:
@@ -377,6 +404,14 @@ class FirewallDConfig(slip.dbus.service.Object):
                     return "yes" if FALLBACK_INDIVIDUAL_CALLS else "no"
                 elif prop == "LogDenied":
                     return FALLBACK_LOG_DENIED
+                elif prop == "ForwardPortMarks":
+                    return "yes" if FALLBACK_FORWARD_PORT_MARKS else "no"
+                elif prop == "ParallelConfigLoading":
+                    return "yes" if FALLBACK_PARALLEL_CONFIG_LOADING else "no"
+                elif prop == "GroupCommitWindow":
+                    return FALLBACK_GROUP_COMMIT_WINDOW
+                elif prop == "GroupCommitMaxBatch":
+                    return FALLBACK_GROUP_COMMIT_MAX_BATCH
         else:
             raise dbus.exceptions.DBusException(
                 "org.freedesktop.DBus.Error.AccessDenied: "
@@ -418,6 +453,11 @@ class FirewallDConfig(slip.dbus.service.Object):
             'IPv6_rpfilter': self._get_property("IPv6_rpfilter"),
             'IndividualCalls': self._get_property("IndividualCalls"),
             'LogDenied': self._get_property("LogDenied"),
+            'ForwardPortMarks': self._get_property("ForwardPortMarks"),
+            'ParallelConfigLoading':
+                self._get_property("ParallelConfigLoading"),
+            'GroupCommitWindow': self._get_property("GroupCommitWindow"),
+            'GroupCommitMaxBatch': self._get_property("GroupCommitMaxBatch"),
         }
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
@@ -437,19 +477,31 @@ class FirewallDConfig(slip.dbus.service.Object):
                 "FirewallD does not implement %s" % interface_name)
 
         if property_name in [ "MinimalMark", "CleanupOnExit", "Lockdown",
-                              "IPv6_rpfilter" ]:
+                              "IPv6_rpfilter", "ForwardPortMarks",
+                              "ParallelConfigLoading", "GroupCommitWindow",
+                              "GroupCommitMaxBatch" ]:
             if property_name == "MinimalMark":
                 try:
                     int(new_value)
                 except ValueError:
                     raise FirewallError(INVALID_MARK, new_value)
+            if property_name in [ "GroupCommitWindow",
+                                  "GroupCommitMaxBatch" ]:
+                minimum = 0 if property_name == "GroupCommitWindow" else 1
+                try:
+                    if int(new_value) < minimum:
+                        raise ValueError(new_value)
+                except (TypeError, ValueError):
+                    raise FirewallError(INVALID_VALUE, "'%s' for %s" % \
+                                            (new_value, property_name))
             try:
                 new_value = str(new_value)
             except:
                 raise FirewallError(INVALID_VALUE, "'%s' for %s" % \
                                             (new_value, property_name))
             if property_name in [ "CleanupOnExit", "Lockdown",
-                                  "IPv6_rpfilter" ]:
+                                  "IPv6_rpfilter", "ForwardPortMarks",
+                                  "ParallelConfigLoading" ]:
                 if new_value.lower() not in [ "yes", "no", "true", "false" ]:
                     raise FirewallError(INVALID_VALUE, "'%s' for %s" % \
                                             (new_value, property_name))
@@ -660,6 +712,19 @@ class FirewallDConfig(slip.dbus.service.Object):
 
     # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+    # C O M M I T
+
+    @dbus_service_method(DBUS_INTERFACE_CONFIG)
+    @dbus_handle_exceptions
+    def commit(self, sender=None):
+        """write pending changes of the permanent configuration to disk
+        """
+        log.debug1("config.commit()")
+        self.accessCheck(sender)
+        self.config.commit()
+
+    # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
     # I P S E T S
 
     @dbus_service_method(DBUS_INTERFACE_CONFIG, out_signature='ao')
@@ -21,6 +21,7 @@
 # force use of pygobject3 in python-slip
 from gi.repository import GObject
 import sys
+import collections
 sys.modules['gobject'] = GObject
 
 import dbus
@@ -37,7 +38,7 @@ from firewall.core.logger import log
 from firewall.server.decorators import *
 from firewall.errors import *
 from firewall.core.base import DEFAULT_ZONE_TARGET
-from firewall.core.rich import Rich_Rule
+from firewall.core.rich import rich_rule_cache
 from firewall.functions import portStr
 
 ############################################################################
@@ -788,8 +789,12 @@ class FirewallDConfigZone(slip.dbus.service.Object):
                    ",".join(rules))
         self.parent.accessCheck(sender)
         settings = list(self.getSettings())
-        rules = [ str(Rich_Rule(rule_str=r)) for r in rules ]
-        settings[12] = rules
+        # equivalent rules are only added once
+        _rules = collections.OrderedDict()
+        for r in rules:
+            obj = rich_rule_cache.get(r)
+            _rules.setdefault(obj.canonical(), str(obj))
+        settings[12] = list(_rules.values())
         self.update(settings)
 
     @dbus_service_method(DBUS_INTERFACE_CONFIG_ZONE, in_signature='s')
@@ -798,11 +803,11 @@ class FirewallDConfigZone(slip.dbus.service.Object):
         rule = dbus_to_python(rule, str)
         log.debug1("config.zone.%d.addRichRule('%s')", self.id, rule)
         self.parent.accessCheck(sender)
-        settings = list(self.getSettings())
-        rule_str = str(Rich_Rule(rule_str=rule))
-        if rule_str in settings[12]:
+        obj = rich_rule_cache.get(rule)
+        if self.obj.query_rule(obj):
             raise FirewallError(ALREADY_ENABLED, rule)
-        settings[12].append(rule_str)
+        settings = list(self.getSettings())
+        settings[12].append(str(obj))
         self.update(settings)
 
     @dbus_service_method(DBUS_INTERFACE_CONFIG_ZONE, in_signature='s')
@@ -811,11 +816,11 @@ class FirewallDConfigZone(slip.dbus.service.Object):
         rule = dbus_to_python(rule, str)
         log.debug1("config.zone.%d.removeRichRule('%s')", self.id, rule)
         self.parent.accessCheck(sender)
-        settings = list(self.getSettings())
-        rule_str = str(Rich_Rule(rule_str=rule))
-        if rule_str not in settings[12]:
+        obj = rich_rule_cache.get(rule)
+        if not self.obj.query_rule(obj):
             raise FirewallError(NOT_ENABLED, rule)
-        settings[12].remove(rule_str)
+        settings = list(self.getSettings())
+        settings[12].remove(str(self.obj.rules[obj.canonical()]))
         self.update(settings)
 
     @dbus_service_method(DBUS_INTERFACE_CONFIG_ZONE, in_signature='s',
@@ -824,5 +829,4 @@ class FirewallDConfigZone(slip.dbus.service.Object):
     def queryRichRule(self, rule, sender=None):
         rule = dbus_to_python(rule, str)
         log.debug1("config.zone.%d.queryRichRule('%s')", self.id, rule)
-        rule_str = str(Rich_Rule(rule_str=rule))
-        return rule_str in self.getSettings()[12]
+        return self.obj.query_rule(rich_rule_cache.get(rule))
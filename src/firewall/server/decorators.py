@@ -24,6 +24,7 @@ from decorator import decorator
 
 from firewall.core.logger import log
 from firewall.config.dbus import DBUS_INTERFACE
+from firewall.server.worker import serialized, group_commit
 from firewall.errors import *
 
 ############################################################################
@@ -66,5 +67,9 @@ def dbus_handle_exceptions(func, *args, **kwargs):
         raise FirewallDBusException(str(e))
 
 def dbus_service_method(*args, **kwargs):
+    """D-Bus method decorator, the method is serialized with the worker.
+    """
     kwargs.setdefault("sender_keyword", "sender")
-    return dbus.service.method(*args, **kwargs)
+    def decorate(func):
+        return serialized(dbus.service.method(*args, **kwargs)(func))
+    return decorate
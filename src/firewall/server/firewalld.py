@@ -22,6 +22,7 @@ from gi.repository import GLib, GObject
 
 # force use of pygobject3 in python-slip
 import sys
+import time
 sys.modules['gobject'] = GObject
 
 import dbus
@@ -32,12 +33,13 @@ import slip.dbus.service
 from firewall.config import *
 from firewall.config.dbus import *
 from firewall.core.fw import Firewall
-from firewall.core.rich import Rich_Rule
+from firewall.core.rich import rich_rule_cache
+from firewall.core.timeouts import Timeouts
 from firewall.core.logger import log
 from firewall.server.decorators import *
 from firewall.server.config import FirewallDConfig
-from firewall.dbus_utils import dbus_to_python, \
-    command_of_sender, context_of_sender, uid_of_sender, user_of_uid
+from firewall.server.worker import worker
+from firewall.dbus_utils import dbus_to_python, sender_cache
 from firewall.core.io.zone import Zone
 from firewall.core.io.ipset import IPSet
 from firewall.core.io.service import Service
@@ -57,33 +59,50 @@ class FirewallD(slip.dbus.service.Object):
     """ Make FirewallD persistent. """
     default_polkit_auth_required = PK_ACTION_INFO
     """ Use PK_ACTION_INFO as a default """
+    snapshot_queries = True
+    """ Answer queries from the snapshot of the worker while reloading. """
 
     @handle_exceptions
     def __init__(self, *args, **kwargs):
         super(FirewallD, self).__init__(*args, **kwargs)
-        self.fw = Firewall()
+        self._fw = Firewall()
         self.path = args[0]
         self.start()
-        self.config = FirewallDConfig(self.fw.config, self.path,
+        self.config = FirewallDConfig(self._fw.config, self.path,
                                       DBUS_PATH_CONFIG)
 
     def __del__(self):
         self.stop()
 
+    @property
+    def fw(self):
+        # the firewall is changed in a thread of the worker while reloading,
+        # queries are using the snapshot taken before in the meantime
+        if worker.snapshot is not None:
+            return worker.snapshot
+        return self._fw
+
     @handle_exceptions
     def start(self):
         # tests if iptables and ip6tables are usable using test functions
         # loads default firewall rules for iptables and ip6tables
         log.debug1("start()")
-        self._timeouts = { }
-        return self.fw.start()
+        self._timeouts = Timeouts()
+        self._timeouts_serial = 0
+        # timed rich rules: (zone, canonical form) -> rule string as given
+        # by the client, for the RichRuleRemoved signal of the timeout
+        self._timed_rich_rules = { }
+        ret = self._fw.start()
+        worker.set_group_commit(self._fw)
+        return ret
 
     @handle_exceptions
     def stop(self):
         # stops firewall: unloads firewall modules, flushes chains and tables,
         #   resets policies
         log.debug1("stop()")
-        return self.fw.stop()
+        worker.set_group_commit(None)
+        return self._fw.stop()
 
     # lockdown functions
 
@@ -93,43 +112,116 @@ class FirewallD(slip.dbus.service.Object):
             if sender is None:
                 log.error("Lockdown not possible, sender not set.")
                 return
-            bus = dbus.SystemBus()
-            context = context_of_sender(bus, sender)
-            if self.fw.policies.access_check("context", context):
-                return
-            uid = uid_of_sender(bus, sender)
-            if self.fw.policies.access_check("uid", uid):
-                return
-            user = user_of_uid(uid)
-            if self.fw.policies.access_check("user", user):
-                return
-            command = command_of_sender(bus, sender)
-            if self.fw.policies.access_check("command", command):
-                return
+            # only the sender attributes, that are used in the whitelist
+            # are resolved, they are cached per sender
+            for key in self.fw.policies.access_check_keys():
+                if self.fw.policies.access_check(key, sender_cache.get(sender, key)):
+                    return
             raise FirewallError(ACCESS_DENIED, "lockdown is enabled")
 
+    # group commit functions
+
+    def _group_commit_keys(self, kind, args):
+        # keys of the objects a grouped call is changing, calls with common
+        # keys are not grouped
+        args = [ dbus_to_python(arg) for arg in args ]
+        zone = args[0]
+        try:
+            zone = self._fw.check_zone(zone)
+        except FirewallError:
+            pass
+        keys = [ ("zone", zone) ]
+        try:
+            if kind == "interface":
+                keys.append(("interface", args[1]))
+                keys.append(("zone",
+                             self._fw.zone.get_zone_of_interface(args[1])))
+            elif kind == "source":
+                keys.append(("source", args[1].upper()))
+                keys.append(("zone",
+                             self._fw.zone.get_zone_of_source(args[1])))
+        except FirewallError:
+            pass
+        return keys
+
     # timeout functions
 
+    def _add_timeout(self, key, deadline, callback, *args):
+        self._timeouts.add(key, deadline, self._timeout_expired,
+                           self._timeouts_serial, callback, args)
+
+    def _timeout_expired(self, serial, callback, args):
+        # expired timeouts are changing the firewall, they are serialized
+        # with the other changes by the worker
+        worker.call(self._timeout_run, serial, callback, args)
+
+    def _timeout_run(self, serial, callback, args):
+        # timeouts, that expired while the firewall has been reloaded, are
+        # obsolete: the timed settings have been restored and the timeouts
+        # armed again
+        if serial == self._timeouts_serial:
+            callback(*args)
+
     @dbus_handle_exceptions
-    def addTimeout(self, zone, x, tag):
-        if zone not in self._timeouts:
-            self._timeouts[zone] = { }
-        self._timeouts[zone][x] = tag
+    def addTimeout(self, zone, x, timeout, callback, *args):
+        self._add_timeout((zone, x), time.time() + timeout, callback, *args)
 
     @dbus_handle_exceptions
     def removeTimeout(self, zone, x):
-        if zone in self._timeouts and x in self._timeouts[zone]:
-            GLib.source_remove(self._timeouts[zone][x])
-            del self._timeouts[zone][x]
+        self._timeouts.remove((zone, x))
 
     @dbus_handle_exceptions
     def cleanup_timeouts(self):
         # cleanup timeouts
-        for zone in self._timeouts:
-            for x in self._timeouts[zone]:
-                GLib.source_remove(self._timeouts[zone][x])
-            self._timeouts[zone].clear()
         self._timeouts.clear()
+        self._timeouts_serial += 1
+
+    @dbus_handle_exceptions
+    def restore_timeouts(self):
+        # (re)arm timeouts for the timed runtime settings of all zones, the
+        # deadline is calculated from the date and timeout of the setting
+        self.cleanup_timeouts()
+        timed_rich_rules = { }
+        for zone in self.fw.zone.get_zones():
+            settings = self.fw.zone.get_settings(zone)
+            for key in [ "services", "ports", "protocols", "icmp_blocks",
+                         "masquerade", "forward_ports", "rules" ]:
+                for (args, _settings) in settings[key].items():
+                    timeout = _settings.get("timeout", 0)
+                    if timeout < 1:
+                        continue
+                    deadline = _settings["date"] + timeout
+                    if key == "services":
+                        self._add_timeout((zone, args), deadline,
+                                          self.disableTimedService,
+                                          zone, args)
+                    elif key == "ports":
+                        self._add_timeout((zone, args), deadline,
+                                          self.disableTimedPort,
+                                          zone, *args)
+                    elif key == "protocols":
+                        self._add_timeout((zone, args), deadline,
+                                          self.disableTimedProtocol,
+                                          zone, args)
+                    elif key == "icmp_blocks":
+                        self._add_timeout((zone, args), deadline,
+                                          self.disableTimedIcmpBlock,
+                                          zone, args, _settings["sender"])
+                    elif key == "masquerade":
+                        self._add_timeout((zone, "masquerade"), deadline,
+                                          self.disableTimedMasquerade,
+                                          zone)
+                    elif key == "forward_ports":
+                        self._add_timeout((zone, args), deadline,
+                                          self.disable_forward_port,
+                                          zone, *args)
+                    elif key == "rules":
+                        rule = self._timed_rich_rules.get((zone, args), args)
+                        timed_rich_rules[(zone, args)] = rule
+                        self._add_timeout((zone, args), deadline,
+                                          self.disableTimedRichRule,
+                                          zone, rule)
+        self._timed_rich_rules = timed_rich_rules
 
     # property handling
 
@@ -230,24 +322,58 @@ class FirewallD(slip.dbus.service.Object):
 
     # reload
 
+    def _reload(self, stop, reply_handler, error_handler):
+        # The firewall is reloaded in a thread of the worker, queries are
+        # answered from a snapshot in the meantime. Pending writes of the
+        # permanent configuration are done before, it is reloaded also.
+        if reply_handler is None:
+            # local call
+            self._fw.reload(stop)
+            self._reloaded(None)
+            return
+
+        def callback(result, error):
+            try:
+                self._reloaded(error)
+            except dbus.exceptions.DBusException as e:
+                error_handler(e)
+            else:
+                reply_handler()
+
+        try:
+            self._fw.config.commit()
+        except FirewallError as msg:
+            log.error(msg)
+        worker.run_in_thread(self._fw.snapshot(), self._fw.reload, callback,
+                             stop)
+
+    @dbus_handle_exceptions
+    def _reloaded(self, error):
+        if error is not None:
+            raise error
+        self.restore_timeouts()
+        self.config.reload()
+        self.Reloaded()
+
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
-    @dbus_service_method(DBUS_INTERFACE, in_signature='', out_signature='')
+    @dbus_service_method(DBUS_INTERFACE, in_signature='', out_signature='',
+                         async_callbacks=('reply_handler', 'error_handler'))
     @dbus_handle_exceptions
-    def reload(self, sender=None):
+    def reload(self, sender=None, reply_handler=None, error_handler=None):
         """Reload the firewall rules.
         """
         log.debug1("reload()")
 
-        self.fw.reload()
-        self.config.reload()
-        self.Reloaded()
+        self._reload(False, reply_handler, error_handler)
 
     # complete_reload
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
-    @dbus_service_method(DBUS_INTERFACE, in_signature='', out_signature='')
+    @dbus_service_method(DBUS_INTERFACE, in_signature='', out_signature='',
+                         async_callbacks=('reply_handler', 'error_handler'))
     @dbus_handle_exceptions
-    def completeReload(self, sender=None):
+    def completeReload(self, sender=None, reply_handler=None,
+                       error_handler=None):
         """Completely reload the firewall.
 
         Completely reload the firewall: Stops firewall, unloads modules and 
@@ -255,9 +381,7 @@ class FirewallD(slip.dbus.service.Object):
         """
         log.debug1("completeReload()")
 
-        self.fw.reload(True)
-        self.config.reload()
-        self.Reloaded()
+        self._reload(True, reply_handler, error_handler)
 
     @dbus.service.signal(DBUS_INTERFACE)
     @dbus_handle_exceptions
@@ -916,6 +1040,7 @@ class FirewallD(slip.dbus.service.Object):
     # INTERFACES
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("interface")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -947,6 +1072,7 @@ class FirewallD(slip.dbus.service.Object):
         return self.changeZoneOfInterface(zone, interface, sender)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("interface")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -964,6 +1090,7 @@ class FirewallD(slip.dbus.service.Object):
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("interface")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1037,6 +1164,7 @@ class FirewallD(slip.dbus.service.Object):
     # SOURCES
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("source")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1054,6 +1182,7 @@ class FirewallD(slip.dbus.service.Object):
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("source")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1071,6 +1200,7 @@ class FirewallD(slip.dbus.service.Object):
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("source")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1136,12 +1266,13 @@ class FirewallD(slip.dbus.service.Object):
     @dbus_handle_exceptions
     def disableTimedRichRule(self, zone, rule):
         log.debug1("zone.disableTimedRichRule('%s', '%s')" % (zone, rule))
-        del self._timeouts[zone][rule]
-        obj = Rich_Rule(rule_str=rule)
+        obj = rich_rule_cache.get(rule)
+        self._timed_rich_rules.pop((zone, obj.canonical()), None)
         self.fw.zone.remove_rule(zone, obj)
         self.RichRuleRemoved(zone, rule)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ssi',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1150,18 +1281,21 @@ class FirewallD(slip.dbus.service.Object):
         rule = dbus_to_python(rule, str)
         timeout = dbus_to_python(timeout, int)
         log.debug1("zone.addRichRule('%s', '%s')" % (zone, rule))
-        obj = Rich_Rule(rule_str=rule)
+        obj = rich_rule_cache.get(rule)
         _zone = self.fw.zone.add_rule(zone, obj, timeout)
 
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout, self.disableTimedRichRule,
-                                           _zone, rule)
-            self.addTimeout(_zone, rule, tag)
+            # same key as in restore_timeouts, the signal of the timeout is
+            # using the rule string as given
+            self._timed_rich_rules[(_zone, obj.canonical())] = rule
+            self.addTimeout(_zone, obj.canonical(), timeout,
+                            self.disableTimedRichRule, _zone, rule)
 
         self.RichRuleAdded(_zone, rule, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1169,9 +1303,10 @@ class FirewallD(slip.dbus.service.Object):
         zone = dbus_to_python(zone, str)
         rule = dbus_to_python(rule, str)
         log.debug1("zone.removeRichRule('%s', '%s')" % (zone, rule))
-        obj = Rich_Rule(rule_str=rule)
+        obj = rich_rule_cache.get(rule)
         _zone = self.fw.zone.remove_rule(zone, obj)
-        self.removeTimeout(_zone, rule)
+        self._timed_rich_rules.pop((_zone, obj.canonical()), None)
+        self.removeTimeout(_zone, obj.canonical())
         self.RichRuleRemoved(_zone, rule)
         return _zone
 
@@ -1183,7 +1318,7 @@ class FirewallD(slip.dbus.service.Object):
         zone = dbus_to_python(zone, str)
         rule = dbus_to_python(rule, str)
         log.debug1("zone.queryRichRule('%s', '%s')" % (zone, rule))
-        obj = Rich_Rule(rule_str=rule)
+        obj = rich_rule_cache.get(rule)
         return self.fw.zone.query_rule(zone, obj)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG_INFO)
@@ -1215,11 +1350,11 @@ class FirewallD(slip.dbus.service.Object):
     @dbus_handle_exceptions
     def disableTimedService(self, zone, service):
         log.debug1("zone.disableTimedService('%s', '%s')" % (zone, service))
-        del self._timeouts[zone][service]
         self.fw.zone.remove_service(zone, service)
         self.ServiceRemoved(zone, service)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ssi',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1234,14 +1369,14 @@ class FirewallD(slip.dbus.service.Object):
         _zone = self.fw.zone.add_service(zone, service, timeout, sender)
 
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout, self.disableTimedService,
-                                           _zone, service)
-            self.addTimeout(_zone, service, tag)
+            self.addTimeout(_zone, service, timeout,
+                            self.disableTimedService, _zone, service)
 
         self.ServiceAdded(_zone, service, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1300,11 +1435,11 @@ class FirewallD(slip.dbus.service.Object):
     def disableTimedPort(self, zone, port, protocol):
         log.debug1("zone.disableTimedPort('%s', '%s', '%s')" % \
                        (zone, port, protocol))
-        del self._timeouts[zone][(port, protocol)]
         self.fw.zone.remove_port(zone, port, protocol)
         self.PortRemoved(zone, port, protocol)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='sssi',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1320,14 +1455,14 @@ class FirewallD(slip.dbus.service.Object):
         _zone = self.fw.zone.add_port(zone, port, protocol, timeout, sender)
 
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout, self.disableTimedPort,
-                                           _zone, port, protocol)
-            self.addTimeout(_zone, (port, protocol), tag)
+            self.addTimeout(_zone, (port, protocol), timeout,
+                            self.disableTimedPort, _zone, port, protocol)
 
         self.PortAdded(_zone, port, protocol, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='sss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1388,11 +1523,11 @@ class FirewallD(slip.dbus.service.Object):
     @dbus_handle_exceptions
     def disableTimedProtocol(self, zone, protocol):
         log.debug1("zone.disableTimedProtocol('%s', '%s')" % (zone, protocol))
-        del self._timeouts[zone][(protocol)]
         self.fw.zone.remove_protocol(zone, protocol)
         self.ProtocolRemoved(zone, protocol)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ssi',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1406,14 +1541,14 @@ class FirewallD(slip.dbus.service.Object):
         _zone = self.fw.zone.add_protocol(zone, protocol, timeout, sender)
 
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout, self.disableTimedProtocol,
-                                           _zone, protocol)
-            self.addTimeout(_zone, protocol, tag)
+            self.addTimeout(_zone, protocol, timeout,
+                            self.disableTimedProtocol, _zone, protocol)
 
         self.ProtocolAdded(_zone, protocol, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1469,11 +1604,11 @@ class FirewallD(slip.dbus.service.Object):
 
     @dbus_handle_exceptions
     def disableTimedMasquerade(self, zone):
-        del self._timeouts[zone]["masquerade"]
         self.fw.zone.remove_masquerade(zone)
         self.MasqueradeRemoved(zone)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='si',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1486,14 +1621,14 @@ class FirewallD(slip.dbus.service.Object):
         _zone = self.fw.zone.add_masquerade(zone, timeout, sender)
         
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout, self.disableTimedMasquerade,
-                                           _zone)
-            self.addTimeout(_zone, "masquerade", tag)
+            self.addTimeout(_zone, "masquerade", timeout,
+                            self.disableTimedMasquerade, _zone)
 
         self.MasqueradeAdded(_zone, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='s',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1534,11 +1669,11 @@ class FirewallD(slip.dbus.service.Object):
 
     @dbus_handle_exceptions
     def disable_forward_port(self, zone, port, protocol, toport, toaddr):
-        del self._timeouts[zone][(port, protocol, toport, toaddr)]
         self.fw.zone.remove_forward_port(zone, port, protocol, toport, toaddr)
         self.ForwardPortRemoved(zone, port, protocol, toport, toaddr)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='sssssi',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1558,16 +1693,15 @@ class FirewallD(slip.dbus.service.Object):
                                               toaddr, timeout, sender)
 
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout,
-                                           self.disable_forward_port,
-                                           _zone, port, protocol, toport,
-                                           toaddr)
-            self.addTimeout(_zone, (port, protocol, toport, toaddr), tag)
+            self.addTimeout(_zone, (port, protocol, toport, toaddr), timeout,
+                            self.disable_forward_port, _zone, port, protocol,
+                            toport, toaddr)
 
         self.ForwardPortAdded(_zone, port, protocol, toport, toaddr, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='sssss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1638,11 +1772,11 @@ class FirewallD(slip.dbus.service.Object):
     @dbus_handle_exceptions
     def disableTimedIcmpBlock(self, zone, icmp, sender):
         log.debug1("zone.disableTimedIcmpBlock('%s', '%s')" % (zone, icmp))
-        del self._timeouts[zone][icmp]
         self.fw.zone.remove_icmp_block(zone, icmp)
         self.IcmpBlockRemoved(zone, icmp)
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ssi',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1656,14 +1790,14 @@ class FirewallD(slip.dbus.service.Object):
         _zone = self.fw.zone.add_icmp_block(zone, icmp, timeout, sender)
 
         if timeout > 0:
-            tag = GLib.timeout_add_seconds(timeout, self.disableTimedIcmpBlock,
-                                           _zone, icmp, sender)
-            self.addTimeout(_zone, icmp, tag)
+            self.addTimeout(_zone, icmp, timeout,
+                            self.disableTimedIcmpBlock, _zone, icmp, sender)
 
         self.IcmpBlockAdded(_zone, icmp, timeout)
         return _zone
 
     @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
+    @group_commit("zone")
     @dbus_service_method(DBUS_INTERFACE_ZONE, in_signature='ss',
                          out_signature='s')
     @dbus_handle_exceptions
@@ -1906,8 +2040,22 @@ class FirewallD(slip.dbus.service.Object):
         self.accessCheck(sender)
         return self.fw.direct.passthrough(ipv, args)
 
+    @slip.dbus.polkit.require_auth(PK_ACTION_DIRECT)
+    @dbus_service_method(DBUS_INTERFACE_DIRECT, in_signature='saas',
+                         out_signature='a(bs)')
+    @dbus_handle_exceptions
+    def passthroughs(self, ipv, args_list, sender=None):
+        # passes several commands through, returns a result for each
+        ipv = dbus_to_python(ipv, str)
+        args_list = [ tuple( dbus_to_python(i, str) for i in args )
+                      for args in args_list ]
+        log.debug1("direct.passthroughs('%s', %d)" % (ipv, len(args_list)))
+        self.accessCheck(sender)
+        return self.fw.direct.passthroughs(ipv, args_list)
+
     # DIRECT PASSTHROUGH (tracked)
 
+    @slip.dbus.polkit.require_auth(PK_ACTION_DIRECT)
     @dbus_service_method(DBUS_INTERFACE_DIRECT, in_signature='sas',
                          out_signature='')
     @dbus_handle_exceptions
@@ -1921,6 +2069,25 @@ class FirewallD(slip.dbus.service.Object):
         self.fw.direct.add_passthrough(ipv, args)
         self.PassthroughAdded(ipv, args)
 
+    @slip.dbus.polkit.require_auth(PK_ACTION_DIRECT)
+    @dbus_service_method(DBUS_INTERFACE_DIRECT, in_signature='saas',
+                         out_signature='a(bs)')
+    @dbus_handle_exceptions
+    def addPassthroughs(self, ipv, args_list, sender=None):
+        # inserts several direct passthroughs, returns a result for each
+        ipv = dbus_to_python(ipv)
+        args_list = [ tuple( dbus_to_python(i) for i in args )
+                      for args in args_list ]
+        log.debug1("direct.addPassthroughs('%s', %d)" % \
+                   (ipv, len(args_list)))
+        self.accessCheck(sender)
+        results = self.fw.direct.add_passthroughs(ipv, args_list)
+        for (args, (ok, msg)) in zip(args_list, results):
+            if ok:
+                self.PassthroughAdded(ipv, args)
+        return results
+
+    @slip.dbus.polkit.require_auth(PK_ACTION_DIRECT)
     @dbus_service_method(DBUS_INTERFACE_DIRECT, in_signature='sas',
                          out_signature='')
     @dbus_handle_exceptions
@@ -2035,6 +2202,7 @@ class FirewallD(slip.dbus.service.Object):
 
     # set entries # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+    @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
     @dbus_service_method(DBUS_INTERFACE_IPSET, in_signature='ss',
                          out_signature='')
     @dbus_handle_exceptions
@@ -2047,6 +2215,7 @@ class FirewallD(slip.dbus.service.Object):
         self.fw.ipset.add_entry(ipset, entry)
         self.EntryAdded(ipset, entry)
 
+    @slip.dbus.polkit.require_auth(PK_ACTION_CONFIG)
     @dbus_service_method(DBUS_INTERFACE_IPSET, in_signature='ss',
                          out_signature='')
     @dbus_handle_exceptions
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import functools
+import threading
+
+from gi.repository import GLib
+
+from firewall.config.dbus import PK_ACTION_INFO, PK_ACTION_CONFIG_INFO, \
+    PK_ACTION_DIRECT_INFO, PK_ACTION_POLICIES_INFO
+from firewall.core.logger import log
+
+class Worker(object):
+    """ Serialized execution of the operations changing the firewall
+
+    Operations are executed one after the other in the order they have been
+    added. An operation gets a done function as first argument, that has to
+    be called when the operation is complete. For a D-Bus method the reply
+    is passed to done as callback with its arguments, done sends it then.
+    The next operation is started in an idle callback of the main loop.
+
+    An operation can do its work in a thread with run_in_thread, the main
+    loop is not blocked by this. Queries are answered from the snapshot in
+    the meantime.
+
+    Grouped operations, that are waiting in the queue and do not conflict
+    with each other, are executed as a batch with a combined rule commit, see
+    Batch. The worker waits for the group commit window to collect them.
+    """
+
+    def __init__(self):
+        self._queue = collections.deque() # (func, args, keys)
+        self._running = False
+        self._threaded = False
+        self._source = None
+        self._window = False
+        self._waited = False
+        self._fw = None
+        self.snapshot = None
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__, self._running,
+                                   self._threaded, len(self._queue))
+
+    def __len__(self):
+        return len(self._queue)
+
+    def busy(self):
+        return self._running or self._threaded or len(self._queue) > 0
+
+    def threaded(self):
+        return self._threaded
+
+    def set_group_commit(self, fw):
+        """ Group the rule commits of grouped operations for fw, no rule
+            commits are grouped if fw is None
+        """
+        self._fw = fw
+
+    def _group_commit(self):
+        if self._fw is None:
+            return (0, 1)
+        return self._fw.get_group_commit()
+
+    def add(self, func, *args):
+        """ Call func(done, *args) after all operations, that have been added
+            before, are done. The operation is started right away if the
+            worker is idle.
+        """
+        self._add(func, args, None)
+
+    def add_grouped(self, keys, func, *args):
+        """ Add the operation func(done, *args), that can be executed in a
+            batch with other grouped operations. keys is called when the batch
+            is formed and returns the keys of the objects the operation
+            changes, operations with common keys are not executed in the same
+            batch.
+        """
+        self._add(func, args, keys)
+
+    def _add(self, func, args, keys):
+        self._queue.append((func, args, keys))
+        if self._window:
+            # start the batch early if it is complete
+            if self._grouped() >= self._group_commit()[1]:
+                GLib.source_remove(self._source)
+                self._window_expired()
+        elif self._source is None:
+            self._next()
+
+    def call(self, func, *args):
+        """ Add the operation func(*args), that is done when it returns """
+        self.add(self._call, func, args)
+
+    def _call(self, done, func, args):
+        try:
+            func(*args)
+        finally:
+            done()
+
+    def _schedule(self):
+        if not self._running and not self._threaded and \
+           len(self._queue) > 0 and self._source is None:
+            self._source = GLib.idle_add(self._next)
+
+    def _grouped(self):
+        # number of grouped operations at the head of the queue
+        count = 0
+        for (func, args, keys) in self._queue:
+            if keys is None:
+                break
+            count += 1
+        return count
+
+    def _window_expired(self):
+        self._window = False
+        self._waited = True
+        return self._next()
+
+    def _batch(self, max_batch):
+        # grouped operations at the head of the queue without common keys
+        jobs = [ ]
+        used = set()
+        for (func, args, keys) in self._queue:
+            if keys is None or len(jobs) >= max_batch:
+                break
+            try:
+                _keys = set(keys())
+            except Exception:
+                log.exception()
+                break
+            if len(used & _keys) > 0:
+                break
+            used |= _keys
+            jobs.append((func, args))
+        return jobs
+
+    def _next(self):
+        self._source = None
+        if self._running or self._threaded or len(self._queue) < 1:
+            # remove this GLib source
+            return False
+        (window, max_batch) = self._group_commit()
+        if max_batch > 1 and self._queue[0][2] is not None:
+            if not self._waited and window > 0 and \
+               self._grouped() < max_batch:
+                # wait for more operations to join the batch
+                self._window = True
+                self._source = GLib.timeout_add(window, self._window_expired)
+                return False
+            self._waited = False
+            jobs = self._batch(max_batch)
+            if len(jobs) > 1:
+                for i in range(len(jobs)):
+                    self._queue.popleft()
+                self._running = True
+                try:
+                    Batch(self._fw, jobs).run()
+                except Exception:
+                    log.exception()
+                self._running = False
+                self._schedule()
+                # remove this GLib source
+                return False
+        (func, args, keys) = self._queue.popleft()
+        self._running = True
+        # done is only used once
+        state = { "done": False }
+        def done(callback=None, *args):
+            if not state["done"]:
+                state["done"] = True
+                self._running = False
+                self._schedule()
+            if callback is not None:
+                callback(*args)
+        try:
+            func(done, *args)
+        except Exception:
+            log.exception()
+            done()
+        # remove this GLib source
+        return False
+
+    def run_in_thread(self, snapshot, func, callback, *args):
+        """ Call func(*args) in a thread and callback(result, error) in the
+            main loop when it returns, error is the exception raised by func
+            or None. No other operation is started while the thread is
+            running, snapshot is provided for queries in the meantime.
+        """
+        if self._threaded:
+            raise RuntimeError("Worker thread is already running")
+        self.snapshot = snapshot
+        self._threaded = True
+        thread = threading.Thread(target=self._thread,
+                                  args=(func, args, callback))
+        thread.daemon = True
+        thread.start()
+
+    def _thread(self, func, args, callback):
+        try:
+            result = (func(*args), None)
+        except Exception as error:
+            result = (None, error)
+        GLib.idle_add(self._thread_done, callback, result)
+
+    def _thread_done(self, callback, result):
+        self._threaded = False
+        self.snapshot = None
+        try:
+            callback(*result)
+        except Exception:
+            log.exception()
+        self._schedule()
+        # remove this GLib source
+        return False
+
+# commands undoing the command of a restore rule
+REVERSE_COMMANDS = { "-A": "-D", "-I": "-D", "-D": "-A", "-N": "-X",
+                     "-X": "-N" }
+
+def reverse_rule(rule):
+    """ Return the restore rule undoing rule: added rules are deleted,
+        deleted rules are appended like in the cleanup of handle_rules,
+        created chains are deleted and deleted chains created again
+    """
+    rule = list(rule)
+    for (i, arg) in enumerate(rule):
+        if arg in REVERSE_COMMANDS:
+            # drop the rule number of an insert
+            if arg == "-I" and len(rule) > i + 2 and rule[i + 2].isdigit():
+                del rule[i + 2]
+            rule[i] = REVERSE_COMMANDS[arg]
+            break
+    return rule
+
+class Batch(object):
+    """ Execution of grouped operations with a combined rule commit
+
+    The operations are executed one after the other in the main loop. The
+    rules they give to handle_rules and handle_chains are collected by the
+    rules committer and the operations continue as if the rules had been
+    applied. Afterwards the rules are committed with one restore call for
+    each ip family and table, the replies are sent then.
+
+    A restore call applies all or none of the rules of a table. If a call
+    fails, the calls that succeeded before are reverted with the reverse
+    rules. The runtime state is rolled back to the checkpoint taken before
+    the batch and the operations are executed again one after the other
+    with their own rule commits, the replies are sent from this run. Only
+    the D-Bus signals of the first run have been sent already.
+    """
+
+    def __init__(self, fw, jobs):
+        self._fw = fw
+        self._jobs = jobs # (func, args)
+        self._parts = { } # (ipv, table): [ rule ]
+        self._replies = [ ] # (callback, args)
+
+    def run(self):
+        self._fw.checkpoint()
+        self._fw.set_rules_committer(self.commit)
+        try:
+            for (func, args) in self._jobs:
+                self._call(func, args, self._done)
+            committed = self._commit()
+        except Exception:
+            log.exception()
+            committed = False
+        if not committed:
+            self._fw.rollback()
+            self._fw.set_rules_committer(None)
+            # execute the operations again with their own rule commits
+            for (func, args) in self._jobs:
+                self._call(func, args, self._send)
+            return
+        self._fw.set_rules_committer(None)
+        self._fw.release()
+        for (callback, args) in self._replies:
+            self._send(callback, *args)
+
+    def _call(self, func, args, done):
+        try:
+            func(done, *args)
+        except Exception:
+            log.exception()
+
+    def _done(self, callback=None, *args):
+        if callback is not None:
+            self._replies.append((callback, args))
+
+    def _send(self, callback=None, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            log.exception()
+
+    def commit(self, rules, values):
+        """ Rules committer for Firewall.set_rules_committer: the rules are
+            collected for each ip family and table. The table is given with
+            -t or it is the table of the previous rule, like in
+            ipXtables.set_rules.
+        """
+        for ipv in rules:
+            table = "filter"
+            for rule in rules[ipv]:
+                if "-t" in rule:
+                    table = rule[rule.index("-t") + 1]
+                else:
+                    rule = [ "-t", table ] + rule
+                self._parts.setdefault((ipv, table), [ ]).append(list(rule))
+        return None
+
+    def _commit(self):
+        # apply the collected rules with one call for each ip family and
+        # table, the calls applied before are reverted if one fails
+        applied = [ ]
+        for key in sorted(self._parts):
+            try:
+                self._fw.rules(key[0], self._parts[key])
+            except Exception as msg:
+                log.debug1("Group commit failed for %s %s: %s" % \
+                           (key[0], key[1], msg))
+                for key in reversed(applied):
+                    self._revert(key)
+                return False
+            applied.append(key)
+        return True
+
+    def _revert(self, key):
+        rules = [ reverse_rule(rule) for rule in reversed(self._parts[key]) ]
+        try:
+            self._fw.rules(key[0], rules)
+        except Exception as msg:
+            log.error("Failed to revert rules. A firewall reload might solve the issue if the firewall has been modified using ip*tables or ebtables.")
+            log.error(msg)
+
+worker = Worker()
+
+QUERY_ACTIONS = ( PK_ACTION_INFO, PK_ACTION_CONFIG_INFO, PK_ACTION_DIRECT_INFO,
+                  PK_ACTION_POLICIES_INFO )
+
+def serialized(method):
+    """ Make the D-Bus method asynchronous and execute it with the worker
+
+    Queries, these are methods with a read only polkit action, are executed
+    right away unless a thread of the worker is running. Objects with
+    snapshot_queries set answer them also then from the snapshot. All other
+    calls are executed by the worker in the order they arrived. The reply is
+    sent when the call is done. Local calls are executed directly.
+
+    Methods marked with group_commit are grouped operations of the worker,
+    the object provides the keys with _group_commit_keys(kind, args).
+    """
+    is_async = method._dbus_async_callbacks is not None
+    if is_async:
+        (reply_keyword, error_keyword) = method._dbus_async_callbacks
+    else:
+        (reply_keyword, error_keyword) = ("reply_handler", "error_handler")
+
+    def execute(done, obj, args, kwargs):
+        reply_handler = kwargs.pop(reply_keyword)
+        error_handler = kwargs.pop(error_keyword)
+        def reply(*result):
+            done(reply_handler, *result)
+        def error(exception):
+            done(error_handler, exception)
+        if is_async:
+            kwargs[reply_keyword] = reply
+            kwargs[error_keyword] = error
+        try:
+            result = method(obj, *args, **kwargs)
+        except Exception as e:
+            error(e)
+            return
+        if is_async:
+            return
+        if result is None:
+            reply()
+        else:
+            reply(result)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if reply_keyword not in kwargs:
+            return method(self, *args, **kwargs)
+        action = getattr(wrapper, "_slip_polkit_auth_required",
+                         getattr(self, "default_polkit_auth_required", None))
+        if action in QUERY_ACTIONS and \
+           (not worker.threaded() or getattr(self, "snapshot_queries", False)):
+            execute(lambda callback, *args: callback(*args), self, args,
+                    kwargs)
+            return
+        kind = getattr(wrapper, "_group_commit", None)
+        if kind is None:
+            worker.add(execute, self, args, kwargs)
+        else:
+            keys = lambda: self._group_commit_keys(kind, args)
+            worker.add_grouped(keys, execute, self, args, kwargs)
+
+    wrapper._dbus_async_callbacks = (reply_keyword, error_keyword)
+    return wrapper
+
+def group_commit(kind):
+    """ Mark the serialized D-Bus method as grouped operation of the kind """
+    def decorate(method):
+        method._group_commit = kind
+        return method
+    return decorate
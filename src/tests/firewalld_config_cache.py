@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_config_cache.py
+
+import shutil
+import tempfile
+import unittest
+
+from firewall.core.io.config_cache import ConfigCache
+from firewall.core.io.service import service_reader
+
+# files read by reader in this process
+read = [ ]
+
+def reader(filename, path):
+    read.append(filename)
+    return service_reader(filename, path)
+
+class ConfigCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = "%s/cache/config.cache" % self.dir
+        del read[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, short):
+        with open("%s/%s" % (self.dir, name), "w") as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n<service>\n'
+                    '<short>%s</short>\n<port protocol="tcp" port="22"/>\n'
+                    '</service>\n' % short)
+
+    def cache(self):
+        # new cache read from the file
+        cache = ConfigCache(self.filename)
+        cache.read()
+        return cache
+
+    def get(self, cache, name):
+        return cache.get(reader, name, self.dir)
+
+class TestConfigCache(ConfigCacheTestCase):
+    """
+    Objects are taken from the cache unless the file, the cache or its entry
+    has been changed.
+    """
+    def test_cached(self):
+        self.write("a.xml", "A")
+        cache = self.cache()
+        self.assertEqual(self.get(cache, "a.xml").short, "A")
+        cache.write()
+        self.assertEqual(read, [ "a.xml" ])
+
+        obj = self.get(self.cache(), "a.xml")
+        self.assertEqual(read, [ "a.xml" ])
+        self.assertEqual(obj.short, "A")
+        self.assertEqual(obj.ports, [ ("22", "tcp") ])
+
+    def test_changed_file(self):
+        self.write("a.xml", "A")
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        cache.write()
+        self.write("a.xml", "changed")
+        self.assertEqual(self.get(self.cache(), "a.xml").short, "changed")
+        self.assertEqual(read, [ "a.xml", "a.xml" ])
+
+    def test_unused_entries(self):
+        # entries of files, that have not been used, are dropped on write
+        self.write("a.xml", "A")
+        self.write("b.xml", "B")
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        self.get(cache, "b.xml")
+        cache.write()
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        cache.write()
+        del read[:]
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        self.get(cache, "b.xml")
+        self.assertEqual(read, [ "b.xml" ])
+
+    def test_stale_cache(self):
+        # a cache of an other format or version is ignored
+        self.write("a.xml", "A")
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        header = cache._header()
+        cache._header = lambda: (header[0], header[1] - 1) + header[2:]
+        cache.write()
+        self.assertEqual(self.get(self.cache(), "a.xml").short, "A")
+        self.assertEqual(read, [ "a.xml", "a.xml" ])
+
+    def test_corrupt_cache(self):
+        self.write("a.xml", "A")
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        cache.write()
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        # truncated file
+        with open(self.filename, "wb") as f:
+            f.write(data[:len(data) // 2])
+        self.assertEqual(self.get(self.cache(), "a.xml").short, "A")
+        # garbage
+        with open(self.filename, "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(self.get(self.cache(), "a.xml").short, "A")
+        self.assertEqual(read, [ "a.xml" ] * 3)
+
+    def test_corrupt_entry(self):
+        # an entry, that can not be loaded, is replaced
+        self.write("a.xml", "A")
+        cache = self.cache()
+        self.get(cache, "a.xml")
+        for key in cache._entries:
+            cache._entries[key] = (cache._entries[key][0], b"garbage")
+        cache.write()
+        cache = self.cache()
+        self.assertEqual(self.get(cache, "a.xml").short, "A")
+        cache.write()
+        self.assertEqual(self.get(self.cache(), "a.xml").short, "A")
+        self.assertEqual(read, [ "a.xml", "a.xml" ])
+
+class TestPreload(ConfigCacheTestCase):
+    """
+    Files parsed in worker processes are used like cached objects.
+    """
+    def test_preload(self):
+        names = [ "%s.xml" % x for x in "abc" ]
+        for name in names:
+            self.write(name, name[0].upper())
+        cache = self.cache()
+        cache.preload([ (reader, name, self.dir) for name in names ],
+                      processes=2)
+        self.assertEqual([ self.get(cache, name).short for name in names ],
+                         [ "A", "B", "C" ])
+        # the files have been read in the worker processes
+        self.assertEqual(read, [ ])
+
+        # only changed files are parsed again
+        cache.write()
+        self.write("b.xml", "changed")
+        cache = self.cache()
+        cache.preload([ (reader, name, self.dir) for name in names ],
+                      processes=2)
+        self.assertEqual([ self.get(cache, name).short for name in names ],
+                         [ "A", "changed", "C" ])
+        self.assertEqual(read, [ "b.xml" ])
+
+    def test_failed_parse(self):
+        # errors are reported by the reader in this process
+        self.write("a.xml", "A")
+        with open("%s/b.xml" % self.dir, "w") as f:
+            f.write("<service><short>B</short")
+        cache = self.cache()
+        cache.preload([ (reader, name, self.dir)
+                        for name in [ "a.xml", "b.xml" ] ], processes=2)
+        self.assertEqual(self.get(cache, "a.xml").short, "A")
+        self.assertRaises(Exception, self.get, cache, "b.xml")
+        self.assertEqual(read, [ "b.xml" ])
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestConfigCache),
+        loader.loadTestsFromTestCase(TestPreload) ])
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_config_writer.py
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import firewall.core.fw_config
+from firewall.core.fw_config import FirewallConfig
+from firewall.core.io.service import Service, service_writer
+from firewall.errors import FirewallError
+
+class TestConfigWriter(unittest.TestCase):
+    """
+    Coalesced writes of the permanent configuration files.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._etc_firewalld = firewall.core.fw_config.ETC_FIREWALLD
+        firewall.core.fw_config.ETC_FIREWALLD = self.dir
+        self.config = FirewallConfig(None)
+        self.config.set_write_delay(60)
+        self.written = [ ]
+
+    def tearDown(self):
+        self.config.set_write_delay(0)
+        firewall.core.fw_config.ETC_FIREWALLD = self._etc_firewalld
+        shutil.rmtree(self.dir)
+
+    def service(self, name):
+        obj = Service()
+        obj.name = name
+        obj.filename = "%s.xml" % name
+        obj.path = "%s/services" % self.dir
+        return obj
+
+    def writer(self, obj, path=None):
+        self.written.append(obj.name)
+        service_writer(obj, path)
+
+    def read(self, obj):
+        with open("%s/%s" % (obj.path, obj.filename)) as f:
+            return f.read()
+
+    def test_coalesce(self):
+        a = self.service("a")
+        b = self.service("b")
+        for i in range(10):
+            a.short = "a%d" % i
+            self.config._write(self.writer, a)
+        self.config._write(self.writer, b)
+        # nothing is written before the commit
+        self.assertEqual(self.written, [ ])
+        self.assertTrue(self.config._write_pending("%s/a.xml" % a.path))
+        self.assertFalse(os.path.exists("%s/a.xml" % a.path))
+
+        self.config.commit()
+        # every file is written once with the last settings
+        self.assertEqual(sorted(self.written), [ "a", "b" ])
+        self.assertTrue("<short>a9</short>" in self.read(a))
+        self.assertFalse(self.config._write_pending("%s/a.xml" % a.path))
+        self.assertEqual([ x for x in os.listdir(self.dir)
+                           if x.startswith(".write.") ], [ ])
+
+        # the previous version is kept as backup
+        a.short = "new"
+        self.config._write(self.writer, a)
+        self.config.commit()
+        self.assertTrue("<short>new</short>" in self.read(a))
+        with open("%s/a.xml.old" % a.path) as f:
+            self.assertTrue("<short>a9</short>" in f.read())
+
+    def test_remove(self):
+        a = self.service("a")
+        self.config._write(self.writer, a)
+        # a pending file, that does not exist yet, is only dropped
+        self.config._remove_file("%s/a.xml" % a.path)
+        self.config.commit()
+        self.assertEqual(self.written, [ ])
+        self.assertFalse(os.path.exists("%s/a.xml" % a.path))
+
+    def test_failed_write(self):
+        a = self.service("a")
+        b = self.service("b")
+        def writer(obj, path=None):
+            if obj.name == "a":
+                raise IOError("disk full")
+            service_writer(obj, path)
+        self.config._write(writer, a)
+        self.config._write(writer, b)
+        self.assertRaises(FirewallError, self.config.commit)
+        # the other files are committed
+        self.assertFalse(os.path.exists("%s/a.xml" % a.path))
+        self.assertTrue(os.path.exists("%s/b.xml" % b.path))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestConfigWriter)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_dbus_utils.py
+
+import os
+import unittest
+
+import dbus.exceptions
+from firewall.dbus_utils import Sender_Cache
+
+class FakeBusInterface(object):
+    """
+    Interface of the bus daemon with the connected senders:
+    unique name -> (uid, pid). The method calls are counted.
+    """
+    def __init__(self):
+        self.senders = { }
+        self.calls = [ ]
+
+    def __lookup(self, sender):
+        if sender not in self.senders:
+            raise dbus.exceptions.DBusException(
+                "The connection does not exist: %s" % sender)
+        return self.senders[sender]
+
+    def GetConnectionSELinuxSecurityContext(self, sender):
+        self.calls.append(("context", sender))
+        self.__lookup(sender)
+        raise dbus.exceptions.DBusException("SELinux is not enabled")
+
+    def GetConnectionUnixUser(self, sender):
+        self.calls.append(("uid", sender))
+        return self.__lookup(sender)[0]
+
+    def GetConnectionUnixProcessID(self, sender):
+        self.calls.append(("pid", sender))
+        return self.__lookup(sender)[1]
+
+class TestSenderCache(unittest.TestCase):
+    """
+    Lookups of the sender identity, that are kept until the sender vanishes.
+    """
+    def setUp(self):
+        self.iface = FakeBusInterface()
+        self.cache = Sender_Cache()
+        self.cache._iface = self.iface
+
+    def vanish(self, sender):
+        del self.iface.senders[sender]
+        self.cache._Sender_Cache__name_owner_changed(sender, sender, "")
+
+    def test_cached(self):
+        self.iface.senders[":1.1"] = (0, os.getpid())
+        for i in range(3):
+            self.assertEqual(self.cache.get(":1.1", "uid"), 0)
+            self.assertEqual(self.cache.get(":1.1", "user"), "root")
+            self.assertTrue(self.cache.get(":1.1", "command"))
+        self.assertEqual(self.iface.calls, [ ("uid", ":1.1"),
+                                             ("pid", ":1.1") ])
+        self.vanish(":1.1")
+        self.assertEqual(self.cache._senders, { })
+
+    def test_vanished(self):
+        # the sender has vanished before the lookup, NameOwnerChanged has
+        # been handled already
+        self.assertRaises(dbus.exceptions.DBusException, self.cache.get,
+                          ":1.2", "uid")
+        self.assertEqual(self.cache.get(":1.2", "context"), None)
+        self.assertEqual(self.cache._senders, { })
+
+    def test_failed_lookup(self):
+        # failed lookups are not cached, they are done again
+        self.iface.senders[":1.3"] = (0, 0)
+        self.assertEqual(self.cache.get(":1.3", "context"), None)
+        self.assertEqual(self.cache.get(":1.3", "context"), None)
+        self.assertEqual(self.iface.calls, [ ("context", ":1.3"),
+                                             ("context", ":1.3") ])
+        self.assertEqual(self.cache._senders, { })
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSenderCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_direct_batch.py
+
+import unittest
+
+from firewall.core.fw import Firewall
+
+def restore_split(line):
+    # split a restore line into arguments like ip*tables-restore: double
+    # quotes group an argument, within quotes the character after a
+    # backslash is taken as is
+    args = [ ]
+    arg = None
+    quoted = False
+    escaped = False
+    for c in line:
+        if quoted:
+            if escaped:
+                arg += c
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                quoted = False
+            else:
+                arg += c
+        elif c == '"':
+            quoted = True
+            if arg is None:
+                arg = ""
+        elif c in " \t":
+            if arg is not None:
+                args.append(arg)
+                arg = None
+        else:
+            arg = c if arg is None else arg + c
+    if arg is not None:
+        args.append(arg)
+    return args
+
+def table_first(args):
+    # move the table option to the front
+    args = list(args)
+    for opt in [ "-t", "--table" ]:
+        if opt in args and args.index(opt) > 0:
+            i = args.index(opt)
+            args = [ "-t", args[i+1] ] + args[:i] + args[i+2:]
+    if args[0] != "-t":
+        args = [ "-t", "filter" ] + args
+    return args
+
+class RecordingFirewall(Firewall):
+    """
+    Firewall, that records the commands instead of running them. Restore
+    calls are recorded as the arguments the restore parser gets from the
+    lines, commands with an argument in fail are failing.
+    """
+    def __init__(self):
+        super(RecordingFirewall, self).__init__()
+        self.calls = [ ] # ("rule" | "rules", [ args ])
+        self.fail = set()
+
+    def is_table_available(self, ipv, table):
+        return True
+
+    def rule(self, ipv, rule):
+        if len(self.fail & set(rule)) > 0:
+            raise Exception("failed: %s" % " ".join(rule))
+        self.calls.append(("rule", [ table_first(rule) ]))
+        return "output of %s" % " ".join(rule)
+
+    def rules(self, ipv, rules):
+        # ip*tables-restore gets the arguments joined with spaces
+        _rules = [ restore_split(" ".join(rule)) for rule in rules ]
+        for rule in _rules:
+            if len(self.fail & set(rule)) > 0:
+                raise Exception("failed: %s" % " ".join(rule))
+        self.calls.append(("rules", [ table_first(rule) for rule in _rules ]))
+
+    def commands(self):
+        # all applied commands in order
+        return [ args for (kind, _args) in self.calls for args in _args ]
+
+class TestDirectConfigBatch(unittest.TestCase):
+    """
+    The direct configuration applied with one restore call per table is
+    compared with the individual calls.
+    """
+    def config(self):
+        chains = { ("ipv4", "filter"): [ "chain1", "chain2" ],
+                   ("ipv4", "mangle"): [ "chain3" ] }
+        rules = { ("ipv4", "filter", "chain1"):
+                  [ (2, ("-s", "10.0.0.2", "-j", "ACCEPT")),
+                    (0, ("-s", "10.0.0.0", "-j", "ACCEPT")),
+                    (1, ("-m", "comment", "--comment",
+                         'a "quoted" \\ comment', "-j", "DROP")),
+                    (0, ("-s", "10.0.0.1", "-j", "ACCEPT")),
+                    (-1, ("-m", "comment", "--comment", "", "-j",
+                          "RETURN")) ],
+                  ("ipv4", "mangle", "chain3"):
+                  [ (0, ("-j", "MARK", "--set-mark", "1")) ],
+                  ("eb", "filter", "chain4"):
+                  [ (0, ("-j", "ACCEPT")) ] }
+        passthroughs = { "ipv4": [ [ "-A", "chain2", "-t", "filter",
+                                     "-j", "ACCEPT" ],
+                                   [ "-t", "mangle", "-A", "chain3",
+                                     "-m", "comment", "--comment",
+                                     "it's", "-j", "ACCEPT" ] ] }
+        return (chains, rules, passthroughs)
+
+    def apply(self, individual):
+        fw = RecordingFirewall()
+        fw._individual_calls = individual
+        fw.direct.set_config(self.config())
+        return fw
+
+    def test_batch(self):
+        batch = self.apply(False)
+        single = self.apply(True)
+
+        # one restore call per ip family and table, ebtables rules are
+        # applied individually
+        self.assertEqual([ (kind, args[0][1]) for (kind, args) in batch.calls
+                           if kind == "rules" ],
+                         [ ("rules", "filter"), ("rules", "mangle") ])
+        self.assertEqual([ x for x in batch.calls if x[0] == "rule" ],
+                         [ ("rule", [ [ "-t", "filter", "-I", "chain4", "1",
+                                        "-j", "ACCEPT" ] ]) ])
+
+        # the same commands as with individual calls
+        self.assertEqual(sorted(batch.commands()),
+                         sorted(single.commands()))
+
+        # the rules of a chain are inserted in the same order with the
+        # same positions
+        for fw in [ batch, single ]:
+            self.assertEqual(
+                [ x[3:] for x in fw.commands() if x[2:4] == [ "-I", "chain1" ] ],
+                [ [ "chain1", "1", "-s", "10.0.0.2", "-j", "ACCEPT" ],
+                  [ "chain1", "1", "-s", "10.0.0.0", "-j", "ACCEPT" ],
+                  [ "chain1", "2", "-m", "comment", "--comment",
+                    'a "quoted" \\ comment', "-j", "DROP" ],
+                  [ "chain1", "2", "-s", "10.0.0.1", "-j", "ACCEPT" ],
+                  [ "chain1", "1", "-m", "comment", "--comment", "",
+                    "-j", "RETURN" ] ])
+        # the same state with the rules in the same order
+        self.assertEqual(batch.direct.get_all_chains(),
+                         single.direct.get_all_chains())
+        self.assertEqual(batch.direct.get_all_rules(),
+                         single.direct.get_all_rules())
+        self.assertEqual(batch.direct.get_all_passthroughs(),
+                         single.direct.get_all_passthroughs())
+
+    def test_newline(self):
+        # an argument with a newline can not be used in restore syntax
+        fw = RecordingFirewall()
+        fw.direct.set_config(({ }, { ("ipv4", "filter", "INPUT"):
+                                     [ (0, ("-m", "comment", "--comment",
+                                            "a\n-A INPUT", "-j",
+                                            "ACCEPT")) ] }, { }))
+        self.assertEqual(fw.calls,
+                         [ ("rule", [ [ "-t", "filter", "-I", "INPUT_direct",
+                                        "1", "-m", "comment", "--comment",
+                                        "a\n-A INPUT", "-j", "ACCEPT" ] ]) ])
+
+    def test_fallback(self):
+        # a failed restore call is applied one by one, only the failing
+        # rule is missing
+        fw = RecordingFirewall()
+        fw.fail.add("10.0.0.2")
+        fw.direct.set_config(self.config())
+        self.assertEqual([ kind for (kind, args) in fw.calls
+                           if args[0][1] == "filter" ][:2],
+                         [ "rule", "rule" ])
+        rules = [ x[1] for x in fw.direct.get_all_rules()
+                  if x[2] == "chain1" ]
+        self.assertEqual(len(rules), 4)
+
+class TestPassthroughs(unittest.TestCase):
+    """
+    Batched passthroughs keep the order of the commands, runs of commands
+    are flushed before a command, that can not be batched.
+    """
+    def test_order(self):
+        fw = RecordingFirewall()
+        args_list = [ [ "-A", "INPUT", "-j", "ACCEPT" ],
+                      [ "-t", "nat", "-A", "POSTROUTING", "-j", "ACCEPT" ],
+                      [ "-I", "INPUT", "-s", "10.0.0.1", "-j", "DROP" ],
+                      [ "-C", "INPUT", "-j", "ACCEPT" ],
+                      [ "-A", "FORWARD", "-j", "ACCEPT" ],
+                      [ "-L", "-t", "nat" ],
+                      [ "-D", "INPUT", "-j", "ACCEPT" ] ]
+        results = fw.direct.passthroughs("ipv4", args_list)
+        self.assertEqual(fw.calls,
+                         [ ("rules", [ [ "-t", "filter", "-A", "INPUT",
+                                         "-j", "ACCEPT" ],
+                                       [ "-t", "filter", "-I", "INPUT",
+                                         "-s", "10.0.0.1", "-j", "DROP" ] ]),
+                           ("rules", [ [ "-t", "nat", "-A", "POSTROUTING",
+                                         "-j", "ACCEPT" ] ]),
+                           ("rule", [ [ "-t", "filter", "-C", "INPUT",
+                                        "-j", "ACCEPT" ] ]),
+                           ("rules", [ [ "-t", "filter", "-A", "FORWARD",
+                                         "-j", "ACCEPT" ] ]),
+                           ("rule", [ [ "-t", "nat", "-L" ] ]),
+                           ("rules", [ [ "-t", "filter", "-D", "INPUT",
+                                         "-j", "ACCEPT" ] ]) ])
+        # batched commands have no output
+        self.assertEqual(results,
+                         [ (True, ""), (True, ""), (True, ""),
+                           (True, "output of -C INPUT -j ACCEPT"),
+                           (True, ""), (True, "output of -L -t nat"),
+                           (True, "") ])
+
+    def test_individual(self):
+        # the same commands are passed through one by one
+        fw = RecordingFirewall()
+        fw._individual_calls = True
+        args_list = [ [ "-A", "INPUT", "-j", "ACCEPT" ],
+                      [ "-L", "INPUT" ] ]
+        results = fw.direct.passthroughs("ipv4", args_list)
+        self.assertEqual([ kind for (kind, args) in fw.calls ],
+                         [ "rule", "rule" ])
+        self.assertEqual(results,
+                         [ (True, "output of -A INPUT -j ACCEPT"),
+                           (True, "output of -L INPUT") ])
+
+    def test_failed_batch(self):
+        # a failed restore call is retried one by one to get the results
+        fw = RecordingFirewall()
+        fw.fail.add("DROP")
+        args_list = [ [ "-A", "INPUT", "-j", "ACCEPT" ],
+                      [ "-A", "INPUT", "-j", "DROP" ],
+                      [ "-A", "INPUT", "-j", "REJECT" ] ]
+        results = fw.direct.passthroughs("ipv4", args_list)
+        self.assertEqual([ kind for (kind, args) in fw.calls ],
+                         [ "rule", "rule" ])
+        self.assertEqual([ ok for (ok, msg) in results ],
+                         [ True, False, True ])
+        self.assertTrue("COMMAND_FAILED" in results[1][1])
+
+    def test_add_passthroughs(self):
+        fw = RecordingFirewall()
+        fw.direct.add_passthrough("ipv4", [ "-A", "INPUT", "-j", "ACCEPT" ])
+        del fw.calls[:]
+        args_list = [ [ "-A", "INPUT", "-j", "ACCEPT" ],
+                      [ "-A", "INPUT", "-j", "DROP" ],
+                      [ "-A", "INPUT", "-j", "DROP" ],
+                      [ "-L", "INPUT" ],
+                      [ "-t", "nat", "-A", "POSTROUTING", "-j", "ACCEPT" ] ]
+        results = fw.direct.add_passthroughs("ipv4", args_list)
+        self.assertEqual([ ok for (ok, msg) in results ],
+                         [ False, True, False, False, True ])
+        self.assertEqual(results[1], (True, ""))
+        self.assertEqual(fw.calls,
+                         [ ("rules", [ [ "-t", "filter", "-A", "INPUT",
+                                         "-j", "DROP" ] ]),
+                           ("rules", [ [ "-t", "nat", "-A", "POSTROUTING",
+                                         "-j", "ACCEPT" ] ]) ])
+        self.assertEqual(fw.direct.get_passthroughs("ipv4"),
+                         [ [ "-A", "INPUT", "-j", "ACCEPT" ],
+                           [ "-A", "INPUT", "-j", "DROP" ],
+                           [ "-t", "nat", "-A", "POSTROUTING", "-j",
+                             "ACCEPT" ] ])
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    for test in [ TestDirectConfigBatch, TestPassthroughs ]:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test))
+    unittest.TextTestRunner(verbosity=2).run(suite)
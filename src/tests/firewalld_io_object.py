@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_io_object.py
+
+import copy
+import unittest
+
+from firewall.core.io.direct import Direct
+from firewall.core.io.service import Service
+from firewall.core.io.zone import Zone
+
+class TestCopyOnWrite(unittest.TestCase):
+    """
+    Copies of IO_Objects share their lists and dicts until they are unshared.
+    """
+    def service(self):
+        obj = Service()
+        obj.name = "test"
+        obj.short = "Test"
+        obj.ports = [ ("22", "tcp") ]
+        obj.modules = [ "ftp" ]
+        obj.destination = { "ipv4": "10.0.0.1" }
+        return obj
+
+    def test_shared(self):
+        obj = self.service()
+        x = copy.copy(obj)
+        self.assertTrue(x.ports is obj.ports)
+        self.assertTrue(x.destination is obj.destination)
+        self.assertEqual(x.export_config(), obj.export_config())
+        self.assertTrue("ports" in x._shared)
+        self.assertTrue("ports" in obj._shared)
+
+    def test_unshare(self):
+        obj = self.service()
+        x = copy.copy(obj)
+        x.unshare()
+        x.ports.append(("80", "tcp"))
+        x.destination["ipv6"] = "::1"
+        self.assertEqual(obj.ports, [ ("22", "tcp") ])
+        self.assertEqual(obj.destination, { "ipv4": "10.0.0.1" })
+        self.assertEqual(x._shared, frozenset())
+
+        # the original is still sharing with the copy, which is harmless
+        obj.unshare()
+        obj.modules.append("tftp")
+        self.assertEqual(x.modules, [ "ftp" ])
+
+    def test_unshare_names(self):
+        obj = self.service()
+        x = copy.copy(obj)
+        x.unshare("ports")
+        x.ports.append(("80", "tcp"))
+        self.assertEqual(obj.ports, [ ("22", "tcp") ])
+        self.assertTrue(x.modules is obj.modules)
+        self.assertFalse("ports" in x._shared)
+        self.assertTrue("modules" in x._shared)
+
+    def test_setattr(self):
+        # replaced attributes do not touch the original
+        obj = self.service()
+        x = copy.copy(obj)
+        x.short = "Changed"
+        x.ports = [ ]
+        self.assertEqual(obj.short, "Test")
+        self.assertEqual(obj.ports, [ ("22", "tcp") ])
+
+    def test_copy_of_copy(self):
+        obj = self.service()
+        x = copy.copy(obj)
+        y = copy.copy(x)
+        y.unshare()
+        y.ports.append(("80", "tcp"))
+        self.assertEqual(obj.ports, [ ("22", "tcp") ])
+        self.assertEqual(x.ports, [ ("22", "tcp") ])
+
+    def test_cleanup(self):
+        # cleanup of a copy does not empty the lists of the original
+        obj = self.service()
+        x = copy.copy(obj)
+        x.cleanup()
+        self.assertEqual(x.ports, [ ])
+        self.assertEqual(obj.ports, [ ("22", "tcp") ])
+        self.assertEqual(obj.destination, { "ipv4": "10.0.0.1" })
+
+    def test_zone(self):
+        obj = Zone()
+        obj.name = "test"
+        obj.services = [ "ssh" ]
+        obj.forward_ports = [ ("22", "tcp", "2222", "") ]
+        x = copy.copy(obj)
+        x.unshare("services", "forward_ports")
+        x.services.append("http")
+        x.forward_ports.append(("80", "tcp", "8080", ""))
+        self.assertEqual(obj.services, [ "ssh" ])
+        self.assertEqual(obj.forward_ports, [ ("22", "tcp", "2222", "") ])
+
+    def test_nested(self):
+        # the nested dicts of direct are copied as well, add_rule unshares
+        obj = Direct("direct.xml")
+        obj.add_rule("ipv4", "filter", "INPUT", 0, [ "-j", "ACCEPT" ])
+        x = copy.copy(obj)
+        x.add_rule("ipv4", "filter", "INPUT", 0, [ "-j", "DROP" ])
+        key = ("ipv4", "filter", "INPUT")
+        self.assertEqual(list(obj.get_all_rules()[key]),
+                         [ (0, ("-j", "ACCEPT")) ])
+        self.assertEqual(list(x.get_all_rules()[key]),
+                         [ (0, ("-j", "ACCEPT")), (0, ("-j", "DROP")) ])
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCopyOnWrite)
+    unittest.TextTestRunner(verbosity=2).run(suite)
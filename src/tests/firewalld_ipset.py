@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_ipset.py
+
+import shutil
+import tempfile
+import unittest
+
+from firewall.core.fw_ipset import FirewallIPSet
+from firewall.core.io.ipset import IPSet, ipset_reader
+
+class TestIPSetReader(unittest.TestCase):
+    """
+    Reading of ipset files with duplicate and invalid entries.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        with open("%s/%s" % (self.dir, name), "w") as f:
+            f.write(content)
+
+    def test_entries(self):
+        entries = [ "10.0.0.%d" % (i % 50) for i in range(200) ] + \
+                  [ "bad", "10.0.0.300", "bad" ]
+        self.write("test.xml", '<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<ipset type="hash:ip">\n%s</ipset>\n' % \
+                   "".join("<entry>%s</entry>\n" % x for x in entries))
+        obj = ipset_reader("test.xml", self.dir)
+        self.assertEqual(sorted(obj.entries),
+                         sorted("10.0.0.%d" % i for i in range(50)))
+
+    def test_timeout(self):
+        # entries are not used for ipsets with timeout
+        self.write("test.xml", '<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<ipset type="hash:ip">\n'
+                   '<option name="timeout" value="60"/>\n'
+                   '<entry>10.0.0.1</entry>\n</ipset>\n')
+        obj = ipset_reader("test.xml", self.dir)
+        self.assertEqual(obj.entries, [ ])
+
+class ListingIPSet(object):
+    """
+    ipset backend keeping the sets in a dict: name -> (type, entries) and
+    logging the calls changing the sets
+    """
+    def __init__(self):
+        self.sets = { }
+        self.calls = [ ]
+
+    def names(self):
+        return list(self.sets.keys())
+
+    def get_entries(self, set_name):
+        return list(self.sets[set_name][1])
+
+    def restore(self, set_name, type_name, entries, create_options=None,
+                entry_options=None):
+        entries = list(entries)
+        self.calls.append(("restore", set_name, len(entries)))
+        self.sets.setdefault(set_name, (type_name, set()))[1].update(entries)
+
+    def update(self, set_name, added, removed):
+        self.calls.append(("update", set_name, sorted(added), sorted(removed)))
+        self.sets[set_name][1].update(added)
+        self.sets[set_name][1].difference_update(removed)
+
+    def destroy(self, set_name):
+        self.calls.append(("destroy", set_name))
+        del self.sets[set_name]
+
+class FakeFirewall(object):
+    def __init__(self):
+        self._ipset = ListingIPSet()
+
+class TestEntriesFile(unittest.TestCase):
+    """
+    ipsets with entries file are kept in the kernel over a reload and only
+    updated with the changes of the entries.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fw = FakeFirewall()
+        self.ipset = FirewallIPSet(self.fw)
+        self.ipset.add_ipset(self.obj("hash:ip"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def obj(self, _type, options=None):
+        obj = IPSet()
+        obj.name = "test"
+        obj.path = self.dir
+        obj.type = _type
+        obj.options = options or { }
+        obj.entries_file = "test.entries"
+        return obj
+
+    def write(self, entries):
+        with open("%s/test.entries" % self.dir, "w") as f:
+            f.write("".join("%s\n" % x for x in entries))
+
+    def reload(self, obj=None):
+        # the ipsets are kept and applied again like in the reload of the
+        # firewall, optionally with a new object read from the config
+        self.ipset.keep_ipsets()
+        if obj is not None:
+            self.ipset.add_ipset(obj)
+        del self.fw._ipset.calls[:]
+        self.ipset.apply_ipsets()
+
+    def test_delta(self):
+        self.write([ "10.0.0.%d" % i for i in range(10) ])
+        self.ipset.apply_ipsets()
+        self.assertEqual(self.fw._ipset.calls, [ ("restore", "test", 10) ])
+
+        self.write([ "10.0.0.%d" % i for i in range(2, 12) ])
+        self.reload()
+        self.assertEqual(self.fw._ipset.calls,
+                         [ ("update", "test", [ "10.0.0.10", "10.0.0.11" ],
+                            [ "10.0.0.0", "10.0.0.1" ]) ])
+        self.assertEqual(sorted(self.fw._ipset.sets["test"][1]),
+                         sorted("10.0.0.%d" % i for i in range(2, 12)))
+        self.assertTrue(self.ipset.get_ipset("test").applied)
+
+    def test_unchanged(self):
+        self.write([ "10.0.0.1", "10.0.0.2" ])
+        self.ipset.apply_ipsets()
+        self.reload()
+        self.assertEqual(self.fw._ipset.calls, [ ])
+        self.assertTrue(self.ipset.get_ipset("test").applied)
+
+    def test_normalized(self):
+        # entries are compared in the form listed by ipset
+        self.ipset.add_ipset(self.obj("hash:net"))
+        self.write([ "10.0.0.1/24", "fe80::1" ])
+        self.ipset.apply_ipsets()
+        self.fw._ipset.sets["test"] = ("hash:net", set([ "10.0.0.0/24" ]))
+        self.reload()
+        self.assertEqual(self.fw._ipset.calls, [ ])
+
+        self.write([ "10.0.0.1/24", "10.0.1.0/24" ])
+        self.reload(self.obj("hash:net"))
+        self.assertEqual(self.fw._ipset.calls,
+                         [ ("update", "test", [ "10.0.1.0/24" ], [ ]) ])
+
+    def test_no_delta(self):
+        # the set is created again for entries, that are split up by the
+        # kernel, or if the type has been changed
+        self.write([ "10.0.0.1", "10.0.0.2" ])
+        self.ipset.apply_ipsets()
+        self.write([ "10.0.0.1-10.0.0.5" ])
+        self.reload()
+        self.assertEqual(self.fw._ipset.calls,
+                         [ ("destroy", "test"), ("restore", "test", 1) ])
+
+        self.write([ "10.0.0.0/24" ])
+        self.reload(self.obj("hash:net"))
+        self.assertEqual(self.fw._ipset.calls,
+                         [ ("destroy", "test"), ("restore", "test", 1) ])
+
+    def test_removed(self):
+        # kept ipsets, that are not used anymore, are destroyed
+        self.write([ "10.0.0.1" ])
+        self.ipset.apply_ipsets()
+        self.ipset.keep_ipsets()
+        del self.ipset._ipsets["test"]
+        del self.fw._ipset.calls[:]
+        self.ipset.apply_ipsets()
+        self.assertEqual(self.fw._ipset.calls, [ ("destroy", "test") ])
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestIPSetReader),
+        loader.loadTestsFromTestCase(TestEntriesFile) ])
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_lockdown_whitelist.py
+
+import copy
+import random
+import unittest
+
+from firewall.core.io.lockdown_whitelist import LockdownWhitelist
+
+def linear_match_command(commands, command):
+    # the linear search, that has been used before the compiled whitelist
+    for _command in commands:
+        if _command.endswith("*"):
+            if command.startswith(_command[:-1]):
+                return True
+        else:
+            if _command == command:
+                return True
+    return False
+
+class TestLockdownWhitelistMatcher(unittest.TestCase):
+    """
+    The compiled whitelist is compared with the linear search over the
+    commands under random additions and removals. Short commands from a
+    small alphabet are used to get many common prefixes.
+    """
+    def random_command(self, rand):
+        command = "/" + "".join(rand.choice("ab /") for i in
+                                range(rand.randint(0, 4)))
+        if rand.random() < 0.4:
+            command += "*"
+        return command
+
+    def check(self, whitelist, rand):
+        commands = whitelist.get_commands()
+        for i in range(30):
+            command = self.random_command(rand).rstrip("*")
+            self.assertEqual(whitelist.match_command(command),
+                             linear_match_command(commands, command),
+                             "%s in %s" % (command, commands))
+        for command in commands:
+            self.assertTrue(whitelist.match_command(command.rstrip("*")))
+
+    def test_commands(self):
+        rand = random.Random(4711)
+        for run in range(20):
+            whitelist = LockdownWhitelist("")
+            for i in range(200):
+                command = self.random_command(rand)
+                if whitelist.has_command(command):
+                    whitelist.remove_command(command)
+                else:
+                    whitelist.add_command(command)
+                if i % 10 == 0:
+                    self.check(whitelist, rand)
+
+            # a copy is compiled again and independent of the original
+            commands = whitelist.get_commands()
+            other = copy.copy(whitelist)
+            self.check(other, rand)
+            for command in other.get_commands():
+                other.remove_command(command)
+            self.assertEqual(whitelist.get_commands(), commands)
+            self.check(whitelist, rand)
+            self.check(other, rand)
+
+            # a new configuration replaces the compiled whitelist
+            whitelist.import_config(([ "/a*", "/b" ], [ ], [ ], [ ]))
+            self.check(whitelist, rand)
+
+    def test_prefix_all(self):
+        whitelist = LockdownWhitelist("")
+        whitelist.add_command("/*")
+        self.assertTrue(whitelist.match_command("/usr/bin/python"))
+        self.assertFalse(whitelist.match_command("usr"))
+        whitelist.remove_command("/*")
+        self.assertFalse(whitelist.match_command("/usr/bin/python"))
+        self.assertFalse(whitelist.match_command(None))
+
+    def test_entries(self):
+        whitelist = LockdownWhitelist("")
+        whitelist.add_uid(0)
+        whitelist.add_user("root")
+        whitelist.add_context("system_u:system_r:NetworkManager_t:s0")
+        self.assertTrue(whitelist.match_uid(0))
+        self.assertFalse(whitelist.match_uid(1))
+        self.assertTrue(whitelist.match_user("root"))
+        self.assertFalse(whitelist.match_user("nobody"))
+        self.assertTrue(whitelist.match_context(
+            "system_u:system_r:NetworkManager_t:s0"))
+        whitelist.remove_user("root")
+        self.assertFalse(whitelist.match_user("root"))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLockdownWhitelistMatcher)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_rich_parser.py
+
+import copy
+import io
+import json
+import os
+import pickle
+import unittest
+
+from firewall.core.rich import Rich_Rule, Rich_Rule_Cache, Rich_Source, \
+    Rich_Limit
+from firewall.errors import FirewallError
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "firewalld_rich_rules.json")
+
+def parse(rule_str):
+    try:
+        return [ "OK", str(Rich_Rule(rule_str=rule_str)) ]
+    except FirewallError as error:
+        return [ "ERROR", str(error) ]
+
+class TestRichRuleParser(unittest.TestCase):
+    """
+    The corpus has been created from generated rules and mutations of them
+    with the results of the previous parser: the string form of the parsed
+    rule or the error. Inputs, that made the previous parser fail with an
+    exception other than FirewallError or with a later and unrelated error
+    for 'rule', 'not' and 'NOT' tokens in the rule, are not part of it.
+    """
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        with io.open(CORPUS, encoding="UTF-8") as f:
+            self.corpus = [ json.loads(line) for line in f if line.strip() ]
+
+    def test_corpus(self):
+        self.assertTrue(len(self.corpus) > 0)
+        for (rule_str, status, result) in self.corpus:
+            self.assertEqual(parse(rule_str), [ status, result ],
+                             "'%s'" % rule_str)
+
+    def test_reparse(self):
+        # the string form of a parsed rule is parsed to the same rule
+        for (rule_str, status, result) in self.corpus:
+            if status == "OK":
+                self.assertEqual(parse(result), [ "OK", result ])
+
+    def test_invalid_tokens(self):
+        # these ended in an IndexError or an unrelated error before
+        for rule_str in [ "rule not address=1.2.3.4 accept",
+                          "rule NOT address=1.2.3.4 accept",
+                          "rule family=ipv4 rule accept",
+                          'rule family=ipv4 log prefix="x accept' ]:
+            self.assertEqual(parse(rule_str)[0], "ERROR")
+            self.assertTrue(parse(rule_str)[1].startswith("INVALID_RULE"))
+
+class TestRichRuleCanonical(unittest.TestCase):
+    """
+    Rules of an equivalence class have the same canonical form and are equal,
+    rules of different classes are not.
+    """
+    classes = [
+        [ 'rule family=ipv4 source address=192.168.1.0/24 accept',
+          'rule family="ipv4"   source address="192.168.1.7/24" accept',
+          "rule source address='192.168.1.255/24' family=ipv4 accept" ],
+        [ 'rule family=ipv4 source address=192.168.1.7 accept',
+          'rule family=ipv4 source address=192.168.1.7/32 accept' ],
+        [ 'rule family=ipv4 source not address=192.168.1.7 accept' ],
+        [ 'rule family=ipv6 source address=2001:DB8:0:0::1 accept',
+          'rule family=ipv6 source address=2001:db8::1/128 accept',
+          'rule family=ipv6 source address=2001:0db8::0001 accept' ],
+        [ 'rule family=ipv6 source address=2001:db8::/64 accept',
+          'rule family=ipv6 source address=2001:db8::1:2/64 accept' ],
+        [ 'rule family=ipv4 port port=22 protocol=tcp accept',
+          'rule family=ipv4 port protocol=tcp port=22-22 accept',
+          'rule family="ipv4" port port="22" protocol="tcp" accept' ],
+        [ 'rule family=ipv4 port port=22 protocol=udp accept' ],
+        [ 'rule family=ipv4 port port=22-23 protocol=tcp accept' ],
+        [ 'rule family=ipv4 source address=10.0.0.1 reject type=host-prohib',
+          'rule family=ipv4 source address=10.0.0.1 '
+          'reject type=icmp-host-prohibited' ],
+        [ 'rule family=ipv4 source address=10.0.0.1 reject' ],
+        [ 'rule family=ipv6 source address=::1 reject type=no-route',
+          'rule family=ipv6 source address=0::1 reject type=icmp6-no-route' ],
+        [ 'rule family=ipv4 service name=ssh log level=info prefix=x accept',
+          'rule family=ipv4 service name=ssh log prefix="x" level="info" '
+          'accept' ],
+        [ 'rule family=ipv4 service name=ssh log prefix=x accept' ],
+        [ 'rule family=ipv4 forward-port port=2222 protocol=tcp to-port=22 '
+          'to-addr=10.0.0.1',
+          'rule family=ipv4 forward-port to-addr=10.0.0.1 to-port=22-22 '
+          'protocol=tcp port=2222' ],
+        [ 'rule service name=ssh accept',
+          'rule   service   name="ssh"   accept' ],
+        [ 'rule service name=ssh drop' ],
+    ]
+
+    def test_classes(self):
+        forms = [ ]
+        for rules in self.classes:
+            parsed = [ Rich_Rule(rule_str=rule_str) for rule_str in rules ]
+            canonical = parsed[0].canonical()
+            for rule in parsed:
+                self.assertEqual(rule.canonical(), canonical, str(rule))
+                self.assertEqual(rule, parsed[0])
+                self.assertEqual(hash(rule), hash(parsed[0]))
+            # the canonical form is a valid rule with the same form
+            self.assertEqual(Rich_Rule(rule_str=canonical).canonical(),
+                             canonical)
+            forms.append(canonical)
+        self.assertEqual(len(set(forms)), len(forms))
+        parsed = [ Rich_Rule(rule_str=rules[0]) for rules in self.classes ]
+        for i in range(len(parsed)):
+            for j in range(i + 1, len(parsed)):
+                self.assertNotEqual(parsed[i], parsed[j])
+
+    def test_corpus(self):
+        # the canonical form of every valid rule of the corpus is stable
+        with io.open(CORPUS, encoding="UTF-8") as f:
+            corpus = [ json.loads(line) for line in f if line.strip() ]
+        for (rule_str, status, result) in corpus:
+            if status != "OK":
+                continue
+            rule = Rich_Rule(rule_str=rule_str)
+            canonical = rule.canonical()
+            self.assertEqual(Rich_Rule(rule_str=canonical), rule)
+            self.assertEqual(Rich_Rule(rule_str=canonical).canonical(),
+                             canonical)
+
+    def test_computed_once(self):
+        # the canonical form is computed when the rule is parsed, rules
+        # created from parts are computing it with the first use
+        forms = [ ]
+        _canonical_form = Rich_Rule._canonical_form
+        def counting(rule):
+            forms.append(rule)
+            return _canonical_form(rule)
+        Rich_Rule._canonical_form = counting
+        try:
+            rule = Rich_Rule(rule_str='rule family=ipv4 source '
+                             'address=10.0.0.1/8 accept')
+            self.assertEqual(len(forms), 1)
+            other = rule.replace(source=Rich_Source("10.0.0.0/8", None, None))
+            self.assertEqual(len(forms), 1)
+            for i in range(10):
+                self.assertEqual(rule, other)
+                self.assertEqual(hash(rule), hash(other))
+                self.assertEqual(len(set([ rule, other ])), 1)
+            self.assertEqual(len(forms), 2)
+        finally:
+            Rich_Rule._canonical_form = _canonical_form
+
+class TestRichRuleImmutable(unittest.TestCase):
+    """
+    Rules and their elements are shared by the rule cache and can not be
+    changed.
+    """
+    def test_cached_rule(self):
+        cache = Rich_Rule_Cache()
+        rule = cache.get('rule family=ipv4 source address=10.0.0.1 '
+                         'log prefix=test limit value=1/m accept')
+        self.assertRaises(AttributeError, setattr, rule, "family", "ipv6")
+        self.assertRaises(AttributeError, setattr, rule, "action", None)
+        self.assertRaises(AttributeError, delattr, rule, "log")
+        self.assertRaises(AttributeError, setattr, rule.source, "addr",
+                          "10.0.0.2")
+        self.assertRaises(AttributeError, setattr, rule.log, "limit",
+                          Rich_Limit("2/m"))
+        self.assertRaises(AttributeError, setattr, rule.log.limit, "value",
+                          "2/m")
+        self.assertTrue(cache.get(str(rule)) is rule)
+        self.assertEqual(str(rule), 'rule family="ipv4" source '
+                         'address="10.0.0.1" log prefix="test" '
+                         'limit value="1/m" accept')
+
+    def test_replace(self):
+        rule = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                         'accept')
+        other = rule.replace(source=Rich_Source("10.0.0.2", None, None))
+        self.assertEqual(str(other), 'rule family="ipv4" source '
+                         'address="10.0.0.2" accept')
+        self.assertEqual(str(rule), 'rule family="ipv4" source '
+                         'address="10.0.0.1" accept')
+        self.assertRaises(AttributeError, setattr, other, "family", "ipv6")
+        self.assertRaises(TypeError, rule.replace, port="22")
+
+    def test_copy(self):
+        rule = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                         'port port=22 protocol=tcp reject type=tcp-rst')
+        self.assertTrue(copy.copy(rule) is rule)
+        self.assertTrue(copy.deepcopy(rule) is rule)
+        other = pickle.loads(pickle.dumps(rule, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(str(other), str(rule))
+        self.assertEqual(other, rule)
+        self.assertRaises(AttributeError, setattr, other, "family", "ipv6")
+        self.assertRaises(AttributeError, setattr, other.element, "port", "23")
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestRichRuleParser),
+        loader.loadTestsFromTestCase(TestRichRuleCanonical),
+        loader.loadTestsFromTestCase(TestRichRuleImmutable) ])
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_types.py
+
+import random
+import unittest
+
+from firewall.fw_types import PriorityOrderedDict
+
+class TestPriorityOrderedDict(unittest.TestCase):
+    """
+    The order and the positions of PriorityOrderedDict are compared with a
+    plain list of (key, priority) in insertion order, that is sorted by
+    priority with a stable sort.
+    """
+    def check(self, d, ref):
+        expected = [ key for (key, priority) in
+                     sorted(ref, key=lambda x: x[1]) ]
+        self.assertEqual(list(d), expected)
+        self.assertEqual(d.keys(), expected)
+        self.assertEqual(len(d), len(ref))
+        for (key, priority) in ref:
+            self.assertTrue(key in d)
+            self.assertEqual(d[key], priority)
+        for priority in range(-12, 13):
+            self.assertEqual(d.position(priority),
+                             len([ x for x in ref if x[1] <= priority ]))
+
+    def test_order(self):
+        d = PriorityOrderedDict()
+        d["a"] = 0
+        d["b"] = -1
+        d["c"] = 0
+        d["d"] = 1
+        self.assertEqual(list(d), [ "b", "a", "c", "d" ])
+        self.assertEqual(d.position(-2), 0)
+        self.assertEqual(d.position(0), 3)
+        # changing the priority moves the key to the end of the priority
+        d["b"] = 0
+        self.assertEqual(list(d), [ "a", "c", "b", "d" ])
+        # setting the same priority again keeps the position
+        d["a"] = 0
+        self.assertEqual(list(d), [ "a", "c", "b", "d" ])
+        del d["c"]
+        self.assertEqual(list(d), [ "a", "b", "d" ])
+        self.assertEqual(d.position(0), 2)
+        self.assertEqual(d.items(), [ ("a", 0), ("b", 0), ("d", 1) ])
+
+    def test_random(self):
+        rand = random.Random(4711)
+        for run in range(20):
+            d = PriorityOrderedDict()
+            ref = [ ]
+            for i in range(300):
+                op = rand.random()
+                if op < 0.55 or len(ref) < 1:
+                    key = "key%d" % rand.randint(0, 60)
+                    priority = rand.randint(-10, 10)
+                    old = [ x for x in ref if x[0] == key ]
+                    if not old or old[0][1] != priority:
+                        ref = [ x for x in ref if x[0] != key ]
+                        ref.append((key, priority))
+                    d[key] = priority
+                else:
+                    (key, priority) = ref.pop(rand.randrange(len(ref)))
+                    del d[key]
+                if i % 25 == 0:
+                    self.check(d, ref)
+            self.check(d, ref)
+
+            # a copy is independent of the original
+            c = d.copy()
+            self.check(c, ref)
+            c["new"] = 0
+            if len(ref) > 0:
+                del c[ref[0][0]]
+            self.check(d, ref)
+
+            d.clear()
+            self.check(d, [ ])
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPriorityOrderedDict)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,471 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_worker.py
+
+import threading
+import time
+import unittest
+
+import firewall.core.fw_zone
+import firewall.server.worker
+from firewall.config.dbus import PK_ACTION_CONFIG, PK_ACTION_INFO
+from firewall.core.io.zone import Zone
+from firewall.core.rich import Rich_Rule
+from firewall.server.worker import Worker, Batch, serialized
+from firewalld_direct_batch import RecordingFirewall
+from firewalld_zone import RecordingIPSet
+
+class FakeMainLoop(object):
+    """
+    GLib replacement for the worker: idle callbacks are run by run(), the
+    timeouts by expire(). Idle callbacks can be added from threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._id = 0
+        self._idle = [ ]
+        self._timeouts = [ ]
+
+    def __add(self, sources, func, args):
+        with self._lock:
+            self._id += 1
+            sources.append((self._id, func, args))
+            return self._id
+
+    def idle_add(self, func, *args):
+        return self.__add(self._idle, func, args)
+
+    def timeout_add(self, interval, func, *args):
+        return self.__add(self._timeouts, func, args)
+
+    def source_remove(self, source):
+        with self._lock:
+            self._idle[:] = [ x for x in self._idle if x[0] != source ]
+            self._timeouts[:] = [ x for x in self._timeouts
+                                  if x[0] != source ]
+
+    def __run(self, sources):
+        while True:
+            with self._lock:
+                if len(sources) < 1:
+                    return
+                (source, func, args) = sources.pop(0)
+            if func(*args):
+                self.__add(sources, func, args)
+
+    def run(self):
+        self.__run(self._idle)
+
+    def expire(self):
+        self.__run(self._timeouts)
+        self.run()
+
+    def pending(self):
+        with self._lock:
+            return len(self._idle) + len(self._timeouts)
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._glib = firewall.server.worker.GLib
+        self.loop = FakeMainLoop()
+        firewall.server.worker.GLib = self.loop
+        self.worker = Worker()
+        self.log = [ ]
+
+    def tearDown(self):
+        firewall.server.worker.GLib = self._glib
+
+    def operation(self, name, complete=True):
+        # operation, that is done when it returns if complete is set, else
+        # it keeps its done function in self.pending
+        def func(done):
+            self.log.append(name)
+            if complete:
+                done()
+            else:
+                self.pending = done
+        return func
+
+    def wait_for(self, condition):
+        # run the main loop until the condition is met
+        deadline = time.time() + 10
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            self.loop.run()
+            time.sleep(0.001)
+
+class TestWorker(WorkerTestCase):
+    """
+    Order of the operations of the worker.
+    """
+    def test_order(self):
+        self.worker.add(self.operation("a", complete=False))
+        # the first operation is started right away
+        self.assertEqual(self.log, [ "a" ])
+        self.worker.add(self.operation("b"))
+        self.worker.add(self.operation("c"))
+        self.loop.run()
+        # the others are waiting for the first one to be done
+        self.assertEqual(self.log, [ "a" ])
+        self.assertTrue(self.worker.busy())
+        self.pending()
+        # done is only used once
+        self.pending()
+        self.assertEqual(self.log, [ "a" ])
+        self.loop.run()
+        self.assertEqual(self.log, [ "a", "b", "c" ])
+        self.assertFalse(self.worker.busy())
+
+    def test_failed(self):
+        # an operation raising an error is done
+        def fail(done):
+            self.log.append("fail")
+            raise Exception("fail")
+        self.worker.add(fail)
+        self.worker.call(self.log.append, "call")
+        self.worker.add(self.operation("a"))
+        self.loop.run()
+        self.assertEqual(self.log, [ "fail", "call", "a" ])
+        self.assertFalse(self.worker.busy())
+
+    def test_reply(self):
+        # the reply is passed to done, it is sent after the operation is done
+        replies = [ ]
+        def func(done):
+            done(replies.append, "reply")
+            self.assertEqual(self.worker.busy(), False)
+        self.worker.add(func)
+        self.assertEqual(replies, [ "reply" ])
+
+    def test_thread(self):
+        event = threading.Event()
+        results = [ ]
+        def func(done):
+            self.log.append("thread")
+            self.worker.run_in_thread("snapshot", event.wait, callback, 10)
+            done()
+        def callback(result, error):
+            results.append((result, error, self.worker.snapshot))
+        self.worker.add(func)
+        self.worker.add(self.operation("a"))
+        self.loop.run()
+        # no operation is started while the thread is running, the snapshot
+        # is provided for queries
+        self.assertEqual(self.log, [ "thread" ])
+        self.assertTrue(self.worker.threaded())
+        self.assertEqual(self.worker.snapshot, "snapshot")
+        event.set()
+        self.wait_for(lambda: len(self.log) > 1)
+        self.assertEqual(self.log, [ "thread", "a" ])
+        self.assertEqual(results, [ (True, None, None) ])
+        self.assertFalse(self.worker.busy())
+
+class Object(object):
+    """
+    D-Bus object with a query and a change method.
+    """
+    default_polkit_auth_required = PK_ACTION_INFO
+    snapshot_queries = False
+
+    def __init__(self, log):
+        self.log = log
+
+    def query(self, value, sender=None):
+        self.log.append(("query", value))
+        return value
+    query._dbus_async_callbacks = None
+    query = serialized(query)
+
+    def change(self, value, sender=None):
+        self.log.append(("change", value))
+    change._dbus_async_callbacks = None
+    change = serialized(change)
+    change._slip_polkit_auth_required = PK_ACTION_CONFIG
+
+    def failure(self, sender=None):
+        raise ValueError("failure")
+    failure._dbus_async_callbacks = None
+    failure = serialized(failure)
+    failure._slip_polkit_auth_required = PK_ACTION_CONFIG
+
+class TestSerialized(WorkerTestCase):
+    """
+    Queries are answered right away, changes are executed by the worker.
+    """
+    def setUp(self):
+        super(TestSerialized, self).setUp()
+        self._worker = firewall.server.worker.worker
+        firewall.server.worker.worker = self.worker
+        self.obj = Object(self.log)
+        self.replies = [ ]
+
+    def tearDown(self):
+        firewall.server.worker.worker = self._worker
+        super(TestSerialized, self).tearDown()
+
+    def call(self, method, *args):
+        method(self.obj, *args,
+               reply_handler=lambda *x: self.replies.append(("reply", x)),
+               error_handler=lambda x: self.replies.append(("error", str(x))))
+
+    def test_classification(self):
+        self.worker.add(self.operation("busy", complete=False))
+        self.call(Object.change, 1)
+        self.call(Object.query, 2)
+        # the query is answered while the change is waiting
+        self.assertEqual(self.log, [ "busy", ("query", 2) ])
+        self.assertEqual(self.replies, [ ("reply", (2, )) ])
+        self.pending()
+        self.loop.run()
+        self.assertEqual(self.log, [ "busy", ("query", 2), ("change", 1) ])
+        self.assertEqual(self.replies, [ ("reply", (2, )), ("reply", ( )) ])
+
+    def test_error(self):
+        self.worker.add(self.operation("busy", complete=False))
+        self.call(Object.failure)
+        self.call(Object.change, 1)
+        self.pending()
+        self.loop.run()
+        self.assertEqual(self.replies, [ ("error", "failure"),
+                                         ("reply", ( )) ])
+
+    def test_local_call(self):
+        # local calls are executed directly
+        self.worker.add(self.operation("busy", complete=False))
+        self.obj.change(1)
+        self.assertEqual(self.log, [ "busy", ("change", 1) ])
+
+    def test_thread(self):
+        # queries are waiting for the thread unless they are answered from
+        # the snapshot
+        event = threading.Event()
+        self.worker.run_in_thread(None, event.wait, lambda *x: None, 10)
+        self.call(Object.query, 1)
+        self.assertEqual(self.log, [ ])
+        self.obj.snapshot_queries = True
+        self.call(Object.query, 2)
+        self.assertEqual(self.log, [ ("query", 2) ])
+        event.set()
+        self.wait_for(lambda: len(self.log) > 1)
+        self.assertEqual(self.log, [ ("query", 2), ("query", 1) ])
+
+class TestSnapshot(unittest.TestCase):
+    """
+    The snapshot for queries while reloading is not changed by the firewall.
+    """
+    def test_snapshot(self):
+        fw = RecordingFirewall()
+        fw.direct.add_chain("ipv4", "filter", "chain1")
+        fw.direct.add_rule("ipv4", "filter", "chain1", 0, ("-j", "ACCEPT"))
+        fw.direct.add_passthrough("ipv4", [ "-A", "INPUT", "-j", "ACCEPT" ])
+        fw.policies.lockdown_whitelist.add_command("/usr/bin/a")
+        snapshot = fw.snapshot()
+
+        fw.direct.add_chain("ipv4", "filter", "chain2")
+        fw.direct.add_rule("ipv4", "filter", "chain1", 0, ("-j", "DROP"))
+        fw.direct.remove_rule("ipv4", "filter", "chain1", 0,
+                              ("-j", "ACCEPT"))
+        fw.direct.add_passthrough("ipv4", [ "-A", "INPUT", "-j", "DROP" ])
+        fw.policies.lockdown_whitelist.add_command("/usr/bin/b")
+        fw.policies.lockdown_whitelist.remove_command("/usr/bin/a")
+        fw.policies.enable_lockdown()
+
+        self.assertEqual(snapshot.direct.get_chains("ipv4", "filter"),
+                         [ "chain1" ])
+        self.assertEqual(snapshot.direct.get_rules("ipv4", "filter",
+                                                   "chain1"),
+                         [ (0, ("-j", "ACCEPT")) ])
+        self.assertEqual(snapshot.direct.get_passthroughs("ipv4"),
+                         [ [ "-A", "INPUT", "-j", "ACCEPT" ] ])
+        self.assertEqual(snapshot.policies.lockdown_whitelist.commands,
+                         [ "/usr/bin/a" ])
+        self.assertFalse(snapshot.policies.query_lockdown())
+
+        # the reload starts with a cleanup
+        fw.cleanup()
+        self.assertEqual(snapshot.direct.get_chains("ipv4", "filter"),
+                         [ "chain1" ])
+        self.assertEqual(snapshot.policies.lockdown_whitelist.commands,
+                         [ "/usr/bin/a" ])
+
+class LoggingIPSet(RecordingIPSet):
+    """
+    RecordingIPSet logging the changes with the number of rule calls before.
+    """
+    def __init__(self, fw):
+        super(LoggingIPSet, self).__init__()
+        self.fw = fw
+        self.log = [ ]
+
+    def destroy(self, set_name):
+        self.log.append(("destroy", set_name, len(self.fw.calls)))
+        super(LoggingIPSet, self).destroy(set_name)
+
+    def add(self, set_name, entry, options=None):
+        self.log.append(("add", entry, len(self.fw.calls)))
+        super(LoggingIPSet, self).add(set_name, entry, options)
+
+    def delete(self, set_name, entry, options=None):
+        self.log.append(("delete", entry, len(self.fw.calls)))
+        super(LoggingIPSet, self).delete(set_name, entry, options)
+
+class TestBatch(unittest.TestCase):
+    """
+    Grouped operations with one restore call for each ip family and table,
+    the rollback if one of these calls fails.
+    """
+    def setUp(self):
+        self._enable_ip_forwarding = firewall.core.fw_zone.enable_ip_forwarding
+        firewall.core.fw_zone.enable_ip_forwarding = lambda ipv: True
+        self.fw = RecordingFirewall()
+        self.fw._ipset = LoggingIPSet(self.fw)
+        for name in [ "a", "b" ]:
+            obj = Zone()
+            obj.name = name
+            self.fw.zone.add_zone(obj)
+            obj.applied = True
+        self.replies = [ ]
+
+    def tearDown(self):
+        firewall.core.fw_zone.enable_ip_forwarding = self._enable_ip_forwarding
+
+    def job(self, name, func, *args):
+        # operation replying with the name or the error and the number of
+        # rule calls before the reply
+        def reply(result):
+            self.replies.append((result, len(self.fw.calls)))
+        def job(done):
+            try:
+                func(*args)
+            except Exception:
+                done(reply, "%s failed" % name)
+                return
+            done(reply, name)
+        return (job, ( ))
+
+    def test_commit(self):
+        Batch(self.fw, [ self.job("a", self.fw.zone.add_port,
+                                  "a", "80", "tcp"),
+                         self.job("b", self.fw.zone.add_masquerade, "b") ]
+              ).run()
+        # one call for each ip family and table
+        self.assertEqual(len(self.fw.calls), 4)
+        self.assertEqual(set(rule[1] for rule in self.fw.commands()),
+                         set([ "filter", "nat" ]))
+        self.assertEqual(self.replies, [ ("a", 4), ("b", 4) ])
+        self.assertTrue(self.fw.zone.query_port("a", "80", "tcp"))
+        self.assertTrue(self.fw.zone.query_masquerade("b"))
+
+        # the same rules are applied without the batch
+        fw = RecordingFirewall()
+        for name in [ "a", "b" ]:
+            obj = Zone()
+            obj.name = name
+            fw.zone.add_zone(obj)
+            obj.applied = True
+        fw.zone.add_port("a", "80", "tcp")
+        fw.zone.add_masquerade("b")
+        self.assertEqual(sorted(self.fw.commands()), sorted(fw.commands()))
+
+    def test_partial_failure(self):
+        # the nat call of the masquerade fails after the filter call
+        self.fw.fail.add("MASQUERADE")
+        Batch(self.fw, [ self.job("a", self.fw.zone.add_port,
+                                  "a", "80", "tcp"),
+                         self.job("b", self.fw.zone.add_masquerade, "b") ]
+              ).run()
+        self.assertTrue(self.fw.zone.query_port("a", "80", "tcp"))
+        self.assertFalse(self.fw.zone.query_masquerade("b"))
+        # the operations are executed again one after the other after the
+        # failed commit and the revert, they reply after their own calls
+        self.assertEqual([ x[0] for x in self.replies ], [ "a", "b failed" ])
+        self.assertTrue(2 < self.replies[0][1] < self.replies[1][1])
+        self.assertEqual(self.fw._ipset.__class__, LoggingIPSet)
+
+    def test_rollback(self):
+        self.fw.fail.add("MASQUERADE")
+        Batch(self.fw, [ self.job("a", self.fw.zone.add_port,
+                                  "a", "80", "tcp"),
+                         self.job("b", self.fw.zone.add_masquerade, "b") ]
+              ).run()
+        # the ipv4 filter rules are applied, then removed again in reverse
+        # order after the nat call failed
+        applied = self.fw.calls[0][1]
+        reverted = self.fw.calls[1][1]
+        self.assertTrue([ "-t", "filter", "-A", "IN_a_allow", "-m", "tcp",
+                          "-p", "tcp", "--dport", "80",
+                          "-m", "conntrack", "--ctstate", "NEW",
+                          "-j", "ACCEPT" ] in applied)
+        self.assertTrue([ "-t", "filter", "-A", "FWDO_b_allow",
+                          "-j", "ACCEPT" ] in applied)
+        self.assertEqual(len(reverted), len(applied))
+        self.assertEqual(reverted[0], [ "-t", "filter", "-D", "FWDO_b_allow",
+                                        "-j", "ACCEPT" ])
+        self.assertEqual(reverted[-1], [ "-t", "filter", "-X", "IN_a" ])
+        self.assertTrue([ "-t", "filter", "-D", "IN_a", "-j", "IN_a_log" ]
+                        in reverted)
+        self.assertEqual(set(rule[2] for rule in reverted),
+                         set([ "-D", "-X" ]))
+
+    def test_rollback_ipsets(self):
+        rule1 = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                          'accept')
+        rule2 = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.2 '
+                          'accept')
+        self.fw.zone.add_rule("a", rule1, timeout=60)
+        del self.fw._ipset.log[:]
+        self.fw.fail.add("MASQUERADE")
+        Batch(self.fw, [ self.job("a", self.fw.zone.add_rule, "a", rule2, 60),
+                         self.job("b", self.fw.zone.add_masquerade, "b") ]
+              ).run()
+        # the entry is removed with the rollback and added again
+        self.assertEqual([ x[:2] for x in self.fw._ipset.log ],
+                         [ ("add", "10.0.0.2"), ("delete", "10.0.0.2"),
+                           ("add", "10.0.0.2") ])
+        self.assertEqual(self.fw._ipset.sets["fwd_a_timed4"][1],
+                         set([ "10.0.0.1", "10.0.0.2" ]))
+        self.assertEqual(self.replies[0][0], "a")
+
+    def test_destroy_after_rules(self):
+        rule = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                         'accept')
+        self.fw.zone.add_rule("a", rule, timeout=60)
+        calls = len(self.fw.calls)
+        Batch(self.fw, [ self.job("a", self.fw.zone.remove_rule, "a", rule),
+                         self.job("b", self.fw.zone.add_masquerade, "b") ]
+              ).run()
+        # the ipset is destroyed after the rule using it has been removed
+        self.assertEqual(self.fw._ipset.log[-1],
+                         ("destroy", "fwd_a_timed4", len(self.fw.calls)))
+        self.assertTrue(len(self.fw.calls) > calls)
+        self.assertEqual(self.fw._ipset.sets, { })
+        self.assertEqual(self.replies[0][0], "a")
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestWorker),
+        loader.loadTestsFromTestCase(TestSerialized),
+        loader.loadTestsFromTestCase(TestSnapshot),
+        loader.loadTestsFromTestCase(TestBatch) ])
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,507 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Red Hat, Inc.
+#
+# Authors:
+# Thomas Woerner <twoerner@redhat.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# To use in git tree: PYTHONPATH=.. python firewalld_zone.py
+
+import unittest
+
+import firewall.core.fw_zone
+from firewall.core.fw import Firewall
+from firewall.core.io.icmptype import IcmpType
+from firewall.core.io.service import Service
+from firewall.core.io.zone import Zone
+from firewall.core.rich import Rich_Rule
+from firewall.errors import FirewallError
+
+class RecordingFirewall(Firewall):
+    """
+    Firewall, that records the rules instead of applying them. Restore
+    calls containing a rule with an argument in fail are raising an error.
+    """
+    def __init__(self):
+        super(RecordingFirewall, self).__init__()
+        self.applied = [ ]
+        self.fail = set()
+
+    def is_table_available(self, ipv, table):
+        return True
+
+    def handle_modules(self, modules, enable):
+        return None
+
+    def rule(self, ipv, rule):
+        self.rules(ipv, [ rule ])
+
+    def rules(self, ipv, rules):
+        for rule in rules:
+            if len(self.fail & set(rule)) > 0:
+                raise Exception("failed: %s" % " ".join(rule))
+        for rule in rules:
+            # move the table to the front
+            rule = list(rule)
+            if "-t" in rule and rule.index("-t") > 0:
+                i = rule.index("-t")
+                rule = rule[i:i+2] + rule[:i] + rule[i+2:]
+            self.applied.append((ipv, rule))
+
+class RecordingIPSet(object):
+    """
+    ipset backend keeping the sets in a dict: name -> (type, entries)
+    """
+    def __init__(self):
+        self.sets = { }
+
+    def names(self):
+        return list(self.sets.keys())
+
+    def restore(self, set_name, type_name, entries, create_options=None,
+                entry_options=None):
+        self.sets.setdefault(set_name, (type_name, set()))[1].update(entries)
+
+    def destroy(self, set_name):
+        del self.sets[set_name]
+
+    def add(self, set_name, entry, options=None):
+        self.sets[set_name][1].add(entry)
+
+    def delete(self, set_name, entry, options=None):
+        self.sets[set_name][1].remove(entry)
+
+    def test(self, set_name, entry, options=None):
+        if entry not in self.sets[set_name][1]:
+            raise ValueError("'%s' is not in set '%s'" % (entry, set_name))
+
+class ZoneTestCase(unittest.TestCase):
+    def setUp(self):
+        self._enable_ip_forwarding = firewall.core.fw_zone.enable_ip_forwarding
+        firewall.core.fw_zone.enable_ip_forwarding = lambda ipv: True
+        self.fw = RecordingFirewall()
+        self.fw._ipset = RecordingIPSet()
+        obj = Zone()
+        obj.name = "test"
+        self.fw.zone.add_zone(obj)
+        obj.applied = True
+
+    def tearDown(self):
+        firewall.core.fw_zone.enable_ip_forwarding = self._enable_ip_forwarding
+
+    def rules(self, table=None, chain=None):
+        # the applied rules of the table, optionally only for the chain,
+        # without the created chains
+        ret = [ ]
+        for (ipv, rule) in self.fw.applied:
+            if rule[0] != "-t" or (table is not None and rule[1] != table):
+                continue
+            if rule[2] not in [ "-A", "-I", "-D" ]:
+                continue
+            if chain is not None and rule[3] != chain:
+                continue
+            ret.append(rule)
+        return ret
+
+class TestForwardPortRules(ZoneTestCase):
+    """
+    The rules of forward ports and forward port rich rules with and
+    without ForwardPortMarks.
+    """
+    def test_marks(self):
+        self.fw._forward_port_marks = True
+        self.fw.zone.add_forward_port("test", "80", "tcp", "8080", "10.0.0.2")
+        mark = "0x%x" % self.fw._min_mark
+        self.assertEqual(self.rules("mangle", "PRE_test_allow"),
+                         [ [ "-t", "mangle", "-A", "PRE_test_allow",
+                             "-p", "tcp", "--dport", "80",
+                             "-j", "MARK", "--set-mark", mark ] ])
+        self.assertEqual(self.rules("filter", "FWDI_test_allow"),
+                         [ [ "-t", "filter", "-A", "FWDI_test_allow",
+                             "-m", "conntrack", "--ctstate", "NEW",
+                             "-m", "mark", "--mark", mark,
+                             "-j", "ACCEPT" ] ])
+        self.fw.zone.remove_forward_port("test", "80", "tcp", "8080",
+                                         "10.0.0.2")
+        self.assertEqual(self.fw._marks, set())
+
+    def test_no_marks(self):
+        self.fw._forward_port_marks = False
+        self.fw.zone.add_forward_port("test", "80", "tcp", "8080", "10.0.0.2")
+        self.fw.zone.add_forward_port("test", "22", "tcp", "2222")
+        self.assertEqual(self.rules("mangle"), [ ])
+        self.assertEqual(self.rules("nat", "PRE_test_allow"),
+                         [ [ "-t", "nat", "-A", "PRE_test_allow",
+                             "-p", "tcp", "--dport", "80",
+                             "-j", "DNAT", "--to-destination",
+                             "10.0.0.2:8080" ],
+                           [ "-t", "nat", "-A", "PRE_test_allow",
+                             "-p", "tcp", "--dport", "22",
+                             "-j", "DNAT", "--to-destination", ":2222" ] ])
+        # only the DNAT of the forward port is accepted
+        self.assertEqual(self.rules("filter", "FWDI_test_allow"),
+                         [ [ "-t", "filter", "-A", "FWDI_test_allow",
+                             "-p", "tcp",
+                             "-m", "conntrack", "--ctstate", "NEW",
+                             "-m", "conntrack", "--ctstate", "DNAT",
+                             "--ctorigdstport", "80",
+                             "--ctreplsrc", "10.0.0.2",
+                             "--ctreplsrcport", "8080", "-j", "ACCEPT" ] ])
+        self.assertEqual(self.rules("filter", "IN_test_allow"),
+                         [ [ "-t", "filter", "-A", "IN_test_allow",
+                             "-p", "tcp",
+                             "-m", "conntrack", "--ctstate", "NEW",
+                             "-m", "conntrack", "--ctstate", "DNAT",
+                             "--ctorigdstport", "22",
+                             "--ctreplsrcport", "2222", "-j", "ACCEPT" ] ])
+        self.assertEqual(self.fw._marks, set())
+
+        # removing a forward port removes its accept rule only
+        del self.fw.applied[:]
+        self.fw.zone.remove_forward_port("test", "22", "tcp", "2222")
+        self.assertEqual([ rule[3] for rule in self.rules() ],
+                         [ "PRE_test_allow", "IN_test_allow" ])
+        self.assertTrue(all(rule[2] == "-D" for rule in self.rules()))
+
+    def test_rich_no_marks(self):
+        self.fw._forward_port_marks = False
+        rule = Rich_Rule(rule_str='rule family=ipv4 source address=10.1.0.0/16 '
+                         'forward-port port=443 protocol=tcp to-addr=10.0.0.3')
+        self.fw.zone.add_rule("test", rule)
+        self.assertEqual(self.rules("filter", "FWDI_test_allow"),
+                         [ [ "-t", "filter", "-A", "FWDI_test_allow",
+                             "-s", "10.1.0.0/16", "-p", "tcp",
+                             "-m", "conntrack", "--ctstate", "NEW",
+                             "-m", "conntrack", "--ctstate", "DNAT",
+                             "--ctorigdstport", "443",
+                             "--ctreplsrc", "10.0.0.3", "-j", "ACCEPT" ] ])
+        self.assertEqual(self.fw._marks, set())
+
+    def test_failed_add_frees_mark(self):
+        self.fw._forward_port_marks = True
+        self.fw.fail.add("DNAT")
+        self.assertRaises(FirewallError, self.fw.zone.add_forward_port,
+                          "test", "80", "tcp", "8080", "10.0.0.2")
+        self.assertEqual(self.fw._marks, set())
+        rule = Rich_Rule(rule_str='rule family=ipv4 forward-port port=443 '
+                         'protocol=tcp to-addr=10.0.0.3')
+        self.assertRaises(FirewallError, self.fw.zone.add_rule, "test", rule)
+        self.assertEqual(self.fw._marks, set())
+
+    def test_failed_reapply_keeps_mark(self):
+        # a failed re-apply must not free the mark of the forward port, that
+        # is still stored in the settings. The mark of a rich rule is freed
+        # if the rule is unapplied, the rule is getting a new mark.
+        self.fw._forward_port_marks = True
+        self.fw.zone.add_forward_port("test", "80", "tcp", "8080", "10.0.0.2")
+        rule = Rich_Rule(rule_str='rule family=ipv4 forward-port port=443 '
+                         'protocol=tcp to-addr=10.0.0.3')
+        self.fw.zone.add_rule("test", rule)
+        self.assertEqual(len(self.fw._marks), 2)
+        self.fw.zone.unapply_zone_settings("test")
+        marks = set(self.fw._marks)
+        self.assertEqual(len(marks), 1)
+        self.fw.fail.add("DNAT")
+        self.fw.zone.apply_zone_settings("test")
+        self.assertEqual(self.fw._marks, marks)
+        self.fw.fail.clear()
+        self.fw.zone.remove_forward_port("test", "80", "tcp", "8080",
+                                         "10.0.0.2")
+        self.fw.zone.remove_rule("test", rule)
+        self.assertEqual(self.fw._marks, set())
+
+class TestTimedRules(ZoneTestCase):
+    """
+    Timed rich rules added as entries to ipsets with timeout.
+    """
+    def test_timed_rule(self):
+        rule1 = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                          'accept')
+        rule2 = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.2 '
+                          'port port=22 protocol=tcp accept')
+        self.fw.zone.add_rule("test", rule1, timeout=60)
+        self.fw.zone.add_rule("test", rule2, timeout=60)
+        # the ipsets are using the reserved prefix
+        self.assertEqual(self.fw._ipset.sets,
+                         { "fwd_test_timed4": ("hash:net",
+                                               set([ "10.0.0.1" ])),
+                           "fwd_test_timed4p": ("hash:net,port",
+                                                set([ "10.0.0.2,tcp:22" ])) })
+        self.assertEqual([ rule[-4:] for rule in
+                           self.rules("filter", "IN_test_allow") ],
+                         [ [ "fwd_test_timed4", "src", "-j", "ACCEPT" ],
+                           [ "--ctstate", "NEW", "-j", "ACCEPT" ] ])
+        self.assertTrue(self.fw.zone.query_rule("test", rule1))
+
+        # an entry expired by the kernel is not enabled anymore
+        self.fw._ipset.sets["fwd_test_timed4"][1].clear()
+        self.assertFalse(self.fw.zone.query_rule("test", rule1))
+        self.assertTrue(self.fw.zone.query_rule("test", rule2))
+
+        self.fw.zone.remove_rule("test", rule1)
+        self.fw.zone.remove_rule("test", rule2)
+        self.assertEqual(self.fw._ipset.sets, { })
+
+    def test_leftover_set(self):
+        # a set of a previous run is replaced
+        self.fw._ipset.sets["fwd_test_timed4"] = ("hash:net",
+                                                  set([ "10.0.0.9" ]))
+        rule = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                          'accept')
+        self.fw.zone.add_rule("test", rule, timeout=60)
+        self.assertEqual(self.fw._ipset.sets["fwd_test_timed4"][1],
+                         set([ "10.0.0.1" ]))
+
+class TestSourceGroups(ZoneTestCase):
+    """
+    Rich rules with a source are grouped in a sub chain per source and chain
+    of the input target of the zone.
+    """
+    def setUp(self):
+        super(TestSourceGroups, self).setUp()
+        # no aggregation of the addresses in ipsets
+        self.fw.ipset_enabled = False
+        del self.fw.applied[:]
+
+    def rule(self, addr, port, action="accept"):
+        return Rich_Rule(rule_str='rule family=ipv4 source address=%s '
+                         'port port=%s protocol=tcp %s' % (addr, port, action))
+
+    def jumps(self, chain):
+        return [ rule[4:] for rule in self.rules("filter", chain) ]
+
+    def test_sub_chains(self):
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1", 22))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1", 80))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.2", 80, "drop"))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.2", 22))
+        self.assertEqual(self.jumps("IN_test_allow"),
+                         [ [ "-s", "10.0.0.1", "-j", "IN_test_src_1" ],
+                           [ "-s", "10.0.0.2", "-j", "IN_test_src_3" ] ])
+        self.assertEqual(self.jumps("IN_test_deny"),
+                         [ [ "-s", "10.0.0.2", "-j", "IN_test_src_2" ] ])
+        # the rules in the sub chains do not match the source again
+        self.assertEqual([ rule[-8:] for rule in
+                           self.rules("filter", "IN_test_src_1") ],
+                         [ [ "--dport", "22", "-m", "conntrack",
+                             "--ctstate", "NEW", "-j", "ACCEPT" ],
+                           [ "--dport", "80", "-m", "conntrack",
+                             "--ctstate", "NEW", "-j", "ACCEPT" ] ])
+        self.assertTrue("-s" not in self.rules("filter", "IN_test_src_1")[0])
+        self.assertEqual(sorted(self.fw.zone._source_groups.values()),
+                         [ ("IN_test_src_1", 2), ("IN_test_src_2", 1),
+                           ("IN_test_src_3", 1) ])
+
+    def test_remove(self):
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1", 22))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1", 80))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.2", 22))
+        del self.fw.applied[:]
+
+        # the jump and the chain are kept as long as there are rules
+        self.fw.zone.remove_rule("test", self.rule("10.0.0.1", 22))
+        self.assertEqual([ rule[2:4] for (ipv, rule) in self.fw.applied ],
+                         [ [ "-D", "IN_test_src_1" ] ])
+
+        del self.fw.applied[:]
+        self.fw.zone.remove_rule("test", self.rule("10.0.0.1", 80))
+        self.assertEqual([ rule[2:4] for (ipv, rule) in self.fw.applied ],
+                         [ [ "-D", "IN_test_src_1" ],
+                           [ "-D", "IN_test_allow" ],
+                           [ "-X", "IN_test_src_1" ] ])
+        self.assertEqual(list(self.fw.zone._source_groups.values()),
+                         [ ("IN_test_src_2", 1) ])
+
+        # the free name is used again
+        self.fw.zone.add_rule("test", self.rule("10.0.0.3", 22))
+        self.assertEqual(self.jumps("IN_test_allow")[-1],
+                         [ "-s", "10.0.0.3", "-j", "IN_test_src_1" ])
+
+    def test_failed_rule(self):
+        # the sub chain of a failed rule is removed again
+        self.fw.fail.add("8080")
+        self.assertRaises(FirewallError, self.fw.zone.add_rule, "test",
+                          self.rule("10.0.0.1", 8080))
+        self.assertEqual(self.fw.zone._source_groups, { })
+        self.assertEqual([ rule[2:4] for (ipv, rule) in self.fw.applied
+                           if "_src_" in rule[3] ],
+                         [ [ "-N", "IN_test_src_1" ],
+                           [ "-X", "IN_test_src_1" ] ])
+        self.fw.fail.clear()
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1", 8080))
+        self.assertEqual(self.jumps("IN_test_allow"),
+                         [ [ "-s", "10.0.0.1", "-j", "IN_test_src_1" ] ])
+
+class TestRuleSets(ZoneTestCase):
+    """
+    Rich rules only differing in the source or destination address are
+    aggregated in an ipset matched by one rule.
+    """
+    def rule(self, addr, port=22, family="ipv4"):
+        return Rich_Rule(rule_str='rule family=%s source address=%s '
+                         'port port=%s protocol=tcp accept' % \
+                         (family, addr, port))
+
+    def test_aggregate(self):
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1"))
+        # the first rule is applied as is
+        self.assertEqual(self.fw._ipset.sets, { })
+        del self.fw.applied[:]
+        self.fw.zone.add_rule("test", self.rule("10.0.0.2"))
+        self.assertEqual(self.fw._ipset.sets,
+                         { "fwd_rules_1": ("hash:net",
+                                           set([ "10.0.0.1", "10.0.0.2" ])) })
+        # the rule matching the ipset replaces the rule of the first address
+        self.assertEqual([ rule[2:9] for rule in
+                           self.rules("filter", "IN_test_allow") ],
+                         [ [ "-A", "IN_test_allow", "-m", "set",
+                             "--match-set", "fwd_rules_1", "src" ],
+                           [ "-D", "IN_test_allow", "-s", "10.0.0.1", "-j",
+                             "IN_test_src_1" ] ])
+
+        # further rules are only added to the ipset
+        del self.fw.applied[:]
+        self.fw.zone.add_rule("test", self.rule("10.0.0.3"))
+        self.assertEqual(self.fw.applied, [ ])
+        self.assertEqual(self.fw._ipset.sets["fwd_rules_1"][1],
+                         set([ "10.0.0.1", "10.0.0.2", "10.0.0.3" ]))
+        self.assertTrue(self.fw.zone.query_rule("test", self.rule("10.0.0.3")))
+
+    def test_groups(self):
+        # rules with other elements or families are in other groups
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1"))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.2"))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1", 80))
+        self.fw.zone.add_rule("test", self.rule("10.0.0.2", 80))
+        self.fw.zone.add_rule("test", self.rule("fe80::1", 80, "ipv6"))
+        self.assertEqual(sorted(self.fw._ipset.sets), [ "fwd_rules_1",
+                                                        "fwd_rules_2" ])
+        self.assertEqual(self.fw.zone._rule_set_names,
+                         { "fwd_rules_1": "ipv4", "fwd_rules_2": "ipv4" })
+
+    def test_remove(self):
+        for addr in [ "10.0.0.1", "10.0.0.2", "10.0.0.3" ]:
+            self.fw.zone.add_rule("test", self.rule(addr))
+        del self.fw.applied[:]
+        self.fw.zone.remove_rule("test", self.rule("10.0.0.1"))
+        self.fw.zone.remove_rule("test", self.rule("10.0.0.2"))
+        self.assertEqual(self.fw.applied, [ ])
+        self.assertEqual(self.fw._ipset.sets["fwd_rules_1"][1],
+                         set([ "10.0.0.3" ]))
+        self.assertFalse(self.fw.zone.query_rule("test",
+                                                 self.rule("10.0.0.1")))
+
+        # the ipset is destroyed with the last rule
+        self.fw.zone.remove_rule("test", self.rule("10.0.0.3"))
+        self.assertEqual(self.rules("filter", "IN_test_allow"),
+                         [ [ "-t", "filter", "-D", "IN_test_allow",
+                             "-m", "set", "--match-set", "fwd_rules_1",
+                             "src", "-j", "IN_test_src_2" ] ])
+        self.assertEqual(self.fw._ipset.sets, { })
+        self.assertEqual(self.fw.zone._rule_sets, { })
+        self.assertEqual(self.fw.zone._rule_set_names, { })
+
+    def test_failed_create(self):
+        # the rule is applied as is if the ipset rule fails
+        self.fw.zone.add_rule("test", self.rule("10.0.0.1"))
+        self.fw.fail.add("fwd_rules_1")
+        self.assertRaises(FirewallError, self.fw.zone.add_rule, "test",
+                          self.rule("10.0.0.2"))
+        self.assertEqual(self.fw._ipset.sets, { })
+        self.assertEqual(self.fw.zone._rule_set_names, { })
+        self.assertTrue(self.fw.zone.query_rule("test", self.rule("10.0.0.1")))
+        self.assertFalse(self.fw.zone.query_rule("test",
+                                                 self.rule("10.0.0.2")))
+
+    def test_apply_zone(self):
+        # the ipset is created with all addresses when the zone is applied
+        for addr in [ "10.0.0.1", "10.0.0.2", "10.0.0.3" ]:
+            self.fw.zone.add_rule("test", self.rule(addr))
+        self.fw.zone.unapply_zone_settings("test")
+        self.assertEqual(self.fw._ipset.sets, { })
+        del self.fw.applied[:]
+        self.fw.zone.apply_zone_settings("test")
+        self.assertEqual(self.fw._ipset.sets,
+                         { "fwd_rules_1": ("hash:net",
+                                           set([ "10.0.0.1", "10.0.0.2",
+                                                 "10.0.0.3" ])) })
+        self.assertEqual(len(self.rules("filter", "IN_test_allow")), 1)
+
+class TestConfigWithSettings(ZoneTestCase):
+    """
+    The exported config with the runtime settings is cached until a setting
+    of the zone is changed.
+    """
+    def setUp(self):
+        super(TestConfigWithSettings, self).setUp()
+        obj = Service()
+        obj.name = "ssh"
+        obj.ports = [ ("22", "tcp") ]
+        self.fw.service.add_service(obj)
+        obj = IcmpType()
+        obj.name = "echo-request"
+        self.fw.icmptype.add_icmptype(obj)
+        obj = Zone()
+        obj.name = "other"
+        self.fw.zone.add_zone(obj)
+        obj.applied = True
+
+    def test_cached(self):
+        config = self.fw.zone.get_config_with_settings("test")
+        self.assertTrue(self.fw.zone.get_config_with_settings("test")
+                        is config)
+        # changes of other zones are not affecting the cache
+        self.fw.zone.add_port("other", "80", "tcp")
+        self.assertTrue(self.fw.zone.get_config_with_settings("test")
+                        is config)
+
+    def test_changes(self):
+        rule = Rich_Rule(rule_str='rule family=ipv4 source address=10.0.0.1 '
+                         'accept')
+        zone = self.fw.zone
+        changes = [
+            (zone.add_interface, "eth0"), (zone.remove_interface, "eth0"),
+            (zone.add_source, "10.0.0.0/8"),
+            (zone.remove_source, "10.0.0.0/8"),
+            (zone.add_service, "ssh"), (zone.remove_service, "ssh"),
+            (zone.add_port, "80", "tcp"), (zone.remove_port, "80", "tcp"),
+            (zone.add_protocol, "gre"), (zone.remove_protocol, "gre"),
+            (zone.add_masquerade, ), (zone.remove_masquerade, ),
+            (zone.add_forward_port, "22", "tcp", "2222"),
+            (zone.remove_forward_port, "22", "tcp", "2222"),
+            (zone.add_icmp_block, "echo-request"),
+            (zone.remove_icmp_block, "echo-request"),
+            (zone.add_rule, rule), (zone.remove_rule, rule) ]
+        for change in changes:
+            config = zone.get_config_with_settings("test")
+            change[0]("test", *change[1:])
+            _config = zone.get_config_with_settings("test")
+            self.assertNotEqual(_config, config, change[0].__name__)
+            self.assertTrue(zone.get_config_with_settings("test") is _config)
+
+        # an interface moved to an other zone changes both zones
+        zone.add_interface("test", "eth1")
+        zone.get_config_with_settings("test")
+        zone.get_config_with_settings("other")
+        zone.change_zone_of_interface("other", "eth1")
+        self.assertEqual(zone.get_config_with_settings("test")[10], [ ])
+        self.assertEqual(zone.get_config_with_settings("other")[10],
+                         [ "eth1" ])
+
+if __name__ == '__main__':
+    unittest.main()